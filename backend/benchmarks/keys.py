@@ -0,0 +1,192 @@
+"""
+Python script for measuring what the type of the snippet identifier costs: the
+same snippets are stored once with identifiers as 36 character strings (VARCHAR)
+and once as 16 bytes (see 'models.CompactUUID'), and the size of the primary key
+index and the latency of point lookups by identifier are compared.
+
+Example: python keys.py --snippets 100000 --lookups 5000
+
+The database defaults to SQLite (sizes are read from its 'dbstat' table, if SQLite
+was compiled with it), a local Postgres can be given instead. The length of the
+Redis keys of a snippet with either form of identifier is printed as well. The
+results are printed as JSON. As in the Docker image, the 'common' directory has to
+be available inside the share function directory (e.g. as a symbolic link).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List
+from share import SHARE_DIR, percentile, snippet_code
+from startup import SECRETS
+
+
+LAYOUTS = ("varchar", "compact")
+
+
+def parse_commandline_args(args_list = None):
+    """ Setup, parse and validate given commandline arguments.
+    """
+    parser = argparse.ArgumentParser(description = "")
+    parser.add_argument("-snippets", "--snippets",
+        required = False,
+        default = 50000,
+        type = int,
+        help = "Specify the number of snippets stored per layout.",
+    )
+    parser.add_argument("-lookups", "--lookups",
+        required = False,
+        default = 2000,
+        type = int,
+        help = "Specify the number of point lookups per layout.",
+    )
+    parser.add_argument("-database_url", "--database_url",
+        required = False,
+        default = None,
+        type = str,
+        help = "Specify a database (e.g. a local Postgres). Defaults to SQLite.",
+    )
+    parser.add_argument("-seed", "--seed",
+        required = False,
+        default = 0,
+        type = int,
+        help = "Specify the seed of the identifiers that are looked up.",
+    )
+    args = parser.parse_args(args_list)
+    return args
+
+
+async def sizes(conn, table: str) -> Dict[str, Any]:
+    # Bytes of the table and of its indexes (i.e. the primary key index)
+    if conn.dialect.name == "postgresql":
+        result = await conn.exec_driver_sql(
+            f"SELECT pg_relation_size('{table}'), pg_indexes_size('{table}')"
+        )
+        table_bytes, index_bytes = result.one()
+        return {"table_bytes": table_bytes, "index_bytes": index_bytes}
+    from sqlalchemy.exc import OperationalError
+    try:
+        result = await conn.exec_driver_sql(
+            "SELECT dbstat.name, SUM(pgsize) FROM dbstat JOIN sqlite_master"
+            f" ON sqlite_master.name = dbstat.name WHERE tbl_name = '{table}'"
+            " GROUP BY dbstat.name"
+        )
+    except OperationalError:
+        return {"table_bytes": None, "index_bytes": None}
+    rows = dict(result.all())
+    table_bytes = rows.pop(table, 0)
+    return {"table_bytes": table_bytes, "index_bytes": sum(rows.values())}
+
+
+async def measure(engine, table, keys: List[str], lookups: int) -> Dict[str, Any]:
+    """Store the snippets in the table and look them up by identifier.
+
+    Args:
+        engine (AsyncEngine): The engine of the database.
+        table (Table): The table, with either type of identifier.
+        keys (List[str]): The identifiers of the snippets, in the form of the layout.
+        lookups (int): The number of point lookups.
+
+    Returns:
+        Dict[str, Any]: The sizes and the lookup latency percentiles (in
+            microseconds).
+    """
+    from sqlalchemy import select
+    async with engine.begin() as conn:
+        await conn.run_sync(table.drop, checkfirst = True)
+        await conn.run_sync(table.create)
+        for i in range(0, len(keys), 1000):
+            await conn.execute(table.insert(), [
+                {"snippetID": key, "code": snippet_code(i + j)}
+                for j, key in enumerate(keys[i:i + 1000])
+            ])
+    async with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.exec_driver_sql(f"VACUUM ANALYZE {table.name}")
+        result = await sizes(conn, table.name)
+        latencies = []
+        for key in random.choices(keys, k = lookups):
+            started = time.perf_counter()
+            await conn.execute(select(table.c.code).where(table.c.snippetID == key))
+            latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    result["lookup_us"] = {
+        f"p{q}": round(1e6 * percentile(latencies, q), 1) for q in (50, 90, 99)
+    }
+    return result
+
+
+async def benchmark(args) -> Dict[str, Any]:
+    # The share service reads its configuration on import
+    sys.path.insert(0, SHARE_DIR)
+    from sqlalchemy import Column, MetaData, String, Table, Text
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from ids import public_id
+    from models import CompactUUID
+    from runoutput import run_key
+
+    metadata = MetaData()
+    tables = {
+        "varchar": Table("snippet_keys_varchar", metadata,
+            Column("snippetID", String, primary_key = True),
+            Column("code", Text),
+        ),
+        "compact": Table("snippet_keys_compact", metadata,
+            Column("snippetID", CompactUUID, primary_key = True),
+            Column("code", Text),
+        ),
+    }
+    engine = create_async_engine(args.database_url)
+    snippet_ids = [uuid.uuid4() for _ in range(args.snippets)]
+    keys = {
+        "varchar": [str(_) for _ in snippet_ids],
+        "compact": [public_id(_) for _ in snippet_ids],
+    }
+    results = {
+        "config": {
+            "snippets": args.snippets,
+            "lookups": args.lookups,
+            "database": engine.dialect.name,
+        },
+        "layouts": {},
+        # Redis keys of a snippet: its code and its run output (among others)
+        "redis_key_bytes": {
+            layout: {"code": len(keys[layout][0]), "run": len(run_key(keys[layout][0]))}
+            for layout in LAYOUTS
+        },
+    }
+    try:
+        for layout in LAYOUTS:
+            results["layouts"][layout] = await measure(
+                engine, tables[layout], keys[layout], args.lookups,
+            )
+        async with engine.begin() as conn:
+            await conn.run_sync(metadata.drop_all)
+    finally:
+        await engine.dispose()
+    return results
+
+
+def main(args):
+    random.seed(args.seed)
+    with TemporaryDirectory() as td:
+        for name, value in SECRETS.items():
+            with open(os.path.join(td, name), "w") as f:
+                f.write(value)
+        os.environ["SECRETS_DIR"] = td
+        if args.database_url is None:
+            args.database_url = f"sqlite+aiosqlite:///{os.path.join(td, 'keys.db')}"
+        os.environ["DATABASE_URL"] = args.database_url
+        os.environ["REDIS_URL"] = "memory://"
+        results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == "__main__":
+    args = parse_commandline_args()
+    main(args = args)
@@ -0,0 +1,314 @@
+"""
+Python script for benchmarking the share service without the cluster: the service
+runs in process against SQLite (or a local Postgres) and an in-process store in
+place of Redis (or a local Redis), and is driven with a mix of traffic patterns.
+With '--storage embedded' the embedded storage backend is measured instead. With
+'--replica_urls' snippet lookups are routed to read replicas, e.g. a second local
+Postgres that streams from the one given by '--database_url'.
+
+Example: python share.py --scenarios read,share,unknown --requests 5000
+
+Scenarios:
+    read:    Reads of existing snippets, Zipf distributed over their identifiers
+    share:   Bursts of new snippets, some of them with code that was shared before
+    unknown: Reads of identifiers that do not exist (mostly random UUIDs)
+
+The results (latency percentiles, requests per second, status codes and the hit
+ratio of each cache tier per scenario) are printed as JSON. As in the Docker
+image, the 'common' directory has to be available inside the share function
+directory (e.g. as a symbolic link).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Tuple
+from startup import BACKEND_DIR, SECRETS
+
+
+SHARE_DIR = os.path.join(BACKEND_DIR, "gleam-playground-share")
+SCENARIOS = ("read", "share", "unknown")
+
+# A request: method, path and JSON body
+Request = Tuple[str, str, Any]
+
+
+def parse_commandline_args(args_list = None):
+    """ Setup, parse and validate given commandline arguments.
+    """
+    parser = argparse.ArgumentParser(description = "")
+    parser.add_argument("-scenarios", "--scenarios",
+        required = False,
+        default = ",".join(SCENARIOS),
+        type = str,
+        help = "Specify a comma separated list of scenarios to run.",
+    )
+    parser.add_argument("-requests", "--requests",
+        required = False,
+        default = 2000,
+        type = int,
+        help = "Specify the number of requests per scenario.",
+    )
+    parser.add_argument("-concurrency", "--concurrency",
+        required = False,
+        default = 20,
+        type = int,
+        help = "Specify the number of concurrent clients.",
+    )
+    parser.add_argument("-snippets", "--snippets",
+        required = False,
+        default = 1000,
+        type = int,
+        help = "Specify the number of snippets stored before the benchmark.",
+    )
+    parser.add_argument("-zipf", "--zipf",
+        required = False,
+        default = 1.1,
+        type = float,
+        help = "Specify the exponent of the Zipf distribution of reads.",
+    )
+    parser.add_argument("-burst", "--burst",
+        required = False,
+        default = 50,
+        type = int,
+        help = "Specify the number of snippets shared at once in the share scenario.",
+    )
+    parser.add_argument("-storage", "--storage",
+        required = False,
+        default = "postgres",
+        choices = ("postgres", "embedded"),
+        type = str,
+        help = "Specify the storage backend of the service.",
+    )
+    parser.add_argument("-database_url", "--database_url",
+        required = False,
+        default = None,
+        type = str,
+        help = "Specify a database (e.g. a local Postgres). Defaults to SQLite.",
+    )
+    parser.add_argument("-replica_urls", "--replica_urls",
+        required = False,
+        default = None,
+        type = str,
+        help = "Specify comma separated read replicas of the database (e.g. a second local Postgres).",
+    )
+    parser.add_argument("-redis_url", "--redis_url",
+        required = False,
+        default = None,
+        type = str,
+        help = "Specify a Redis server. Defaults to an in-process store.",
+    )
+    parser.add_argument("-seed", "--seed",
+        required = False,
+        default = 0,
+        type = int,
+        help = "Specify the seed of the traffic patterns.",
+    )
+    args = parser.parse_args(args_list)
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            parser.error(f"Unknown scenario: {scenario}")
+    return args
+
+
+def snippet_code(i: int) -> str:
+    return f'import gleam/io\n\npub fn main() {{\n  io.println("Snippet {i}")\n}}\n'
+
+
+def zipf_reads(snippet_ids: List[str], n: int, exponent: float) -> List[Request]:
+    # The i-th most popular snippet is read proportionally to 1 / i^exponent
+    weights = list(itertools.accumulate(
+        1 / (rank ** exponent) for rank in range(1, len(snippet_ids) + 1)
+    ))
+    return [
+        ("GET", f"/snippet/{snippet_id}", None)
+        for snippet_id in random.choices(snippet_ids, cum_weights = weights, k = n)
+    ]
+
+
+def share_bursts(n: int, duplicate_rate: float = 0.2) -> List[Request]:
+    requests = []
+    for i in range(n):
+        # Some snippets are shared again unchanged (e.g. examples)
+        if i > 0 and random.random() < duplicate_rate:
+            code = snippet_code(-random.randrange(i) - 1)
+        else:
+            code = snippet_code(-i - 1)
+        requests.append(("POST", "/snippet", {"code": code}))
+    return requests
+
+
+def unknown_reads(n: int) -> List[Request]:
+    requests = []
+    for _ in range(n):
+        r = random.random()
+        if r < 0.1:
+            # Malformed identifiers
+            snippet_id = uuid.uuid4().hex[:12]
+        elif r < 0.3 and requests:
+            # The same unknown identifier again
+            snippet_id = random.choice(requests)[1].rsplit("/", 1)[1]
+        else:
+            snippet_id = str(uuid.uuid4())
+        requests.append(("GET", f"/snippet/{snippet_id}", None))
+    return requests
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+async def drive(
+    client,
+    requests: List[Request],
+    concurrency: int,
+    burst: int = 0,
+    ) -> Dict[str, Any]:
+    """Send the requests with a number of concurrent clients and time each of them.
+
+    Args:
+        client (httpx.AsyncClient): The client of the service.
+        requests (List[Request]): The requests to send.
+        concurrency (int): The number of concurrent clients.
+        burst (int, optional): Send the requests in bursts of this size instead,
+            each burst at once. Defaults to 0.
+
+    Returns:
+        Dict[str, Any]: Throughput, latency percentiles (in milliseconds) and the
+            number of responses per status code.
+    """
+    latencies = []
+    statuses: Dict[str, int] = {}
+
+    async def worker(pending) -> None:
+        for method, path, body in pending:
+            started = time.perf_counter()
+            response = await client.request(method, path, json = body)
+            latencies.append(time.perf_counter() - started)
+            status = str(response.status_code)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    if burst > 0:
+        for i in range(0, len(requests), burst):
+            pending = iter(requests[i:i + burst])
+            await asyncio.gather(*[worker(pending) for _ in range(burst)])
+    else:
+        pending = iter(requests)
+        await asyncio.gather(*[worker(pending) for _ in range(concurrency)])
+    duration = time.perf_counter() - started
+    latencies.sort()
+    latency_ms = {f"p{q}": round(1000 * percentile(latencies, q), 3) for q in (50, 90, 99)}
+    latency_ms["max"] = round(1000 * latencies[-1], 3) if latencies else 0.0
+    return {
+        "requests": len(requests),
+        "duration_s": round(duration, 3),
+        "rps": round(len(requests) / duration, 1) if duration > 0 else None,
+        "latency_ms": latency_ms,
+        "statuses": statuses,
+    }
+
+
+def tier_deltas(before: Dict[str, Dict[str, float]], after: Dict[str, Dict[str, float]]):
+    # Hit ratios of the lookups made between two snapshots of 'metrics.hit_ratios'
+    tiers = {}
+    for tier, counts in after.items():
+        hits = counts["hits"] - before.get(tier, {}).get("hits", 0)
+        misses = counts["misses"] - before.get(tier, {}).get("misses", 0)
+        if hits + misses:
+            tiers[tier] = {"hits": hits, "misses": misses, "ratio": round(hits / (hits + misses), 4)}
+    return tiers
+
+
+async def benchmark(args) -> Dict[str, Any]:
+    # The share service reads its configuration on import, and the bundled example
+    # snippets relative to its directory
+    sys.path.insert(0, SHARE_DIR)
+    os.chdir(SHARE_DIR)
+    import httpx
+    import main as share
+    import crud
+    from database import SessionLocal, engine
+    from metrics import hit_ratios
+    from replicas import read_replicas
+
+    await share.app.router.startup()
+    try:
+        await share._startup_task
+        # Store the snippets that are read, and make the existence filter aware of them
+        snippet_ids = [str(uuid.uuid4()) for _ in range(args.snippets)]
+        for i in range(0, len(snippet_ids), 500):
+            async with SessionLocal() as db:
+                await crud.insert_snippets(db, [
+                    (snippet_id, snippet_code(i + j), crud.content_hash(snippet_code(i + j)))
+                    for j, snippet_id in enumerate(snippet_ids[i:i + 500])
+                ])
+        await share.snippet_filter.rebuild(share.load_snippet_ids)
+
+        results = {
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "snippets": args.snippets,
+                "zipf": args.zipf,
+                "burst": args.burst,
+                "storage": args.storage,
+                "database": engine.dialect.name,
+                "replicas": len(read_replicas.engines),
+                "redis": "memory" if args.redis_url is None else "server",
+            },
+            "scenarios": {},
+        }
+        async with httpx.AsyncClient(app = share.app, base_url = "http://share") as client:
+            for scenario in args.scenarios.split(","):
+                before = hit_ratios()
+                if scenario == "read":
+                    requests = zipf_reads(snippet_ids, args.requests, args.zipf)
+                    result = await drive(client, requests, args.concurrency)
+                elif scenario == "share":
+                    requests = share_bursts(args.requests)
+                    result = await drive(client, requests, args.concurrency, burst = args.burst)
+                else:
+                    requests = unknown_reads(args.requests)
+                    result = await drive(client, requests, args.concurrency)
+                result["tiers"] = tier_deltas(before, hit_ratios())
+                results["scenarios"][scenario] = result
+        return results
+    finally:
+        await share.app.router.shutdown()
+
+
+def main(args):
+    random.seed(args.seed)
+    with TemporaryDirectory() as td:
+        for name, value in SECRETS.items():
+            with open(os.path.join(td, name), "w") as f:
+                f.write(value)
+        os.environ["SECRETS_DIR"] = td
+        os.environ["DB_BOOTSTRAP"] = "true"
+        os.environ["STORAGE_BACKEND"] = args.storage
+        os.environ["EMBEDDED_DB_PATH"] = os.path.join(td, "share.db")
+        # Both backends default to SQLite and the in-process store here
+        if args.storage == "postgres" or args.database_url is not None:
+            os.environ["DATABASE_URL"] = args.database_url or \
+                f"sqlite+aiosqlite:///{os.path.join(td, 'share.db')}"
+        if args.replica_urls is not None:
+            os.environ["DATABASE_REPLICA_URLS"] = args.replica_urls
+        if args.storage == "postgres" or args.redis_url is not None:
+            os.environ["REDIS_URL"] = args.redis_url or "memory://"
+        results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == "__main__":
+    args = parse_commandline_args()
+    main(args = args)
@@ -0,0 +1,154 @@
+"""
+Python script for measuring the cold start of a function: the time from launching
+its server process until it answers its first request.
+
+Example: python startup.py --function gleam-playground-share --runs 10
+
+The function is started the same way as in its Docker image (uvicorn). Its
+secrets are read from a temporary directory filled with placeholder values, so
+neither a database nor Redis has to be reachable for the '/version' endpoint.
+As in the Docker image, the 'common' directory has to be available inside the
+function directory (e.g. as a symbolic link).
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory, TemporaryFile
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Placeholder values of the secrets read on import
+SECRETS = {
+    "VERSION": "startup-benchmark",
+    "API_KEY": "",
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+    "REDIS_DB": "0",
+    "POSTGRES_USER": "postgres",
+    "POSTGRES_PASSWORD": "postgres",
+    "POSTGRES_PORT": "5432",
+    "POSTGRES_DB": "postgres",
+}
+
+
+def parse_commandline_args(args_list = None):
+    """ Setup, parse and validate given commandline arguments.
+    """
+    parser = argparse.ArgumentParser(description = "")
+    parser.add_argument("-function", "--function",
+        required = False,
+        default = "gleam-playground-share",
+        type = str,
+        help = "Specify the directory of the function (relative to 'backend').",
+    )
+    parser.add_argument("-path", "--path",
+        required = False,
+        default = "/version",
+        type = str,
+        help = "Specify the path of the first request.",
+    )
+    parser.add_argument("-runs", "--runs",
+        required = False,
+        default = 5,
+        type = int,
+        help = "Specify the number of cold starts to measure.",
+    )
+    parser.add_argument("-timeout", "--timeout",
+        required = False,
+        default = 30.0,
+        type = float,
+        help = "Specify the number of seconds to wait for the first response.",
+    )
+    args = parser.parse_args(args_list)
+    return args
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_response(process: subprocess.Popen, stderr, port: int, path: str, deadline: float) -> int:
+    # Poll until the server accepts connections and answers the request, or exits
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            stderr.seek(0)
+            output = stderr.read().decode("utf-8", errors = "replace")
+            raise RuntimeError(
+                f"The function exited with code {process.returncode}:\n{output}"
+            )
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout = 1)
+            connection.request("GET", path)
+            status = connection.getresponse().status
+            connection.close()
+            return status
+        except (ConnectionError, OSError):
+            time.sleep(0.005)
+    raise TimeoutError("No response within the timeout")
+
+
+def cold_start(function_dir: str, path: str, secrets_dir: str, timeout: float) -> float:
+    """Start the function once and measure the time until its first response.
+
+    Returns:
+        float: Seconds from launching the process until the first response.
+    """
+    port = free_port()
+    # As deployed, the share function does not create its tables on startup (the
+    # placeholder database is not reachable anyway)
+    env = dict(os.environ, SECRETS_DIR = secrets_dir, DB_BOOTSTRAP = "false")
+    # A file rather than a pipe, such that the process never blocks on writing it
+    stderr = TemporaryFile()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+        ],
+        cwd = function_dir,
+        env = env,
+        stderr = stderr,
+    )
+    try:
+        status = first_response(process, stderr, port, path, deadline = started + timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+        stderr.close()
+    if status >= 500:
+        raise RuntimeError(f"The first request failed with status {status}")
+    return elapsed
+
+
+def main(args):
+    function_dir = os.path.join(BACKEND_DIR, args.function)
+    with TemporaryDirectory() as secrets_dir:
+        for name, value in SECRETS.items():
+            with open(os.path.join(secrets_dir, name), "w") as f:
+                f.write(value)
+        timings = [
+            cold_start(function_dir, args.path, secrets_dir, args.timeout)
+            for _ in range(args.runs)
+        ]
+    print(json.dumps({
+        "function": args.function,
+        "path": args.path,
+        "runs": args.runs,
+        "median_ms": round(1000 * statistics.median(timings), 1),
+        "min_ms": round(1000 * min(timings), 1),
+        "max_ms": round(1000 * max(timings), 1),
+    }, indent = 2))
+
+
+if __name__ == "__main__":
+    args = parse_commandline_args()
+    main(args = args)
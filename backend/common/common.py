@@ -1,15 +1,23 @@
 from typing import Union
 from fastapi import HTTPException
+import hmac
 import json
 import os
 
-def get_secret(seret_name: str) -> str:
+def get_secret(seret_name: str, default: Union[None, str] = None) -> str:
     secret = None
     # Read kubernetes secrets from the default directory secrets directory
-    # mounted by OpenFaaS
-    # TODO: Error handling... In case a certain secret is not present...
-    with open(f"/var/openfaas/secrets/{seret_name}") as f:
-        secret = f.read()
+    # mounted by OpenFaaS (overridable e.g. to run a function locally)
+    secrets_dir = os.environ.get("SECRETS_DIR", "/var/openfaas/secrets")
+    try:
+        with open(os.path.join(secrets_dir, seret_name)) as f:
+            secret = f.read()
+    except FileNotFoundError:
+        # Optional secrets fall back to the given default, required secrets
+        # still fail loudly
+        if default is None:
+            raise
+        secret = default
     return secret
 
 
@@ -23,6 +31,23 @@ def check_api_key(x_api_key: str, api_key: Union[None, str]) -> None:
             )
 
 
+def check_admin_key(x_admin_key: Union[None, str], admin_key: Union[None, str]) -> None:
+    # Admin endpoints are disabled altogether unless an admin key is configured
+    if not admin_key:
+        raise HTTPException(
+            status_code = 404,
+            detail = 'Not Found',
+        )
+    # Compared as bytes, 'compare_digest' rejects strings with non-ASCII characters
+    if x_admin_key is None or not hmac.compare_digest(
+        x_admin_key.encode('utf-8'), admin_key.encode('utf-8'),
+    ):
+        raise HTTPException(
+            status_code = 401,
+            detail = 'Unauthorized. Wrong admin key.',
+        )
+
+
 def load_cors(PATH: Union[None, str] = None) -> dict:
     if PATH is None:
         PATH = './common/cors_config.json'
@@ -1,4 +1,3 @@
-import asyncio 
 import shutil
 import logging
 import os
@@ -9,14 +8,36 @@ from fastapi import FastAPI, Request, HTTPException
 from fastapi.params import Header
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware 
+from starlette.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from common.middleware import ContentSizeLimitMiddleware
 
-from common.common import check_api_key, str_to_bool_or_none, load_cors
+from common.common import check_admin_key, check_api_key, str_to_bool_or_none, load_cors
+from profiling import (
+    ProfilingMiddleware,
+    list_profiles,
+    read_profile,
+    read_profile_stats,
+    time_subprocess,
+)
+from spawner import SpawnerProcess, spawn
+from supersede import Superseded, SupersedeRegistry
+from timing import PhaseTimer, TimingMiddleware
 from settings import (
     ansi_escape,
     API_KEY,
+    ADMIN_KEY,
     GLEAM_PROJECT_NAME,
     GLEAM_PROJECT_FILE,
+    PROFILE_DIR,
+    PROFILE_MAX_FILES,
+    PROFILE_SAMPLE_RATE,
+    SPAWNER_ENABLED,
+    SPAWNER_SOCKET,
+    SUBPROCESS_TIMEOUT,
+    SUBPROCESS_CPU_LIMIT,
+    SUBPROCESS_MEMORY_LIMIT,
+    TOOLCHAIN_VERSION,
 )
 
 
@@ -34,46 +55,132 @@ if CORS_CONFIG:
 # Limit request size to 250000 bytes = 0.25 megabytes
 app.add_middleware(ContentSizeLimitMiddleware, max_content_size=25_00_00)
 
+# Phase timings of every request, including the ones that fail
+app.add_middleware(TimingMiddleware)
+
+# Opt-in profiling of individual requests (added last such that it wraps everything)
+app.add_middleware(
+    ProfilingMiddleware,
+    profile_dir = PROFILE_DIR,
+    max_files = PROFILE_MAX_FILES,
+    sample_rate = PROFILE_SAMPLE_RATE,
+    admin_key = ADMIN_KEY,
+)
+
+
+# The newest job of each client. Starting a new job cancels the previous one
+jobs = SupersedeRegistry()
+
+# The spawner is started while the web process is still small and is restarted if
+# it ever exits
+spawner_process = SpawnerProcess(
+    socket_path = SPAWNER_SOCKET,
+    cpu_limit = SUBPROCESS_CPU_LIMIT,
+    memory_limit = SUBPROCESS_MEMORY_LIMIT,
+    default_timeout = SUBPROCESS_TIMEOUT,
+)
+
+
+# The version of the Gleam toolchain, see 'detect_toolchain_version'
+toolchain_version = TOOLCHAIN_VERSION
+
+
+@app.on_event('startup')
+async def startup_event() -> None:
+    global toolchain_version
+    if SPAWNER_ENABLED:
+        await spawner_process.start()
+    if not toolchain_version:
+        toolchain_version = await detect_toolchain_version()
+
+
+async def detect_toolchain_version() -> str:
+    """Ask the Gleam compiler for its version (e.g. 'gleam 0.16.1').
+
+    Returns:
+        str: The version. 'unknown' if it could not be determined.
+    """
+    with TemporaryDirectory() as td:
+        try:
+            stdout, _, rc = await run_subprocess(
+                ['gleam', '--version'], cwd = td, env = subprocess_env(td),
+            )
+        except Exception as e:
+            logging.debug(f'The Gleam toolchain version could not be determined: {e}')
+            return 'unknown'
+    version = ' '.join(_.strip() for _ in stdout if _.strip())
+    return version if rc == 0 and version else 'unknown'
+
+
+@app.on_event('shutdown')
+async def shutdown_event() -> None:
+    if SPAWNER_ENABLED:
+        await spawner_process.stop()
+
+
+def subprocess_env(td: str) -> Dict[str, str]:
+    """The explicit environment sandbox subprocesses are launched with.
+
+    Args:
+        td (str): The temporary directory of the request, used as home directory.
+
+    Returns:
+        Dict[str, str]: Environment variables.
+    """
+    env = {'HOME': td, 'PATH': os.environ.get('PATH', os.defpath)}
+    for key in ('LANG', 'LC_ALL'):
+        if key in os.environ:
+            env[key] = os.environ[key]
+    return env
+
 
 async def run_subprocess(
-    commandline_args: str,
+    argv: List[str],
     cwd: Union[None, str],
+    env: Dict[str, str],
     ) -> Tuple[List[str], List[str], int]:
-    """Run shell commands.
+    """Run a command by exec (without a shell), through the spawner process if enabled.
 
     Args:
-        commandline_args (str): Shell commands to be run.
+        argv (List[str]): The command to be run and its arguments.
         cwd (Union[None, str], optional): The current working directory. Defaults to
             None.
+        env (Dict[str, str]): The complete environment of the command.
 
     Returns:
         Tuple[List[str], List[str], int]: stdout, stderror and a return code
     """
+    commandline_args = ' '.join(argv)
     logging.debug('Subprocess commandline args: ' + commandline_args)
-    s = await asyncio.create_subprocess_shell(
-        commandline_args,
-        stdout = asyncio.subprocess.PIPE,
-        stderr = asyncio.subprocess.STDOUT,
-        cwd = cwd,
-    )
-    stdout_data, stderr_data = await s.communicate()
+    with time_subprocess(commandline_args) as record:
+        result = await spawn(
+            argv,
+            env = env,
+            cwd = cwd,
+            timeout = SUBPROCESS_TIMEOUT,
+            socket_path = SPAWNER_SOCKET if SPAWNER_ENABLED else None,
+        )
+        record['returncode'] = result['returncode']
+        # The spawner reports exact CPU times for each subprocess
+        for key in ('cpu_user', 'cpu_system'):
+            if key in result:
+                record[key] = result[key]
+    # NOTE: stderr is redirected to stdout
+    stdout_data = result['output']; stderr_data = None
     logging.debug('\nSubprocess stdout: ')
-    for string in stdout_data.decode('utf-8').split('\n'):
-        logging.debug(string)
-    logging.debug('\nSubprocess stderr: ')
-    for string in str(stderr_data).split('\n'):
+    for string in stdout_data.split('\n'):
         logging.debug(string)
     # Check the returncode to see whether the process terminated normally
-    if s.returncode == 0:
+    if result['returncode'] == 0:
         logging.debug(
-            'Subprocess exited normally with return code: ' + str(s.returncode)
+            'Subprocess exited normally with return code: ' + str(result['returncode'])
             )
-        return stdout_data.decode('utf-8').split('\n'), str(stderr_data).split('\n'), 0
+        return stdout_data.split('\n'), str(stderr_data).split('\n'), 0
     else:
         logging.debug(
-            'Subprocess exited with non-zero return code: ' + str(s.returncode)
+            'Subprocess exited with non-zero return code: ' + str(result['returncode'])
         )
-        return stdout_data.decode('utf-8').split('\n'), str(stderr_data).split('\n'), -1
+        return stdout_data.split('\n'), str(stderr_data).split('\n'), -1
 
 
 async def handle_output(
@@ -111,68 +218,72 @@ async def handle_output(
     return events
 
 
-@app.post('/run')
-async def run(
+async def _run(
     request: Request,
-    x_api_key: Optional[str] = Header(None),
-    ) -> JSONResponse:
-    """Compile and run a gleam code snippet.
+    result: Dict[str, Any],
+    timer: PhaseTimer,
+    ) -> Dict[str, Any]:
+    """Compile and run a parsed Gleam code snippet in a temporary project directory.
 
     Args:
-        request (Request): A request containing a Gleam code snippet that is
-            to be compilled and run.
-        x_api_key (Optional[str], optional): An API key provided by the frontend.
-            Defaults to Header(None).
+        request (Request): The '/run' request (its query parameters are used).
+        result (Dict[str, Any]): The parsed request body.
+        timer (PhaseTimer): The phase timings of the request.
 
     Raises:
         HTTPException: If the backend can not find the appropriate files that is to be
             compilled and run.
 
     Returns:
-        JSONResponse: The formatted code, stderr and stdout associated with the 
+        Dict[str, Any]: The formatted code, stderr and stdout associated with the
             execution of the Gleam code snippet.
     """
-    # Check if the given API is valid
-    check_api_key(x_api_key, API_KEY)
-    result = await request.json()
     events = []; formatted = None
     # Create a temporary directory for compiling and running a Gleam snippet
     with TemporaryDirectory() as td:
-        # Copy a default and pre-defined Gleam project to the temporary directory
-        shutil.copytree(
-            f'./{GLEAM_PROJECT_NAME}',
-            f'{td}/{GLEAM_PROJECT_NAME}',
-            copy_function = shutil.copy,
-        )
+        with timer.phase('setup'):
+            # Copy a default and pre-defined Gleam project to the temporary directory
+            shutil.copytree(
+                f'./{GLEAM_PROJECT_NAME}',
+                f'{td}/{GLEAM_PROJECT_NAME}',
+                copy_function = shutil.copy,
+            )
         # Check that everything was copied properly to the temporary directory
         if os.path.exists(f'{td}/{GLEAM_PROJECT_NAME}'):
             # Write the Gleam code snippet we would like to run to a file in the
             # default Gleam project  
-            with open(f'{td}/{GLEAM_PROJECT_FILE}', 'w') as f:
-                f.write(result['code'])
+            with timer.phase('setup'):
+                with open(f'{td}/{GLEAM_PROJECT_FILE}', 'w') as f:
+                    f.write(result['code'])
             # Compile the given Gleam code snippet
-            stdout, stderr, rc = await run_subprocess(
-                f'export HOME={td} && rebar3 escriptize',
-                cwd = f'{td}/{GLEAM_PROJECT_NAME}'
-            )
+            with timer.phase('compile'):
+                stdout, stderr, rc = await run_subprocess(
+                    ['rebar3', 'escriptize'],
+                    cwd = f'{td}/{GLEAM_PROJECT_NAME}',
+                    env = subprocess_env(td),
+                )
             # Save all events from stdout and stderr such that we can forward these to 
             # the user in the frontend
-            events_ = await handle_output(stdout, stderr)
-            events.extend(events_)
+            with timer.phase('output'):
+                events_ = await handle_output(stdout, stderr)
+                events.extend(events_)
             # If the Gleam project was compilled successfully then try to run the code
             if rc == 0:
-                stdout, stderr, rc = await run_subprocess(
-                    f'_build/default/bin/{GLEAM_PROJECT_NAME}',
-                    cwd = f'{td}/{GLEAM_PROJECT_NAME}',
-                )
+                with timer.phase('execute'):
+                    stdout, stderr, rc = await run_subprocess(
+                        [f'_build/default/bin/{GLEAM_PROJECT_NAME}'],
+                        cwd = f'{td}/{GLEAM_PROJECT_NAME}',
+                        env = subprocess_env(td),
+                    )
                 # Again, save all events from stdout and stderr such that we can forward
                 # these to the user in the frontend
-                events_ = await handle_output(stdout, stderr)
-                events.extend(events_)
+                with timer.phase('output'):
+                    events_ = await handle_output(stdout, stderr)
+                    events.extend(events_)
                 if "format" in request.query_params:
                     if str_to_bool_or_none(request.query_params["format"]) == True:
                         # Finally, format the gleam code
-                        events_, formatted = await _format(td = td)
+                        events_, formatted = await _format(td = td, timer = timer)
                         events.extend(events_) 
         # ... Else raise an exception and log the attempt
         else:
@@ -182,77 +293,161 @@ async def run(
                 status_code = 500,
                 detail = 'The Gleam code snippet could not be compilled by the backend',
             )
-    # Return formatted code and associated events (stdout and stderr)
+    # Return formatted code and associated events (stdout and stderr), and the
+    # toolchain that produced them
     if formatted is not None:
         response = {'events': events, 'formatted': formatted}
     else:
         response = {'events': events}
-    return JSONResponse(response, 200)
+    response['toolchain'] = toolchain_version
+    return response
+
+
+@app.post('/run')
+async def run(
+    request: Request,
+    x_api_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """Compile and run a gleam code snippet.
 
+    Args:
+        request (Request): A request containing a Gleam code snippet that is
+            to be compilled and run.
+        x_api_key (Optional[str], optional): An API key provided by the frontend.
+            Defaults to Header(None).
+
+    Raises:
+        HTTPException: If the backend can not find the appropriate files that is to be
+            compilled and run.
 
-async def _format(td: str) -> Tuple[Events, str]:
+    Returns:
+        JSONResponse: The formatted code, stderr and stdout associated with the 
+            execution of the Gleam code snippet. A 409 'superseded' response if the
+            same client (see 'client_key') sent a newer request in the meantime.
+    """
+    # Check if the given API is valid
+    check_api_key(x_api_key, API_KEY)
+    timer = request.state.timer
+    with timer.phase('parse'):
+        result = await request.json()
+    try:
+        response = await jobs.run(
+            client_key(request),
+            _run(request = request, result = result, timer = timer),
+        )
+    except Superseded:
+        return _superseded_response()
+    return _timed_response(request, response, timer)
+
+
+def client_key(request: Request) -> Union[None, str]:
+    """The key identifying the client (e.g. a browser tab) a request was sent from.
+
+    Args:
+        request (Request): The request.
+
+    Returns:
+        Union[None, str]: The 'X-Client-Key' header or the 'client_key' cookie. None if
+            the client did not provide a key.
+    """
+    key = request.headers.get('x-client-key') or request.cookies.get('client_key')
+    # Keys are only compared, but there is no reason to keep arbitrarily long ones
+    if key:
+        return key[:128]
+    return None
+
+
+def _superseded_response() -> JSONResponse:
+    # The client has already sent a newer request whose result replaces this one
+    return JSONResponse({'events': [], 'superseded': True}, 409)
+
+
+def _timed_response(
+    request: Request,
+    response: Dict[str, Any],
+    timer: PhaseTimer,
+    ) -> JSONResponse:
+    """Serialize a response, timed as a phase of the request.
+
+    Args:
+        request (Request): The request that is being responded to. The timings are
+            included in the response body if the 'timings' query parameter is true.
+        response (Dict[str, Any]): The response body.
+        timer (PhaseTimer): The phase timings of the request.
+
+    Returns:
+        JSONResponse: The response ('TimingMiddleware' adds the 'Server-Timing'
+            header).
+    """
+    if "timings" in request.query_params:
+        if str_to_bool_or_none(request.query_params["timings"]) == True:
+            # NOTE: The serialization phase itself is only part of the header
+            response['timings'] = timer.as_dict()
+    with timer.phase('serialize'):
+        json_response = JSONResponse(response, 200)
+    return json_response
+
+
+async def _format(td: str, timer: PhaseTimer) -> Tuple[Events, str]:
     """Run the 'gleam format' command in a shell in the directory that contains a given
     Gleam code snippet.
 
     Args:
         td (str): The temporary directory containing the Gleam code snippet that is to
             be formatted.
+        timer (PhaseTimer): The phase timings of the current request.
 
     Returns:
         Tuple[Events, str]: Stdout, stderror and the formatted code (if no errors were
             encountered).
     """
     events = []; formatted = None
-    stdout, stderr, _ = await run_subprocess(
-        f'gleam format',
-        cwd = f'{td}/{GLEAM_PROJECT_NAME}'
-    )
-    with open(f'{td}/{GLEAM_PROJECT_FILE}', 'r') as f:
-        formatted = f.read()
-    events_ = await handle_output(stdout, stderr)
-    events.extend(events_)
+    with timer.phase('format'):
+        stdout, stderr, _ = await run_subprocess(
+            ['gleam', 'format'],
+            cwd = f'{td}/{GLEAM_PROJECT_NAME}',
+            env = subprocess_env(td),
+        )
+        with open(f'{td}/{GLEAM_PROJECT_FILE}', 'r') as f:
+            formatted = f.read()
+    with timer.phase('output'):
+        events_ = await handle_output(stdout, stderr)
+        events.extend(events_)
     return events, formatted
 
 
-@app.post('/format')
-async def format(
-    request: Request,
-    x_api_key: Optional[str] = Header(None),
-    ) -> JSONResponse:
-    """Format a given Gleam code snippet and return the formatted code (if no errors were
-    encountered).
+async def _format_snippet(result: Dict[str, Any], timer: PhaseTimer) -> Dict[str, Any]:
+    """Format a parsed Gleam code snippet in a temporary project directory.
 
     Args:
-        request (Request): Request containing the Gleam code snippet to be formatted.
-        x_api_key (Optional[str], optional): An API key provided by the frontend.
-            Defaults to Header(None).
+        result (Dict[str, Any]): The parsed request body.
+        timer (PhaseTimer): The phase timings of the request.
 
     Raises:
         HTTPException: If the backend can not find the appropriate files that is to be
             formatted.
 
     Returns:
-        JSONResponse: Stdout, stderror and the formatted code (if no errors were
+        Dict[str, Any]: Stdout, stderror and the formatted code (if no errors were
             encountered).
     """
-    # Check if the given API is valid
-    check_api_key(x_api_key, API_KEY)
-    result = await request.json()
     events = []; formatted = None
     # Create a temporary directory for running 'gleam format' in a temporary
     # project directory
     with TemporaryDirectory() as td:
-        # Copy default project structure to temporary directory
-        shutil.copytree(
-            f'./{GLEAM_PROJECT_NAME}',
-            f'{td}/{GLEAM_PROJECT_NAME}',
-            copy_function = shutil.copy,
-        )   
+        with timer.phase('setup'):
+            # Copy default project structure to temporary directory
+            shutil.copytree(
+                f'./{GLEAM_PROJECT_NAME}',
+                f'{td}/{GLEAM_PROJECT_NAME}',
+                copy_function = shutil.copy,
+            )   
         # Check that everything was copied in properly
         if os.path.exists(f'{td}/{GLEAM_PROJECT_NAME}'):
-            with open(f'{td}/{GLEAM_PROJECT_FILE}', 'w') as f:
-                f.write(result['code'])
-            events_, formatted = await _format(td = td)
+            with timer.phase('setup'):
+                with open(f'{td}/{GLEAM_PROJECT_FILE}', 'w') as f:
+                    f.write(result['code'])
+            events_, formatted = await _format(td = td, timer = timer)
             events.extend(events_) 
         # ... Else raise an exception and log the attempt
         else:
@@ -264,4 +459,109 @@ async def format(
             )
     # Return formatted code and associated events (stdout and stderr)
     response = {'formatted': formatted, 'events': events}
-    return JSONResponse(response, 200)
\ No newline at end of file
+    return response
+
+
+@app.post('/format')
+async def format(
+    request: Request,
+    x_api_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """Format a given Gleam code snippet and return the formatted code (if no errors were
+    encountered).
+
+    Args:
+        request (Request): Request containing the Gleam code snippet to be formatted.
+        x_api_key (Optional[str], optional): An API key provided by the frontend.
+            Defaults to Header(None).
+
+    Raises:
+        HTTPException: If the backend can not find the appropriate files that is to be
+            formatted.
+
+    Returns:
+        JSONResponse: Stdout, stderror and the formatted code (if no errors were
+            encountered). A 409 'superseded' response if the same client (see
+            'client_key') sent a newer request in the meantime.
+    """
+    # Check if the given API is valid
+    check_api_key(x_api_key, API_KEY)
+    timer = request.state.timer
+    with timer.phase('parse'):
+        result = await request.json()
+    try:
+        response = await jobs.run(
+            client_key(request),
+            _format_snippet(result = result, timer = timer),
+        )
+    except Superseded:
+        return _superseded_response()
+    return _timed_response(request, response, timer)
+
+
+@app.get('/version')
+async def version() -> JSONResponse:
+    """Retrieve the version of the Gleam toolchain that runs and formats code.
+
+    Returns:
+        JSONResponse: The toolchain version.
+    """
+    return JSONResponse({'toolchain': toolchain_version}, 200)
+
+
+@app.get('/metrics')
+async def metrics() -> Response:
+    """Expose Prometheus metrics (e.g. the per-phase latency histograms).
+
+    Returns:
+        Response: The metrics in the Prometheus text format.
+    """
+    return Response(generate_latest(), 200, media_type = CONTENT_TYPE_LATEST)
+
+
+@app.get('/admin/profiles')
+async def get_profiles(
+    x_admin_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """List the stored request profiles, newest first.
+
+    Args:
+        x_admin_key (Optional[str], optional): The admin key. Defaults to Header(None).
+
+    Returns:
+        JSONResponse: Metadata (wall time, subprocess timings, ...) of each profile.
+    """
+    check_admin_key(x_admin_key, ADMIN_KEY)
+    return JSONResponse({'profiles': list_profiles(PROFILE_DIR)}, 200)
+
+
+@app.get('/admin/profiles/{profile_id}')
+async def get_profile(
+    profile_id: str,
+    raw: bool = False,
+    x_admin_key: Optional[str] = Header(None),
+    ) -> Response:
+    """Retrieve a single stored request profile.
+
+    Args:
+        profile_id (str): The identifier of the profile.
+        raw (bool, optional): Return the raw pstats data instead of a text summary.
+            Defaults to False.
+        x_admin_key (Optional[str], optional): The admin key. Defaults to Header(None).
+
+    Raises:
+        HTTPException: If the requested profile was not found.
+
+    Returns:
+        Response: The profile metadata with a text summary, or the raw pstats data.
+    """
+    check_admin_key(x_admin_key, ADMIN_KEY)
+    if raw:
+        stats = read_profile_stats(PROFILE_DIR, profile_id)
+        if stats is None:
+            raise HTTPException(status_code = 404, detail = 'Profile not found')
+        return Response(stats, 200, media_type = 'application/octet-stream')
+    profile = read_profile(PROFILE_DIR, profile_id)
+    if profile is None:
+        raise HTTPException(status_code = 404, detail = 'Profile not found')
+    return JSONResponse(profile, 200)
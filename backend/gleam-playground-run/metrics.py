@@ -0,0 +1,20 @@
+from prometheus_client import Counter, Histogram
+
+
+# Per-phase latency of the '/run' and '/format' endpoints. The buckets span quick
+# phases (request parsing, serialization) as well as slow ones (compilation)
+PHASE_SECONDS = Histogram(
+    'gleam_playground_run_phase_seconds',
+    'Time spent in each phase of handling a request.',
+    ['endpoint', 'phase'],
+    buckets = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 20.0,
+    ),
+)
+
+# Jobs that were cancelled because the same client started a newer one
+SUPERSEDED_TOTAL = Counter(
+    'gleam_playground_run_superseded_total',
+    'Jobs cancelled in favour of a newer job from the same client.',
+)
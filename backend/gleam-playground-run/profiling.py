@@ -0,0 +1,269 @@
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import resource
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+from common.common import str_to_bool_or_none
+
+
+# Profile identifiers are generated by this module. Anything else that is passed to
+# the admin endpoints is rejected such that no files outside the profile directory
+# can be read
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]+-[0-9a-f]{8}$')
+
+# The profile of the request that is currently being handled (if any)
+_current_profile: ContextVar[Optional['RequestProfile']] = ContextVar(
+    'current_profile', default = None,
+)
+# cProfile can only be attached once per interpreter, so only a single request is
+# profiled at any given time
+_profiling_active = False
+
+
+class RequestProfile:
+    """Python profile and subprocess timings collected while handling a request.
+
+    Args:
+        path (str): The path of the profiled request.
+        reason (str): Why the request was profiled ('header' or 'sampled').
+    """
+
+    def __init__(self, path: str, reason: str) -> None:
+        self.id = f'{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}'
+        self.path = path
+        self.reason = reason
+        self.started = time.time()
+        self.wall = None
+        self.status_code = None
+        self.subprocesses: List[Dict[str, Any]] = []
+        self.profiler = cProfile.Profile()
+
+    def metadata(self) -> Dict[str, Any]:
+        subprocess_wall = sum(_['wall'] for _ in self.subprocesses)
+        return {
+            'id': self.id,
+            'path': self.path,
+            'reason': self.reason,
+            'started': self.started,
+            'wall': self.wall,
+            'status_code': self.status_code,
+            'subprocess_wall': subprocess_wall,
+            'subprocesses': self.subprocesses,
+        }
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current_profile.get()
+
+
+@contextmanager
+def time_subprocess(commandline_args: str) -> Iterator[Dict[str, Any]]:
+    """Measure wall and CPU time of a subprocess if the current request is profiled.
+
+    The caller is expected to set the 'returncode' of the yielded record.
+
+    Args:
+        commandline_args (str): The commandline arguments of the subprocess.
+
+    Yields:
+        Iterator[Dict[str, Any]]: A record describing the subprocess.
+    """
+    record = {'args': commandline_args, 'returncode': None}
+    profile = _current_profile.get()
+    if profile is None:
+        yield record
+        return
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - started
+        # Only set the CPU times if they were not already reported by the caller.
+        # NOTE: RUSAGE_CHILDREN covers every child reaped by this process in the
+        # meantime, so subprocesses of concurrent requests may inflate the numbers
+        usage_ = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record.setdefault('cpu_user', usage_.ru_utime - usage.ru_utime)
+        record.setdefault('cpu_system', usage_.ru_stime - usage.ru_stime)
+        profile.subprocesses.append(record)
+
+
+def save_profile(profile: RequestProfile, profile_dir: str, max_files: int) -> None:
+    """Write a profile to disk and remove the oldest profiles above the limit.
+
+    Args:
+        profile (RequestProfile): The profile to save.
+        profile_dir (str): The directory profiles are stored in.
+        max_files (int): The maximum number of profiles to keep.
+    """
+    os.makedirs(profile_dir, exist_ok = True)
+    profile.profiler.dump_stats(os.path.join(profile_dir, f'{profile.id}.prof'))
+    with open(os.path.join(profile_dir, f'{profile.id}.json'), 'w') as f:
+        f.write(json.dumps(profile.metadata()))
+    # Profile identifiers start with a timestamp, so sorting them orders them by age
+    profile_ids = sorted(_list_profile_ids(profile_dir))
+    for profile_id in profile_ids[:max(len(profile_ids) - max_files, 0)]:
+        for extension in ('json', 'prof'):
+            try:
+                os.remove(os.path.join(profile_dir, f'{profile_id}.{extension}'))
+            except FileNotFoundError:
+                pass
+
+
+def _list_profile_ids(profile_dir: str) -> List[str]:
+    try:
+        filenames = os.listdir(profile_dir)
+    except FileNotFoundError:
+        return []
+    return [
+        f[:-len('.json')] for f in filenames
+        if f.endswith('.json') and PROFILE_ID_PATTERN.match(f[:-len('.json')])
+    ]
+
+
+def list_profiles(profile_dir: str) -> List[Dict[str, Any]]:
+    """List the metadata of all stored profiles, newest first.
+
+    Args:
+        profile_dir (str): The directory profiles are stored in.
+
+    Returns:
+        List[Dict[str, Any]]: Metadata of the stored profiles.
+    """
+    profiles = []
+    for profile_id in sorted(_list_profile_ids(profile_dir), reverse = True):
+        try:
+            with open(os.path.join(profile_dir, f'{profile_id}.json')) as f:
+                profiles.append(json.loads(f.read()))
+        except (FileNotFoundError, ValueError):
+            # The profile was removed or is being written concurrently
+            continue
+    return profiles
+
+
+def read_profile(
+    profile_dir: str,
+    profile_id: str,
+    limit: int = 40,
+    ) -> Union[None, Dict[str, Any]]:
+    """Read a stored profile together with a text summary of its Python profile.
+
+    Args:
+        profile_dir (str): The directory profiles are stored in.
+        profile_id (str): The identifier of the profile.
+        limit (int, optional): The number of functions in the summary. Defaults to 40.
+
+    Returns:
+        Union[None, Dict[str, Any]]: The profile metadata and summary. None if the
+            profile does not exist.
+    """
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(profile_dir, f'{profile_id}.json')) as f:
+            metadata = json.loads(f.read())
+        stream = io.StringIO()
+        stats = pstats.Stats(os.path.join(profile_dir, f'{profile_id}.prof'), stream = stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+    except FileNotFoundError:
+        return None
+    metadata['summary'] = stream.getvalue()
+    return metadata
+
+
+def read_profile_stats(profile_dir: str, profile_id: str) -> Union[None, bytes]:
+    """Read the raw pstats data of a stored profile (e.g. for snakeviz)."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(profile_dir, f'{profile_id}.prof'), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class ProfilingMiddleware:
+    """Profile individual requests and store the results in a bounded directory.
+
+    Args:
+      app (ASGI application): ASGI application
+      profile_dir: the directory profiles are stored in
+      max_files: the maximum number of stored profiles
+      sample_rate: the fraction of requests to profile, 0 to only profile on demand
+      admin_key: the key required to request profiling through the 'X-Profile' header
+      paths: the request paths that can be profiled
+    """
+
+    def __init__(
+        self,
+        app,
+        profile_dir: str,
+        max_files: int = 50,
+        sample_rate: float = 0.0,
+        admin_key: Optional[str] = None,
+        paths: Sequence[str] = ('/run', '/format'),
+    ):
+        self.app = app
+        self.profile_dir = profile_dir
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.admin_key = admin_key
+        self.paths = paths
+
+    def profile_reason(self, scope) -> Union[None, str]:
+        headers = dict(scope.get('headers', []))
+        x_profile = headers.get(b'x-profile', b'').decode('latin-1')
+        if self.admin_key and str_to_bool_or_none(x_profile) == True:
+            # Compared as bytes, 'compare_digest' rejects strings with non-ASCII characters
+            x_admin_key = headers.get(b'x-admin-key', b'')
+            if hmac.compare_digest(x_admin_key, self.admin_key.encode('utf-8')):
+                return 'header'
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sampled'
+        return None
+
+    async def __call__(self, scope, receive, send):
+        global _profiling_active
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        reason = self.profile_reason(scope)
+        if reason is None or _profiling_active:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(path = scope["path"], reason = reason)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+            await send(message)
+
+        _profiling_active = True
+        token = _current_profile.set(profile)
+        started = time.perf_counter()
+        # NOTE: The profiler sees every coroutine that runs on the event loop while
+        # it is enabled, not only the ones belonging to this request
+        profile.profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.profiler.disable()
+            profile.wall = time.perf_counter() - started
+            _current_profile.reset(token)
+            _profiling_active = False
+            try:
+                save_profile(profile, self.profile_dir, self.max_files)
+                logging.debug(f'Saved request profile: {profile.id}')
+            except OSError as e:
+                logging.debug(f'A request profile could not be saved: {e}')
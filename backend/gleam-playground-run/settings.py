@@ -1,5 +1,6 @@
+import os
 import re
-from common.common import get_secret
+from common.common import get_secret, str_to_bool_or_none
 
 # 7-bit C1 ANSI sequences (used for removing rebar3 terminal colors and styling)
 ansi_escape = re.compile(r'''
@@ -17,4 +18,28 @@ ansi_escape = re.compile(r'''
 
 API_KEY = get_secret("API_KEY")
 GLEAM_PROJECT_NAME = 'gleam_project'
-GLEAM_PROJECT_FILE = f'{GLEAM_PROJECT_NAME}/src/{GLEAM_PROJECT_NAME}.gleam'
\ No newline at end of file
+GLEAM_PROJECT_FILE = f'{GLEAM_PROJECT_NAME}/src/{GLEAM_PROJECT_NAME}.gleam'
+
+
+# Admin endpoints are disabled unless an admin key is available as a secret
+ADMIN_KEY = get_secret("ADMIN_KEY", default = "")
+
+# Opt-in profiling of '/run' and '/format' requests. A request is profiled when it
+# carries the 'X-Profile' header together with a valid 'X-Admin-Key' header, or when
+# it is picked by random sampling (a rate of 0 disables sampling)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/gleam-playground-profiles")
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+
+# Sandbox subprocesses are launched by a dedicated spawner process listening on a
+# Unix socket. If it is disabled they are launched directly by the web process
+SPAWNER_ENABLED = str_to_bool_or_none(os.environ.get("SPAWNER_ENABLED", "true"))
+SPAWNER_SOCKET = os.environ.get("SPAWNER_SOCKET", "/tmp/gleam-playground-spawner.sock")
+# Limits applied to every sandbox subprocess (0 disables a limit)
+SUBPROCESS_TIMEOUT = float(os.environ.get("SUBPROCESS_TIMEOUT", "15"))
+SUBPROCESS_CPU_LIMIT = int(os.environ.get("SUBPROCESS_CPU_LIMIT", "15"))
+SUBPROCESS_MEMORY_LIMIT = int(os.environ.get("SUBPROCESS_MEMORY_LIMIT", "0"))
+
+# Version of the Gleam toolchain that run outputs are tagged with (the Docker image
+# sets GLEAM_VERSION). Determined with 'gleam --version' on startup otherwise
+TOOLCHAIN_VERSION = os.environ.get("TOOLCHAIN_VERSION", os.environ.get("GLEAM_VERSION", ""))
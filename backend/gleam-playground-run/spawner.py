@@ -0,0 +1,412 @@
+"""
+Small and long-lived helper process that launches the sandbox subprocesses of the
+run service.
+
+The web process hands every command over a Unix socket to this process, which
+starts it by exec with an explicit argv and environment (no intermediate shell),
+applies resource limits and streams the output and exit status back. Forking the
+spawner stays cheap however large the web process grows, and the lifecycle of all
+sandbox processes (timeouts, killing, reaping) is handled in a single place.
+
+Protocol: The client sends a single JSON line
+    {"argv": [...], "env": {...}, "cwd": "...", "timeout": 15.0}
+and receives JSON lines
+    {"output": "..."}   (any number of times)
+    {"returncode": 0, "wall": ..., "cpu_user": ..., "cpu_system": ..., "timed_out": false}
+Closing the connection early kills the subprocess.
+"""
+import argparse
+import asyncio
+import codecs
+import json
+import logging
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# Size of the chunks the output of a subprocess is read and forwarded in
+CHUNK_SIZE = 64 * 1024
+
+
+def _apply_limits(pid: int, cpu_limit: int, memory_limit: int) -> None:
+    # NOTE: The limits are applied right after the process was started, so the
+    # first few instructions of the child run unrestricted. Avoiding 'preexec_fn'
+    # keeps process creation on the fast (vfork) path
+    try:
+        if cpu_limit > 0:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+        if memory_limit > 0:
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except (ProcessLookupError, PermissionError):
+        # The process already exited
+        pass
+
+
+def _kill(pid: int) -> None:
+    # Every subprocess runs in its own session, so this also kills its children
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _wait(pid: int) -> Tuple[int, Any]:
+    """Wait for a process to exit without blocking the event loop.
+
+    Args:
+        pid (int): The process identifier.
+
+    Returns:
+        Tuple[int, Any]: The return code and the resource usage of the process.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is not None:
+        # The pidfd becomes readable once the process has exited
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        _, status, rusage = os.wait4(pid, 0)
+        return os.waitstatus_to_exitcode(status), rusage
+    while True:
+        wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if wpid == pid:
+            return os.waitstatus_to_exitcode(status), rusage
+        await asyncio.sleep(0.005)
+
+
+async def _write(writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+    writer.write(json.dumps(message).encode('utf-8') + b'\n')
+    await writer.drain()
+
+
+class Spawner:
+    """Serve requests to launch sandbox subprocesses on a Unix socket.
+
+    Args:
+        cpu_limit (int): Maximum CPU seconds per subprocess, 0 for no limit.
+        memory_limit (int): Maximum address space in bytes per subprocess, 0 for
+            no limit.
+        default_timeout (float): Wall time limit used if a request does not set one.
+    """
+
+    def __init__(self, cpu_limit: int, memory_limit: int, default_timeout: float) -> None:
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.default_timeout = default_timeout
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            await self.run(request, reader, writer)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logging.debug(f'Spawner: Invalid request or failed launch: {e}')
+            try:
+                await _write(writer, {'error': str(e), 'returncode': -1})
+            except ConnectionError:
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(
+        self,
+        request: Dict[str, Any],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        ) -> None:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [str(_) for _ in request['argv']],
+            env = {str(k): str(v) for k, v in request.get('env', {}).items()},
+            cwd = request.get('cwd'),
+            stdin = subprocess.DEVNULL,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT,
+            start_new_session = True,
+        )
+        _apply_limits(process.pid, self.cpu_limit, self.memory_limit)
+        output = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(output), process.stdout,
+        )
+        exited = asyncio.ensure_future(_wait(process.pid))
+        # The client closing the connection means the result is no longer needed
+        client_gone = asyncio.ensure_future(reader.read())
+        timed_out = False
+        try:
+            async def forward() -> None:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+                while True:
+                    chunk = await output.read(CHUNK_SIZE)
+                    text = decoder.decode(chunk, final = not chunk)
+                    if text:
+                        await _write(writer, {'output': text})
+                    if not chunk:
+                        break
+            forwarding = asyncio.ensure_future(forward())
+            done, _ = await asyncio.wait(
+                [forwarding, client_gone],
+                timeout = request.get('timeout') or self.default_timeout,
+                return_when = asyncio.FIRST_COMPLETED,
+            )
+            if client_gone in done:
+                logging.debug(f'Spawner: Client went away, killing process {process.pid}')
+                forwarding.cancel()
+                return
+            if not done:
+                timed_out = True
+                forwarding.cancel()
+                _kill(process.pid)
+                await _write(writer, {'output': '\nProcess killed: time limit exceeded\n'})
+            returncode, rusage = await exited
+            # The process was reaped above, make sure Popen does not try to again
+            process.returncode = returncode
+            await _write(writer, {
+                'returncode': returncode,
+                'wall': time.perf_counter() - started,
+                'cpu_user': rusage.ru_utime,
+                'cpu_system': rusage.ru_stime,
+                'max_rss': rusage.ru_maxrss,
+                'timed_out': timed_out,
+            })
+        finally:
+            # Makes sure that nothing outlives the request, including grandchildren
+            _kill(process.pid)
+            if not exited.done():
+                returncode, _ = await exited
+                process.returncode = returncode
+            client_gone.cancel()
+            process.stdout.close()
+
+    async def serve(self, socket_path: str) -> None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.handle, path = socket_path)
+        os.chmod(socket_path, 0o600)
+        logging.debug(f'Spawner: Listening on {socket_path}')
+        async with server:
+            await server.serve_forever()
+
+
+async def spawn(
+    argv: List[str],
+    env: Dict[str, str],
+    cwd: Optional[str],
+    timeout: float,
+    socket_path: Optional[str] = None,
+    ) -> Dict[str, Any]:
+    """Run a command by exec, through the spawner process if a socket is given.
+
+    Args:
+        argv (List[str]): The command and its arguments.
+        env (Dict[str, str]): The complete environment of the command.
+        cwd (Optional[str]): The working directory of the command.
+        timeout (float): Wall time limit in seconds.
+        socket_path (Optional[str], optional): The Unix socket of the spawner
+            process. Defaults to None, in which case the command is launched
+            directly from the calling process.
+
+    Returns:
+        Dict[str, Any]: The combined stdout/stderr 'output', the 'returncode' and,
+            if available, the 'wall', 'cpu_user' and 'cpu_system' times. A command
+            that could not be launched has return code -1 and the error as output.
+    """
+    if socket_path is None:
+        return await _spawn_locally(argv, env, cwd, timeout)
+    try:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError) as e:
+        # E.g. while the spawner is being restarted
+        logging.debug(f'Spawner: Not available, launching directly: {e}')
+        return await _spawn_locally(argv, env, cwd, timeout)
+    try:
+        request = {'argv': argv, 'env': env, 'cwd': cwd, 'timeout': timeout}
+        writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        await writer.drain()
+        output = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                # The spawner went down while the command was running
+                output.append('\nProcess killed: the spawner exited unexpectedly\n')
+                return {'output': ''.join(output), 'returncode': -1, 'timed_out': False}
+            message = json.loads(line)
+            if 'output' in message:
+                output.append(message['output'])
+            if 'error' in message:
+                # The command could not be launched (e.g. its binary is missing)
+                output.append(message.pop('error'))
+            if 'returncode' in message:
+                message['output'] = ''.join(output)
+                return message
+    finally:
+        # Closing the connection (also when cancelled) kills the subprocess
+        writer.close()
+
+
+async def _spawn_locally(
+    argv: List[str],
+    env: Dict[str, str],
+    cwd: Optional[str],
+    timeout: float,
+    ) -> Dict[str, Any]:
+    started = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            env = env,
+            cwd = cwd,
+            stdin = asyncio.subprocess.DEVNULL,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.STDOUT,
+            start_new_session = True,
+        )
+    except OSError as e:
+        # As reported by the spawner
+        return {
+            'output': str(e),
+            'returncode': -1,
+            'wall': time.perf_counter() - started,
+            'timed_out': False,
+        }
+    timed_out = False
+    # Kept as it is read, such that the output up to a timeout is returned as well
+    # (like the spawner forwards it)
+    chunks = []
+
+    async def read_output() -> None:
+        while True:
+            chunk = await process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        await process.wait()
+
+    try:
+        await asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        _kill(process.pid)
+        chunks.append(b'\nProcess killed: time limit exceeded\n')
+        await process.wait()
+    finally:
+        if process.returncode is None:
+            _kill(process.pid)
+    return {
+        'output': b''.join(chunks).decode('utf-8', errors = 'replace'),
+        'returncode': process.returncode,
+        'wall': time.perf_counter() - started,
+        'timed_out': timed_out,
+    }
+
+
+class SpawnerProcess:
+    """Start the spawner as a child of the web process and restart it if it dies.
+
+    Args:
+        socket_path (str): The Unix socket the spawner listens on.
+        cpu_limit (int): Maximum CPU seconds per subprocess.
+        memory_limit (int): Maximum address space in bytes per subprocess.
+        default_timeout (float): Default wall time limit per subprocess.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        cpu_limit: int,
+        memory_limit: int,
+        default_timeout: float,
+    ) -> None:
+        self.socket_path = socket_path
+        self.args = [
+            sys.executable, os.path.abspath(__file__),
+            '--socket', socket_path,
+            '--cpu_limit', str(cpu_limit),
+            '--memory_limit', str(memory_limit),
+            '--timeout', str(default_timeout),
+        ]
+        self.process = None
+        self.supervisor = None
+
+    async def start(self) -> None:
+        # A socket left behind by a previous spawner must not be mistaken for a
+        # spawner that is ready to accept connections
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.supervisor = asyncio.ensure_future(self._supervise())
+        # Wait until the spawner accepts connections
+        for _ in range(200):
+            if os.path.exists(self.socket_path):
+                return
+            await asyncio.sleep(0.025)
+        logging.debug('Spawner: The spawner did not come up in time')
+
+    async def _supervise(self) -> None:
+        while True:
+            self.process = await asyncio.create_subprocess_exec(*self.args)
+            returncode = await self.process.wait()
+            logging.debug(f'Spawner: Exited with return code {returncode}, restarting')
+            await asyncio.sleep(0.5)
+
+    async def stop(self) -> None:
+        if self.supervisor is not None:
+            self.supervisor.cancel()
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+
+def parse_commandline_args(args_list = None):
+    """ Setup, parse and validate given commandline arguments.
+    """
+    parser = argparse.ArgumentParser(description = "Sandbox subprocess spawner")
+    parser.add_argument("-socket", "--socket",
+        required = True,
+        type = str,
+        help = "Specify the Unix socket to listen on.",
+    )
+    parser.add_argument("-cpu_limit", "--cpu_limit",
+        required = False,
+        default = 0,
+        type = int,
+        help = "Specify the maximum CPU seconds per subprocess (0 for no limit).",
+    )
+    parser.add_argument("-memory_limit", "--memory_limit",
+        required = False,
+        default = 0,
+        type = int,
+        help = "Specify the maximum address space in bytes per subprocess (0 for no limit).",
+    )
+    parser.add_argument("-timeout", "--timeout",
+        required = False,
+        default = 15.0,
+        type = float,
+        help = "Specify the default wall time limit in seconds per subprocess.",
+    )
+    return parser.parse_args(args_list)
+
+
+if __name__ == "__main__":
+    args = parse_commandline_args()
+    logging.basicConfig(level = logging.DEBUG)
+    spawner = Spawner(
+        cpu_limit = args.cpu_limit,
+        memory_limit = args.memory_limit,
+        default_timeout = args.timeout,
+    )
+    asyncio.run(spawner.serve(args.socket))
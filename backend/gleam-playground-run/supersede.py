@@ -0,0 +1,55 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Optional, Set
+from metrics import SUPERSEDED_TOTAL
+
+
+class Superseded(Exception):
+    pass
+
+
+class SupersedeRegistry:
+    """Keep track of the newest job of each client and cancel older ones.
+
+    Users tend to press 'Run' (or trigger format-on-run) repeatedly while editing,
+    but only the result of their newest request matters. Cancelling an older job
+    kills its subprocesses and removes its temporary directory right away, which
+    frees the sandbox for the new job.
+    """
+
+    def __init__(self) -> None:
+        self.jobs: Dict[str, asyncio.Task] = {}
+        self.superseded: Set[asyncio.Task] = set()
+
+    async def run(self, key: Optional[str], job: Awaitable[Any]) -> Any:
+        """Run a job on behalf of a client, cancelling the client's previous job.
+
+        Args:
+            key (Optional[str]): The key identifying the client. Jobs without a key
+                are neither cancelled nor cancel other jobs.
+            job (Awaitable[Any]): The job to run.
+
+        Raises:
+            Superseded: If a newer job of the same client cancelled this one.
+
+        Returns:
+            Any: The result of the job.
+        """
+        if key is None:
+            return await job
+        task = asyncio.ensure_future(job)
+        previous = self.jobs.get(key)
+        self.jobs[key] = task
+        if previous is not None and not previous.done():
+            self.superseded.add(previous)
+            previous.cancel()
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task in self.superseded:
+                SUPERSEDED_TOTAL.inc()
+                raise Superseded()
+            raise
+        finally:
+            self.superseded.discard(task)
+            if self.jobs.get(key) is task:
+                del self.jobs[key]
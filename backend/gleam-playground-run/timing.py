@@ -0,0 +1,81 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Sequence
+from starlette.datastructures import MutableHeaders
+from metrics import PHASE_SECONDS
+
+
+class PhaseTimer:
+    """Measure the time spent in each phase of handling a request.
+
+    Phases that are entered more than once (e.g. output processing after both
+    compiling and running a snippet) accumulate their time.
+
+    Args:
+        endpoint (str): The name of the endpoint, used as a metric label.
+    """
+
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def observe(self) -> None:
+        """Feed the accumulated phase timings to the per-phase histograms."""
+        for name, elapsed in self.timings.items():
+            PHASE_SECONDS.labels(endpoint = self.endpoint, phase = name).observe(elapsed)
+
+    def as_dict(self) -> Dict[str, float]:
+        """Return the phase timings in milliseconds."""
+        return {name: round(1000 * _, 3) for name, _ in self.timings.items()}
+
+    def server_timing(self) -> str:
+        """Return the phase timings formatted as a 'Server-Timing' header value."""
+        return ', '.join(
+            f'{name};dur={duration}' for name, duration in self.as_dict().items()
+        )
+
+
+class TimingMiddleware:
+    """Time the phases of requests whatever their outcome, including errors.
+
+    Each request gets a 'PhaseTimer' (as 'request.state.timer') for its endpoint to
+    record phases with. The timings are sent in the 'Server-Timing' header of the
+    response, and fed to the histograms once the request is done, also if it failed.
+    Unhandled exceptions are answered outside all middleware, so their timings only
+    reach the histograms.
+
+    Args:
+      app (ASGI application): ASGI application
+      paths: the request paths that are timed, labelled without the leading '/'
+    """
+
+    def __init__(self, app, paths: Sequence[str] = ('/run', '/format')):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        timer = PhaseTimer(endpoint = scope["path"].lstrip("/"))
+        scope.setdefault("state", {})["timer"] = timer
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope = message).append("Server-Timing", timer.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            timer.observe()
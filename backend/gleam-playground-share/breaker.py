@@ -0,0 +1,87 @@
+import logging
+import random
+import time
+from metrics import BREAKER_STATE
+
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+# Values of the breaker state metric
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """Stop calling a dependency after repeated failures and re-admit it gradually.
+
+    The breaker opens after 'failure_threshold' consecutive failures. Once it has been
+    open for 'reset_timeout' seconds (and a health check succeeded) it is half-open:
+    only a share of the calls is let through, which grows with every success until
+    the breaker closes again. Any failure while half-open opens it again.
+
+    Args:
+        name (str): The name of the dependency (used for logging).
+        failure_threshold (int): Consecutive failures after which the breaker opens.
+        reset_timeout (float): Seconds the breaker stays open at least.
+        recovery_calls (int): Successful calls while half-open until the breaker
+            closes again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        recovery_calls: int,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.recovery_calls = recovery_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.successes = 0
+        self.opened_at = 0.0
+        BREAKER_STATE.labels(dependency = name).set(STATE_VALUES[CLOSED])
+
+    def allow(self) -> bool:
+        """Whether a call should be attempted."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return False
+        # Let through a growing share of the calls while half-open
+        admitted = (self.successes + 1) / (self.recovery_calls + 1)
+        return random.random() < admitted
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self.state == HALF_OPEN:
+            self.successes += 1
+            if self.successes >= self.recovery_calls:
+                self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.failures >= self.failure_threshold
+        ):
+            self._transition(OPEN)
+
+    def can_probe(self) -> bool:
+        # Whether the breaker has been open long enough to probe the dependency
+        return self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def half_open(self) -> None:
+        if self.state == OPEN:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state: str) -> None:
+        logging.debug(f'BREAKER: {self.name} changed from {self.state} to {state}')
+        self.state = state
+        BREAKER_STATE.labels(dependency = self.name).set(STATE_VALUES[state])
+        self.successes = 0
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        else:
+            self.failures = 0
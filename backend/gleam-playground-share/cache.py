@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple
+from settings import L1_CACHE_MAX_BYTES, L1_CACHE_TTL, RUN_CACHE_MAX_BYTES, BODY_CACHE_MAX_BYTES
+
+
+class LRUCache:
+    """A bounded in-process LRU cache with size-based eviction and per-entry TTLs.
+
+    It is used as the first cache tier in front of Redis. Snippets never change
+    once they are created, so entries are never invalidated, only evicted or
+    expired.
+
+    Args:
+        max_bytes (int): The maximum total size of all entries.
+        ttl (float): The default time to live of an entry in seconds.
+        sizeof (Callable[[Any], int], optional): Returns the size of a value.
+            Defaults to len.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        sizeof: Callable[[Any], int] = len,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        # key -> (value, size, expiry time)
+        self._entries: 'OrderedDict[str, Tuple[Any, int, float]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, size, expires = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Cache a value, evicting the least recently used entries if necessary.
+
+        Args:
+            key (str): The key of the value.
+            value (Any): The value.
+            ttl (Optional[float], optional): The time to live of the entry in
+                seconds. Defaults to the TTL of the cache.
+
+        Returns:
+            bool: False if the value is too large to be cached at all.
+        """
+        size = self.sizeof(value)
+        # A single huge entry would otherwise flush the entire cache
+        if size > self.max_bytes // 4:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (value, size, expires)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        return True
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+# Snippet identifier -> code
+snippet_cache = LRUCache(max_bytes = L1_CACHE_MAX_BYTES, ttl = L1_CACHE_TTL)
+# Snippet identifier -> run output (JSON), set together with the code
+run_cache = LRUCache(max_bytes = RUN_CACHE_MAX_BYTES, ttl = L1_CACHE_TTL)
+# Snippet identifier -> final response body ('httpcache.RenderedSnippet')
+body_cache = LRUCache(
+    max_bytes = BODY_CACHE_MAX_BYTES, ttl = L1_CACHE_TTL, sizeof = lambda _: _.size,
+)
@@ -0,0 +1,75 @@
+import zlib
+from typing import Optional, Tuple, Union
+from settings import COMPRESSION_THRESHOLD, COMPRESSION_LEVEL
+
+
+# The first byte of a compressed value tells how it is encoded, such that other
+# encodings (e.g. zstd) can be added later on without breaking existing values
+ZLIB = b'\x01'
+
+
+def compress(data: bytes) -> bytes:
+    """Compress data if it is large enough and compression actually pays off.
+
+    Args:
+        data (bytes): The data to compress.
+
+    Returns:
+        bytes: The compressed data prefixed with a format marker, or the data as is.
+    """
+    if len(data) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+        if len(compressed) + 1 < len(data):
+            return ZLIB + compressed
+    return data
+
+
+def decompress(data: bytes) -> bytes:
+    if data[:1] == ZLIB:
+        return zlib.decompress(data[1:])
+    return data
+
+
+def encode_column(code: str) -> Tuple[Optional[str], Optional[bytes]]:
+    """Encode the code of a snippet for the 'code' and 'codeBlob' columns.
+
+    Args:
+        code (str): The code of a snippet.
+
+    Returns:
+        Tuple[Optional[str], Optional[bytes]]: The code as text if it is small, or the
+            compressed code if it is large.
+    """
+    data = code.encode('utf-8')
+    compressed = compress(data)
+    if compressed is data:
+        return code, None
+    return None, compressed
+
+
+def decode_column(code: Optional[str], code_blob: Optional[bytes]) -> str:
+    # Rows stored before compression was introduced only have the 'code' column
+    if code_blob is not None:
+        return decompress(code_blob).decode('utf-8')
+    return code
+
+
+def encode_cache_value(value: str) -> bytes:
+    """Encode a JSON document for Redis, compressing it if it is large.
+
+    Uncompressed values are plain JSON, which starts with a printable character, so
+    values cached before compression was introduced remain readable.
+
+    Args:
+        value (str): A JSON document.
+
+    Returns:
+        bytes: The encoded value.
+    """
+    return compress(value.encode('utf-8'))
+
+
+def decode_cache_value(value: Union[str, bytes]) -> str:
+    if isinstance(value, str):
+        return value
+    return decompress(value).decode('utf-8')
@@ -1,23 +1,202 @@
-from typing import List, Dict
-import uuid
-from sqlalchemy.orm import Session
+from typing import List, Tuple, Union
+import hashlib
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 import models, schemas
+from compression import encode_column
+from ids import canonical_id, new_snippet_id
 
 
-def get_snippet(db: Session, snippet_id: str):
-    return db.query(
-        models.Snippet,
-    ).filter(
-        models.Snippet.snippetID == snippet_id,
-    ).first()
+def content_hash(code: str) -> str:
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def _insert(db: AsyncSession):
+    # INSERT ... ON CONFLICT is dialect specific
+    if db.bind.dialect.name == 'sqlite':
+        return sqlite.insert
+    return postgresql.insert
+
+
+async def get_snippet(db: AsyncSession, snippet_id: str):
+    result = await db.execute(
+        select(
+            models.Snippet,
+        ).where(
+            models.Snippet.snippetID == snippet_id,
+        )
+    )
+    return result.scalars().first()
+
+
+async def get_snippets(db: AsyncSession, snippet_ids: List[str]) -> List[models.Snippet]:
+    result = await db.execute(
+        select(
+            models.Snippet,
+        ).where(
+            models.Snippet.snippetID.in_(snippet_ids),
+        )
+    )
+    return result.scalars().all()
 
 
-def create_snippet(db: Session, snippet: schemas.BaseSnippet):
-    db_snippet = models.Snippet(
-        code = snippet.code,
-        snippetID = str(uuid.uuid4()),
+async def get_snippet_ids(db: AsyncSession) -> List[str]:
+    result = await db.stream(
+        select(models.Snippet.snippetID).execution_options(yield_per = 10000)
+    )
+    return [snippet_id async for snippet_id in result.scalars()]
+
+
+async def get_snippet_id_by_hash(db: AsyncSession, code_hash: str) -> Union[None, str]:
+    result = await db.execute(
+        select(
+            models.Snippet.snippetID,
+        ).where(
+            models.Snippet.contentHash == code_hash,
+        )
+    )
+    return result.scalars().first()
+
+
+async def create_snippet(
+    db: AsyncSession,
+    snippet: schemas.BaseSnippet,
+    code_hash: str,
+    ) -> Tuple[str, bool]:
+    """Store a snippet unless a snippet with identical code already exists.
+
+    Args:
+        db (AsyncSession): A database session.
+        snippet (schemas.BaseSnippet): The snippet to store.
+        code_hash (str): The content hash of the code of the snippet.
+
+    Returns:
+        Tuple[str, bool]: The identifier of the (new or existing) snippet and whether
+            it was newly created.
+    """
+    snippet_id = new_snippet_id()
+    code, code_blob = encode_column(snippet.code)
+    result = await db.execute(
+        _insert(db)(models.Snippet).values(
+            code = code,
+            codeBlob = code_blob,
+            snippetID = snippet_id,
+            contentHash = code_hash,
+        ).on_conflict_do_nothing(
+            index_elements = ['contentHash'],
+        )
+    )
+    created = result.rowcount == 1
+    if not created:
+        snippet_id = await get_snippet_id_by_hash(db, code_hash)
+    await db.commit()
+    return snippet_id, created
+
+
+async def insert_snippets(db: AsyncSession, snippets: List[Tuple[str, str, str]]) -> None:
+    """Insert a batch of snippets with multi-row inserts.
+
+    Snippets that already exist are skipped. A snippet whose code was stored under
+    another identifier in the meantime is still inserted (without a content hash),
+    since its identifier has already been handed out.
+
+    Args:
+        db (AsyncSession): A database session.
+        snippets (List[Tuple[str, str, str]]): Identifier, code and content hash of
+            each snippet.
+    """
+    rows = {}
+    for snippet_id, code, code_hash in snippets:
+        # Identifiers are compared with the ones loaded from the database below
+        snippet_id = canonical_id(snippet_id) or snippet_id
+        code, code_blob = encode_column(code)
+        rows[snippet_id] = {
+            'snippetID': snippet_id,
+            'code': code,
+            'codeBlob': code_blob,
+            'contentHash': code_hash,
+        }
+    await db.execute(
+        _insert(db)(models.Snippet).values(list(rows.values())).on_conflict_do_nothing()
+    )
+    result = await db.execute(
+        select(
+            models.Snippet.snippetID,
+        ).where(
+            models.Snippet.snippetID.in_(list(rows)),
+        )
+    )
+    missing = set(rows) - set(result.scalars().all())
+    if missing:
+        await db.execute(
+            _insert(db)(models.Snippet).values(
+                [dict(rows[_], contentHash = None) for _ in missing]
+            ).on_conflict_do_nothing()
+        )
+    await db.commit()
+
+
+async def set_run_output(db: AsyncSession, snippet_id: str, run_output: str) -> bool:
+    """Store the run output of a snippet.
+
+    Args:
+        db (AsyncSession): A database session.
+        snippet_id (str): The identifier of the snippet.
+        run_output (str): The run output (JSON).
+
+    Returns:
+        bool: Whether the snippet exists (it may not be persisted yet).
+    """
+    result = await db.execute(
+        update(
+            models.Snippet,
+        ).where(
+            models.Snippet.snippetID == snippet_id,
+        ).values(
+            runOutput = run_output,
+        )
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+
+async def compress_snippets(
+    db: AsyncSession,
+    batch_size: int,
+    after: Union[None, str] = None,
+    ) -> Union[None, str]:
+    """Move the code of a batch of large, uncompressed snippets to 'codeBlob'.
+
+    Args:
+        db (AsyncSession): A database session.
+        batch_size (int): The number of snippets to look at.
+        after (Union[None, str], optional): Only look at snippets with a larger
+            identifier. Defaults to None (all snippets).
+
+    Returns:
+        Union[None, str]: The largest identifier of the batch, None if there are no
+            snippets left.
+    """
+    query = select(
+        models.Snippet,
+    ).where(
+        models.Snippet.codeBlob.is_(None),
+    )
+    if after is not None:
+        query = query.where(models.Snippet.snippetID > after)
+    result = await db.execute(
+        query.order_by(
+            models.Snippet.snippetID,
+        ).limit(batch_size)
     )
-    db.add(db_snippet)
-    db.commit()
-    db.refresh(db_snippet)
-    return db_snippet
\ No newline at end of file
+    db_snippets = result.scalars().all()
+    if not db_snippets:
+        return None
+    for db_snippet in db_snippets:
+        code, code_blob = encode_column(db_snippet.code)
+        if code_blob is not None:
+            db_snippet.code = code
+            db_snippet.codeBlob = code_blob
+    await db.commit()
+    return db_snippets[-1].snippetID
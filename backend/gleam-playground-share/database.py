@@ -1,69 +1,332 @@
+import asyncio
 import logging
-from typing import Union, Any
-from aioredis import create_redis_pool
-from sqlalchemy import create_engine
+import time
+from typing import Union, Any, AsyncIterator, List, Tuple
+from aioredis import RedisError, create_redis_pool
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from settings import (
-    REDIS_HOST,
-    REDIS_PORT,
-    REDIS_DB,
-    POSTGRES_USER,
-    POSTGRES_PASSWORD,
-    POSTGRES_PORT,
-    POSTGRES_DB,    
+    DATABASE_URL,
+    REDIS_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    REDIS_POOL_MINSIZE,
+    REDIS_POOL_MAXSIZE,
+    REDIS_CONNECT_TIMEOUT,
+    REDIS_COMMAND_TIMEOUT,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_SCAN_COUNT,
+    REDIS_BREAKER_FAILURE_THRESHOLD,
+    REDIS_BREAKER_RESET_TIMEOUT,
+    REDIS_BREAKER_RECOVERY_CALLS,
+    MEMORY_STORE_MAX_KEYS,
+)
+from breaker import CLOSED, OPEN, CircuitBreaker
+from memorystore import MemoryStore
+from storage import MEMORY_URL, storage_backend
+from metrics import (
+    DB_POOL_CHECKED_OUT,
+    DB_POOL_CHECKOUT_SECONDS,
+    DB_POOL_CONNECTIONS,
+    DB_POOL_SATURATION,
+    REDIS_COMMAND_ERRORS,
+    REDIS_COMMAND_SECONDS,
+    REDIS_COMMANDS_SKIPPED,
 )
 
 
 class RedisCache:
+    """Redis connection pool with timeouts, health checks and a circuit breaker.
+
+    Commands that fail or exceed the command timeout return None, like commands
+    issued while the pool is not initialized, so callers fall back to the database.
+    After repeated failures the circuit breaker skips Redis entirely until a health
+    check succeeds, and then re-admits it gradually.
 
-    def __init__(self, url: str) -> None:
+    Args:
+        url (str): The address of Redis.
+        minsize (int, optional): The minimum number of pooled connections.
+            Defaults to REDIS_POOL_MINSIZE.
+        maxsize (int, optional): The maximum number of pooled connections.
+            Defaults to REDIS_POOL_MAXSIZE.
+        connect_timeout (float, optional): Seconds to wait for a new connection.
+            Defaults to REDIS_CONNECT_TIMEOUT.
+        command_timeout (float, optional): Seconds to wait for a command.
+            Defaults to REDIS_COMMAND_TIMEOUT.
+        health_check_interval (float, optional): Seconds between health checks.
+            Defaults to REDIS_HEALTH_CHECK_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        minsize: int = REDIS_POOL_MINSIZE,
+        maxsize: int = REDIS_POOL_MAXSIZE,
+        connect_timeout: float = REDIS_CONNECT_TIMEOUT,
+        command_timeout: float = REDIS_COMMAND_TIMEOUT,
+        health_check_interval: float = REDIS_HEALTH_CHECK_INTERVAL,
+    ) -> None:
         self.url = url
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.health_check_interval = health_check_interval
+        self.breaker = CircuitBreaker(
+            name = 'redis',
+            failure_threshold = REDIS_BREAKER_FAILURE_THRESHOLD,
+            reset_timeout = REDIS_BREAKER_RESET_TIMEOUT,
+            recovery_calls = REDIS_BREAKER_RECOVERY_CALLS,
+        )
         self.redis_cache = None
-        
+        self._task = None
+
+    @property
+    def available(self) -> bool:
+        # Whether commands are currently sent to Redis at all
+        return self.redis_cache is not None and self.breaker.state == CLOSED
+
     async def init_cache(self) -> None:
-        self.redis_cache = await create_redis_pool(self.url)
+        try:
+            await self._create_pool()
+        except (asyncio.TimeoutError, RedisError, OSError) as e:
+            # Serve from the database until the health check manages to connect
+            logging.debug(f'REDIS: Could not connect: {e}')
+            self.breaker.record_failure()
+        self._task = asyncio.ensure_future(self._check_health_periodically())
 
-    async def keys(self, pattern: str) -> Union[None, Any]:
-        if self.redis_cache is not None:
-            return await self.redis_cache.keys(pattern)
-        else:
+    async def _create_pool(self) -> None:
+        if self.url.startswith(MEMORY_URL):
+            # In-process store of the embedded storage backend
+            self.redis_cache = MemoryStore(max_keys = MEMORY_STORE_MAX_KEYS)
+            return
+        self.redis_cache = await asyncio.wait_for(
+            create_redis_pool(
+                self.url,
+                minsize = self.minsize,
+                maxsize = self.maxsize,
+                timeout = self.connect_timeout,
+            ),
+            # Creating the pool opens 'minsize' connections
+            timeout = self.connect_timeout * max(self.minsize, 1),
+        )
+
+    async def check_health(self) -> bool:
+        """Ping Redis and update the circuit breaker accordingly.
+
+        Returns:
+            bool: Whether Redis responded in time.
+        """
+        started = time.perf_counter()
+        try:
+            if self.redis_cache is None:
+                await self._create_pool()
+            await asyncio.wait_for(self.redis_cache.ping(), timeout = self.command_timeout)
+        except (asyncio.TimeoutError, RedisError, OSError) as e:
+            REDIS_COMMAND_ERRORS.labels(command = 'ping').inc()
+            logging.debug(f'REDIS: Health check failed: {e}')
+            if self.breaker.state != OPEN:
+                self.breaker.record_failure()
+            return False
+        finally:
+            REDIS_COMMAND_SECONDS.labels(command = 'ping').observe(time.perf_counter() - started)
+        if self.breaker.can_probe():
+            self.breaker.half_open()
+        return True
+
+    async def _check_health_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    async def _execute(self, command: str, awaitable_factory, purpose: str) -> Union[None, Any]:
+        """Run a command with a timeout, unless the circuit breaker is open.
+
+        Args:
+            command (str): The name of the command (used for metrics).
+            awaitable_factory: Returns the awaitable of the command given the pool.
+            purpose (str): What can not be done if Redis is unavailable (used for
+                logging).
+
+        Returns:
+            Union[None, Any]: The result of the command. None if Redis is unavailable.
+        """
+        if self.redis_cache is None:
             logging.debug(
                 "A Redis connection pool has not yet been initialized. " + \
-                "Used keys can thus not be retrieved from Redis. " + \
+                f"{purpose} " + \
                 "Please call method .init_cache()",
             )
             return None
-            
-    async def set(self, key: str, value: Any, expire: int = 0) -> Union[None, bool]:
-        if self.redis_cache is not None:
-            return await self.redis_cache.set(
-                key = key,
-                value = value,
-                expire = expire,
-            )
-        else:
-            logging.debug(
-                "A Redis connection pool has not yet been initialized. " + \
-                "A key-value pair can thus not be set in Redis. " + \
-                "Please call method .init_cache()",
-            )
+        if not self.breaker.allow():
+            REDIS_COMMANDS_SKIPPED.labels(command = command).inc()
             return None
-    
-    async def get(self, key: str) -> Union[None, Any]:
-        if self.redis_cache is not None:
-            return await self.redis_cache.get(key = key)
-        else:
-            logging.debug(
-                "A Redis connection pool has not yet been initialized. " + \
-                "A value can thus not retrieved from Redis. " + \
-                "Please call method .init_cache()",
+        started = time.perf_counter()
+        try:
+            rv = await asyncio.wait_for(
+                awaitable_factory(self.redis_cache),
+                timeout = self.command_timeout,
             )
+        except (asyncio.TimeoutError, RedisError, OSError) as e:
+            REDIS_COMMAND_ERRORS.labels(command = command).inc()
+            logging.debug(f'REDIS: Command {command} failed: {e!r}')
+            self.breaker.record_failure()
+            return None
+        finally:
+            REDIS_COMMAND_SECONDS.labels(command = command).observe(time.perf_counter() - started)
+        self.breaker.record_success()
+        return rv
+
+    async def scan(
+        self,
+        cursor: int = 0,
+        match: Union[None, str] = None,
+        count: int = REDIS_SCAN_COUNT,
+    ) -> Union[None, Tuple[int, List[str]]]:
+        """Return a page of keys and the cursor of the next one (SCAN).
+
+        Unlike KEYS, SCAN only blocks Redis for a page of about 'count' keys. Pages
+        may be empty while the cursor is not 0, and keys modified during a scan may
+        be returned twice or not at all.
+
+        Args:
+            cursor (int, optional): The cursor of the page. Defaults to 0 (the first).
+            match (Union[None, str], optional): Only keys matching this glob-style
+                pattern. Defaults to None.
+            count (int, optional): The number of keys to look at. Defaults to
+                REDIS_SCAN_COUNT.
+
+        Returns:
+            Union[None, Tuple[int, List[str]]]: The next cursor (0 after the last page)
+                and the keys. None if Redis is unavailable.
+        """
+        return await self._execute(
+            'scan',
+            lambda redis: redis.scan(cursor = cursor, match = match, count = count),
+            "Used keys can thus not be retrieved from Redis.",
+        )
+
+    async def iscan(
+        self,
+        match: Union[None, str] = None,
+        count: int = REDIS_SCAN_COUNT,
+    ) -> AsyncIterator[str]:
+        """Iterate over all keys (matching 'match') page by page, see 'scan'.
+
+        Each page is a command of its own (with timeout and circuit breaker), the
+        iteration ends early if Redis becomes unavailable.
+        """
+        cursor = 0
+        while True:
+            rv = await self.scan(cursor, match = match, count = count)
+            if rv is None:
+                return
+            cursor, keys = rv
+            for key in keys:
+                yield key
+            if int(cursor) == 0:
+                return
+
+    async def set(self, key: str, value: Any, expire: int = 0) -> Union[None, bool]:
+        return await self._execute(
+            'set',
+            lambda redis: redis.set(key = key, value = value, expire = expire),
+            "A key-value pair can thus not be set in Redis.",
+        )
+
+    async def get(self, key: str, encoding: Union[None, str] = 'utf-8') -> Union[None, Any]:
+        # Pass encoding = None to retrieve raw bytes (e.g. compressed values)
+        return await self._execute(
+            'get',
+            lambda redis: redis.get(key = key, encoding = encoding),
+            "A value can thus not retrieved from Redis.",
+        )
+
+    async def mget(
+        self,
+        key: str,
+        *keys: str,
+        encoding: Union[None, str] = 'utf-8',
+        ) -> Union[None, List[Any]]:
+        return await self._execute(
+            'mget',
+            lambda redis: redis.mget(key, *keys, encoding = encoding),
+            "Values can thus not retrieved from Redis.",
+        )
+
+    async def persistent(self) -> Union[None, bool]:
+        """Whether Redis keeps its data across restarts (append only file).
+
+        Returns:
+            Union[None, bool]: None if it can not be told (e.g. CONFIG is disabled
+                or Redis is unavailable).
+        """
+        if isinstance(self.redis_cache, MemoryStore):
+            return False
+        rv = await self._execute(
+            'config_get',
+            lambda redis: redis.config_get('appendonly'),
+            "Its persistence can thus not be checked.",
+        )
+        if rv is None:
             return None
-    
+        return rv.get('appendonly') == 'yes'
+
+    async def smembers(self, key: str) -> Union[None, List[str]]:
+        return await self._execute(
+            'smembers',
+            lambda redis: redis.smembers(key),
+            "Set members can thus not retrieved from Redis.",
+        )
+
+    async def zrevrange(
+        self,
+        key: str,
+        start: int,
+        stop: int,
+        withscores: bool = False,
+        ) -> Union[None, List[Any]]:
+        return await self._execute(
+            'zrevrange',
+            lambda redis: redis.zrevrange(key, start, stop, withscores = withscores),
+            "A sorted set can thus not retrieved from Redis.",
+        )
+
+    async def multi_exec(self, *commands: Tuple[Any, ...]) -> Union[None, List[Any]]:
+        # Run commands, given as (command name, *args) tuples, in a transaction
+        def execute(redis):
+            transaction = redis.multi_exec()
+            for name, *args in commands:
+                getattr(transaction, name)(*args)
+            return transaction.execute()
+        return await self._execute(
+            'multi_exec',
+            execute,
+            "A transaction can thus not be executed in Redis.",
+        )
+
+    async def pipeline(self, *commands: Tuple[Any, ...]) -> Union[None, List[Any]]:
+        # Send commands, given as (command name, *args) tuples, in a single round trip
+        def execute(redis):
+            pipeline = redis.pipeline()
+            for name, *args in commands:
+                getattr(pipeline, name)(*args)
+            return pipeline.execute()
+        return await self._execute(
+            'pipeline',
+            execute,
+            "A pipeline can thus not be executed in Redis.",
+        )
+
     async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
         if self.redis_cache is not None:
-            await self.redis_cache.close()
+            self.redis_cache.close()
             await self.redis_cache.wait_closed()
         else:
             logging.debug(
@@ -74,16 +337,66 @@ class RedisCache:
             return None
 
 
-# PostgreSQL Kubernetes address is 'servicename.namespace.svc.cluster.local'
-# TODO: Set address as environment variable such that it aligns with the kubernetes pod namespace
-SQLALCHEMY_DATABASE_URL = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}' + \
-    f'@gleam-playground-db.gleam-playground:{POSTGRES_PORT}/{POSTGRES_DB}'
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    # Measure how long requests wait for a connection, including opening new ones
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+def instrument_pool(engine: AsyncEngine, capacity: int) -> None:
+    """Export the saturation and connection churn of the pool of an engine.
+
+    Args:
+        engine (AsyncEngine): The engine whose pool is instrumented.
+        capacity (int): The maximum number of connections of the pool.
+    """
+    pool = engine.sync_engine.pool
+    checked_out = 0
+
+    def update(delta: int) -> None:
+        nonlocal checked_out
+        checked_out += delta
+        DB_POOL_CHECKED_OUT.set(checked_out)
+        DB_POOL_SATURATION.set(checked_out / capacity if capacity > 0 else 0.0)
+
+    event.listen(pool, 'checkout', lambda *args: update(1))
+    event.listen(pool, 'checkin', lambda *args: update(-1))
+    event.listen(
+        pool, 'connect', lambda *args: DB_POOL_CONNECTIONS.labels(event = 'opened').inc(),
+    )
+    event.listen(
+        pool, 'close', lambda *args: DB_POOL_CONNECTIONS.labels(event = 'closed').inc(),
+    )
+    event.listen(
+        pool, 'invalidate', lambda *args: DB_POOL_CONNECTIONS.labels(event = 'invalidated').inc(),
+    )
+
+
+# The addresses can be overridden, e.g. to run the service against local instances
+SQLALCHEMY_DATABASE_URL = DATABASE_URL or storage_backend.database_url()
+# Database access is fully asynchronous (asyncpg or aiosqlite), so concurrent
+# requests each use their own pooled connection instead of blocking the event loop
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass = InstrumentedQueuePool,
+    **storage_backend.engine_options(SQLALCHEMY_DATABASE_URL),
+)
+storage_backend.configure(engine)
+instrument_pool(engine, capacity = DB_POOL_SIZE + max(DB_MAX_OVERFLOW, 0))
+SessionLocal = sessionmaker(
+    autocommit = False,
+    autoflush = False,
+    expire_on_commit = False,
+    bind = engine,
+    class_ = AsyncSession,
+)
 Base = declarative_base()
 
 
-# Redis kubernetes address is 'servicename.namespace.svc.cluster.local'
-# TODO: Set address as environment variable such that it aligns with the kubernetes pod namespace
-REDIS_DATABASE_URL = f'redis://{REDIS_HOST}.gleam-playground:{REDIS_PORT}/{REDIS_DB}?encoding=utf-8'
+REDIS_DATABASE_URL = REDIS_URL or storage_backend.redis_url()
 redis_cache = RedisCache(url = REDIS_DATABASE_URL)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional
+from httpcache import RenderedSnippet, render_json
+from settings import SNIPPET_DIR
+
+
+class Example(NamedTuple):
+    uuid: str
+    name: str
+    code: str
+
+
+def parse_example(filepath: str) -> Optional[Example]:
+    """Parse a bundled Gleam code snippet.
+
+    The snippet starts with a '//cname:' and a '//cuuid:' header line, everything
+    after these lines is the code of the snippet.
+
+    Args:
+        filepath (str): The filepath to a Gleam code snippet.
+
+    Returns:
+        Optional[Example]: The parsed snippet. None if the headers are missing.
+    """
+    with open(filepath) as f:
+        name = None; uuid = None
+        for line in f:
+            if len(line.split("//cname:")) == 2:
+                name = line.split("//cname:")[-1].strip("'\n")
+            if len(line.split("//cuuid:")) == 2:
+                uuid = line.split("//cuuid:")[-1].strip("'\n")
+            if name is not None and uuid is not None:
+                return Example(uuid = uuid, name = name, code = f.read())
+    return None
+
+
+def _gleam_files(directory: str) -> Dict[str, float]:
+    # Filepath -> modification time of all Gleam files in a directory
+    files = {}
+    for filename in os.listdir(directory):
+        if "gleam" in filename.split("."):
+            filepath = os.path.join(directory, filename)
+            files[filepath] = os.stat(filepath).st_mtime
+    return files
+
+
+def load_examples(directory: str) -> Mapping[str, Example]:
+    """Parse all bundled Gleam code snippets in a directory.
+
+    Args:
+        directory (str): The directory containing the Gleam code snippets.
+
+    Returns:
+        Mapping[str, Example]: An immutable mapping from uuid to snippet.
+    """
+    index = {}
+    for filepath in sorted(_gleam_files(directory)):
+        example = parse_example(filepath)
+        if example is None:
+            logging.debug(f'EXAMPLES: Skipping snippet without headers: {filepath}')
+            continue
+        index[example.uuid] = example
+    return MappingProxyType(index)
+
+
+def render_examples(examples: Mapping[str, Example]) -> RenderedSnippet:
+    """Render the response body listing all examples (identifier, name and code).
+
+    Args:
+        examples (Mapping[str, Example]): The examples by identifier.
+
+    Returns:
+        RenderedSnippet: The body, its entity tag and a gzipped variant.
+    """
+    return render_json('examples', {
+        'examples': [
+            {'uuid': _.uuid, 'name': _.name, 'code': _.code} for _ in examples.values()
+        ],
+    })
+
+
+class ExampleIndex:
+    """In-memory index of the bundled example snippets.
+
+    The snippets are parsed once (at startup) such that lookups, in particular of
+    unknown identifiers, never touch the filesystem.
+
+    Args:
+        directory (str): The directory containing the Gleam code snippets.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.examples: Mapping[str, Example] = MappingProxyType({})
+        # The response body of all examples, see 'render_examples'
+        self.bundle: RenderedSnippet = render_examples(self.examples)
+        self._mtimes: Dict[str, float] = {}
+        self._watcher = None
+
+    def load(self) -> None:
+        self._mtimes = _gleam_files(self.directory)
+        # The index is replaced as a whole, so readers never see a partial update
+        examples = load_examples(self.directory)
+        self.bundle = render_examples(examples)
+        self.examples = examples
+        logging.debug(f'EXAMPLES: Indexed {len(self.examples)} example snippets')
+
+    def get(self, uuid: str) -> Optional[Example]:
+        return self.examples.get(uuid)
+
+    def watch(self, interval: float = 1.0) -> None:
+        """Reload the index whenever a snippet is added, changed or removed.
+
+        Meant for development, the bundled snippets do not change in production.
+
+        Args:
+            interval (float, optional): Seconds between checks. Defaults to 1.0.
+        """
+        self._watcher = asyncio.ensure_future(self._watch(interval))
+
+    async def _watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if _gleam_files(self.directory) != self._mtimes:
+                    self.load()
+            except OSError as e:
+                logging.debug(f'EXAMPLES: Could not reload example snippets: {e}')
+
+    def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+
+example_index = ExampleIndex(SNIPPET_DIR)
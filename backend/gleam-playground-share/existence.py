@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Set
+from bloom import BloomFilter
+from cache import LRUCache
+from ids import created_at
+from settings import (
+    NEGATIVE_CACHE_TTL,
+    NEGATIVE_CACHE_MAX_ENTRIES,
+    EXISTENCE_FILTER_ERROR_RATE,
+    EXISTENCE_FILTER_GRACE,
+)
+
+
+# Prefix of the Redis keys marking snippet identifiers that do not exist
+MISSING_PREFIX = 'missing:'
+
+
+def missing_key(snippet_id: str) -> str:
+    return f'{MISSING_PREFIX}{snippet_id}'
+
+
+class SnippetFilter:
+    """Probabilistic set of all snippet identifiers stored in the database.
+
+    Until the filter has been built for the first time every identifier is assumed
+    to exist, so it never rejects an identifier it knows nothing about. Likewise
+    snippets created (by other replicas) since it was built are not rejected, their
+    identifiers tell when they were created (see 'ids.new_snippet_id').
+
+    Args:
+        error_rate (float): The false positive rate of the filter.
+        grace (float): Seconds before the last build (and after now) of creation
+            times that are not rejected either, for clock skew between replicas
+            and snippets persisted late (write-behind).
+        min_capacity (int, optional): The minimum capacity of the filter. Defaults
+            to 100000.
+    """
+
+    def __init__(self, error_rate: float, grace: float, min_capacity: int = 100_000) -> None:
+        self.error_rate = error_rate
+        self.grace = grace
+        self.min_capacity = min_capacity
+        self.bloom: Optional[BloomFilter] = None
+        # Unix time the identifiers of the filter were loaded at
+        self.built_at = 0.0
+        # Identifiers added while the filter is being rebuilt
+        self._added: Optional[Set[str]] = None
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self.bloom is not None
+
+    def might_exist(self, snippet_id: str) -> bool:
+        if self.bloom is None or snippet_id in self.bloom:
+            return True
+        # Identifiers created before time-ordered identifiers were introduced are
+        # all in the filter (once the replicas creating them are replaced)
+        created = created_at(snippet_id)
+        return created is not None and \
+            self.built_at - self.grace <= created <= time.time() + self.grace
+
+    def contains(self, snippet_id: str) -> bool:
+        # Whether the identifier was stored (or is a false positive), unlike
+        # 'might_exist' False for everything the filter knows nothing about
+        return self.bloom is not None and snippet_id in self.bloom
+
+    def add(self, snippet_id: str) -> None:
+        if self.bloom is not None:
+            self.bloom.add(snippet_id)
+        if self._added is not None:
+            self._added.add(snippet_id)
+
+    async def rebuild(self, load: Callable[[], Awaitable[List[str]]]) -> None:
+        """Rebuild the filter from scratch.
+
+        Args:
+            load (Callable[[], Awaitable[List[str]]]): Returns all snippet
+                identifiers.
+        """
+        self._added = set()
+        try:
+            started = time.time()
+            snippet_ids = await load()
+            # Leave room for the snippets created until the next rebuild
+            bloom = BloomFilter(
+                capacity = max(2 * len(snippet_ids), self.min_capacity),
+                error_rate = self.error_rate,
+            )
+            for i, snippet_id in enumerate(snippet_ids):
+                bloom.add(snippet_id)
+                # Do not hold up requests while indexing a large table
+                if i % 10000 == 9999:
+                    await asyncio.sleep(0)
+            for snippet_id in self._added:
+                bloom.add(snippet_id)
+            self.bloom = bloom
+            self.built_at = started
+            logging.debug(f'FILTER: Rebuilt with {len(snippet_ids)} snippet identifiers')
+        finally:
+            self._added = None
+
+    def rebuild_periodically(
+        self,
+        load: Callable[[], Awaitable[List[str]]],
+        interval: float,
+    ) -> None:
+        self._task = asyncio.ensure_future(self._rebuild_periodically(load, interval))
+
+    async def _rebuild_periodically(
+        self,
+        load: Callable[[], Awaitable[List[str]]],
+        interval: float,
+    ) -> None:
+        while True:
+            try:
+                await self.rebuild(load)
+            except Exception as e:
+                # Keep using the previous filter (if any) until the next attempt
+                logging.debug(f'FILTER: Could not be rebuilt: {e}')
+            await asyncio.sleep(interval)
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# Snippet identifier -> True for identifiers that recently resolved to nothing
+missing_cache = LRUCache(
+    max_bytes = NEGATIVE_CACHE_MAX_ENTRIES,
+    ttl = NEGATIVE_CACHE_TTL,
+    sizeof = lambda _: 1,
+)
+snippet_filter = SnippetFilter(
+    error_rate = EXISTENCE_FILTER_ERROR_RATE,
+    grace = EXISTENCE_FILTER_GRACE,
+)
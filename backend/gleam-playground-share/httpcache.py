@@ -0,0 +1,260 @@
+import gzip
+import hashlib
+import json
+from typing import Any, Iterator, NamedTuple, Optional
+from fastapi.responses import JSONResponse
+from starlette.responses import Response
+from settings import COMPRESSION_THRESHOLD, COMPRESSION_LEVEL
+
+
+# Shared snippets never change once created
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Redis keys of the rendered responses of snippets. Once a snippet's body is
+# cached, its code and run output are not cached separately anymore
+BODY_PREFIX = 'body:'
+# Marks a gzipped body in Redis (plain bodies are JSON and start with '{')
+GZIP = b'\x02'
+
+
+def body_key(snippet_id: str) -> str:
+    return f'{BODY_PREFIX}{snippet_id}'
+
+
+def snippet_etag(
+    snippet_id: str,
+    code: str,
+    run: Optional[str] = None,
+    final: bool = True,
+    ) -> str:
+    """Strong entity tag of a snippet.
+
+    The tag starts with the snippet identifier, such that a conditional request for
+    an immutable snippet can be answered without looking up its code. Tags of
+    responses that may still change (their run output is yet to be computed) use a
+    different separator and are always compared in full.
+
+    Args:
+        snippet_id (str): The identifier of the snippet.
+        code (str): The code of the snippet.
+        run (Optional[str], optional): The run output (JSON) of the snippet.
+            Defaults to None.
+        final (bool, optional): Whether the response can not change anymore.
+            Defaults to True.
+
+    Returns:
+        str: The quoted entity tag.
+    """
+    content_hash = hashlib.sha256(code.encode('utf-8'))
+    if run is not None:
+        content_hash.update(run.encode('utf-8'))
+    separator = '.' if final else '~'
+    return f'"{snippet_id}{separator}{content_hash.hexdigest()[:16]}"'
+
+
+def _entity_tags(if_none_match: str) -> Iterator[str]:
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison
+        yield tag[2:] if tag.startswith('W/') else tag
+
+
+def gzip_etag(etag: str) -> str:
+    # The gzipped representation of a body needs a strong entity tag of its own
+    return f'{etag[:-1]}-gz"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(tag in ('*', etag) for tag in _entity_tags(if_none_match))
+
+
+def matching_snippet_etag(if_none_match: Optional[str], snippet_id: str) -> Optional[str]:
+    # Any entity tag issued for an immutable snippet is still valid
+    if not if_none_match:
+        return None
+    prefix = f'"{snippet_id}.'
+    for tag in _entity_tags(if_none_match):
+        if tag.startswith(prefix):
+            return tag
+    return None
+
+
+def snippet_response(
+    snippet_id: str,
+    code: str,
+    cache_control: str = IMMUTABLE_CACHE_CONTROL,
+    run: Optional[str] = None,
+    final: bool = True,
+    ) -> JSONResponse:
+    rv = {'fileName': None, 'code': code}
+    if run is not None:
+        rv['run'] = json.loads(run)
+    return JSONResponse(
+        rv, 200,
+        headers = {
+            'ETag': snippet_etag(snippet_id, code, run = run, final = final),
+            # Clients revalidate responses whose run output may still come
+            'Cache-Control': cache_control if final else 'no-cache',
+        },
+    )
+
+
+def conditional_snippet_response(
+    if_none_match: Optional[str],
+    snippet_id: str,
+    code: str,
+    cache_control: str = IMMUTABLE_CACHE_CONTROL,
+    run: Optional[str] = None,
+    final: bool = True,
+    ) -> Response:
+    # The snippet, or 304 Not Modified if the client's copy is still up to date
+    etag = snippet_etag(snippet_id, code, run = run, final = final)
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag, cache_control if final else 'no-cache')
+    return snippet_response(snippet_id, code, cache_control, run = run, final = final)
+
+
+class RenderedSnippet(NamedTuple):
+    """The encoded response body of a snippet, served as is.
+
+    Either variant may be missing: Bodies read from Redis are only decompressed
+    for clients that do not accept gzip, and small bodies are not compressed.
+    """
+    etag: str
+    body: Optional[bytes]
+    gzipped: Optional[bytes]
+
+    @property
+    def size(self) -> int:
+        return len(self.body or b'') + len(self.gzipped or b'')
+
+
+def render_snippet(snippet_id: str, code: str, run: Optional[str] = None) -> RenderedSnippet:
+    """Encode the final response body of a snippet once, and compress it if that pays off.
+
+    Args:
+        snippet_id (str): The identifier of the snippet.
+        code (str): The code of the snippet.
+        run (Optional[str], optional): The run output (JSON) of the snippet, which
+            is embedded as is. Defaults to None.
+
+    Returns:
+        RenderedSnippet: The rendered snippet.
+    """
+    # Encoded like 'JSONResponse' does
+    body = b'{"fileName":null,"code":' + json.dumps(
+        code, ensure_ascii = False, separators = (',', ':'),
+    ).encode('utf-8')
+    if run is not None:
+        body += b',"run":' + run.encode('utf-8')
+    body += b'}'
+    return RenderedSnippet(snippet_etag(snippet_id, code, run = run), body, _gzipped(body))
+
+
+def render_json(name: str, value: Any) -> RenderedSnippet:
+    """Encode a JSON response body once, e.g. of a bundle of snippets.
+
+    Args:
+        name (str): The start of the entity tag, which ends with the content hash.
+        value (Any): The JSON document.
+
+    Returns:
+        RenderedSnippet: The rendered body.
+    """
+    body = json.dumps(value, ensure_ascii = False, separators = (',', ':')).encode('utf-8')
+    etag = f'"{name}.{hashlib.sha256(body).hexdigest()[:16]}"'
+    return RenderedSnippet(etag, body, _gzipped(body))
+
+
+def _gzipped(body: bytes) -> Optional[bytes]:
+    # Small bodies, or bodies that do not get smaller, are not compressed
+    if len(body) < COMPRESSION_THRESHOLD:
+        return None
+    gzipped = gzip.compress(body, COMPRESSION_LEVEL, mtime = 0)
+    return gzipped if len(gzipped) < len(body) else None
+
+
+def rendered_code(rendered: RenderedSnippet) -> str:
+    # The code of a rendered snippet, for the responses that embed it differently
+    body = rendered.body if rendered.body is not None else gzip.decompress(rendered.gzipped)
+    return json.loads(body)['code']
+
+
+def encode_rendered(rendered: RenderedSnippet) -> bytes:
+    # The entity tag on the first line, then the gzipped or plain body
+    payload = GZIP + rendered.gzipped if rendered.gzipped is not None else rendered.body
+    return rendered.etag.encode('utf-8') + b'\n' + payload
+
+
+def decode_rendered(value: bytes) -> RenderedSnippet:
+    etag, payload = value.split(b'\n', 1)
+    if payload[:1] == GZIP:
+        return RenderedSnippet(etag.decode('utf-8'), None, payload[1:])
+    return RenderedSnippet(etag.decode('utf-8'), payload, None)
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def rendered_response(
+    if_none_match: Optional[str],
+    accept_encoding: Optional[str],
+    rendered: RenderedSnippet,
+    cache_control: str = IMMUTABLE_CACHE_CONTROL,
+    ) -> Response:
+    """Send a rendered snippet, or 304 Not Modified if the client's copy is up to date.
+
+    The body is sent gzipped to clients that accept it, if a gzipped variant exists.
+    Either representation has its own entity tag, a client holding one of them is
+    up to date.
+
+    Args:
+        if_none_match (Optional[str]): Entity tags of the snippet cached by the client.
+        accept_encoding (Optional[str]): The content codings accepted by the client.
+        rendered (RenderedSnippet): The rendered snippet.
+        cache_control (str, optional): The Cache-Control header. Defaults to
+            IMMUTABLE_CACHE_CONTROL.
+
+    Returns:
+        Response: The response.
+    """
+    gzipped = rendered.gzipped is not None and accepts_gzip(accept_encoding)
+    etag = gzip_etag(rendered.etag) if gzipped else rendered.etag
+    if etag_matches(if_none_match, rendered.etag) or (
+        rendered.gzipped is not None and etag_matches(if_none_match, gzip_etag(rendered.etag))
+    ):
+        return not_modified_response(etag, cache_control)
+    headers = {
+        'ETag': etag,
+        'Cache-Control': cache_control,
+        'Vary': 'Accept-Encoding',
+    }
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+        content = rendered.gzipped
+    elif rendered.body is not None:
+        content = rendered.body
+    else:
+        content = gzip.decompress(rendered.gzipped)
+    return Response(content, 200, headers = headers, media_type = 'application/json')
+
+
+def not_modified_response(etag: str, cache_control: str = IMMUTABLE_CACHE_CONTROL) -> Response:
+    return Response(
+        status_code = 304,
+        headers = {
+            'ETag': etag,
+            'Cache-Control': cache_control,
+            # As the 200 responses, which may be gzipped
+            'Vary': 'Accept-Encoding',
+        },
+    )
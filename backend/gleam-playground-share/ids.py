@@ -0,0 +1,81 @@
+import os
+import time
+import uuid
+from typing import Optional
+
+
+# Snippet identifiers are UUIDs. They are stored as 16 bytes and published as 22
+# base62 digits (e.g. in links and Redis keys) instead of 36 hexadecimal digits
+# and dashes. Links with the UUID form keep resolving (see 'canonical_id')
+BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+PUBLIC_ID_LENGTH = 22
+_DIGITS = {digit: value for value, digit in enumerate(BASE62)}
+
+
+def public_id(value: uuid.UUID) -> str:
+    """Encode a UUID as its (fixed length) base62 public identifier."""
+    n = value.int
+    digits = []
+    for _ in range(PUBLIC_ID_LENGTH):
+        n, digit = divmod(n, 62)
+        digits.append(BASE62[digit])
+    return ''.join(reversed(digits))
+
+
+def to_uuid(snippet_id: str) -> uuid.UUID:
+    """Decode a public identifier, or parse the UUID form of an identifier.
+
+    Raises:
+        ValueError: If the identifier is neither.
+    """
+    if len(snippet_id) == PUBLIC_ID_LENGTH:
+        n = 0
+        for digit in snippet_id:
+            value = _DIGITS.get(digit)
+            if value is None:
+                raise ValueError(f'Invalid snippet identifier: {snippet_id}')
+            n = n * 62 + value
+        if n >> 128:
+            raise ValueError(f'Invalid snippet identifier: {snippet_id}')
+        return uuid.UUID(int = n)
+    return uuid.UUID(snippet_id)
+
+
+def canonical_id(snippet_id: str) -> Optional[str]:
+    """The public identifier of a snippet given either form of its identifier.
+
+    Returns:
+        Optional[str]: The public identifier. None if the identifier is invalid.
+    """
+    try:
+        return public_id(to_uuid(snippet_id))
+    except ValueError:
+        return None
+
+
+def new_snippet_id() -> str:
+    """A new, time-ordered public identifier (a version 7 UUID).
+
+    The first 48 bits are the Unix time in milliseconds, the remaining 74 bits
+    (besides version and variant) are random.
+    """
+    n = int(time.time() * 1000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    n = n & ~(0xf << 76) | 7 << 76
+    n = n & ~(0x3 << 62) | 0x2 << 62
+    return public_id(uuid.UUID(int = n))
+
+
+def created_at(snippet_id: str) -> Optional[float]:
+    """The Unix time a snippet was created at, given its identifier.
+
+    Returns:
+        Optional[float]: The time. None for invalid identifiers and for identifiers
+            (version 4 UUIDs) created before identifiers were time-ordered.
+    """
+    try:
+        value = to_uuid(snippet_id)
+    except ValueError:
+        return None
+    if value.variant != uuid.RFC_4122 or value.version != 7:
+        return None
+    return (value.int >> 80) / 1000
@@ -1,23 +1,61 @@
-from typing import Optional, Union, Tuple
+from typing import Any, List, Optional, Tuple
+import asyncio
+import fnmatch
 import logging
 import json
-import os
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.params import Header
 from starlette.responses import Response
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware 
 from database import redis_cache
-from sqlalchemy.orm import Session
+from cache import body_cache, run_cache, snippet_cache
+from examples import example_index
+from ids import PUBLIC_ID_LENGTH, canonical_id, new_snippet_id
+from existence import missing_cache, missing_key, snippet_filter
+from writebehind import pending_key, write_behind
+from popularity import popularity
+from replicas import read_replicas
+from runoutput import run_key, run_outputs
+from metrics import hit_ratios, record_lookup
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import SessionLocal, engine
-import crud, models, schemas
+import crud, schemas
+from migrations import bootstrap
+from compression import decode_cache_value, encode_cache_value
+from httpcache import (
+    BODY_PREFIX,
+    IMMUTABLE_CACHE_CONTROL,
+    body_key,
+    conditional_snippet_response,
+    decode_rendered,
+    rendered_code,
+    encode_rendered,
+    matching_snippet_etag,
+    not_modified_response,
+    render_snippet,
+    rendered_response,
+)
 from common.middleware import ContentSizeLimitMiddleware
-from common.common import check_api_key, load_cors
+from common.common import check_admin_key, check_api_key, load_cors
 from settings import (
     API_KEY,
+    ADMIN_KEY,
     VERSION,
     REDIS_TTL,
-    SNIPPET_DIR,
+    EXAMPLES_RELOAD,
+    EXAMPLES_RELOAD_INTERVAL,
+    NEGATIVE_CACHE_TTL,
+    EXISTENCE_FILTER_ENABLED,
+    EXISTENCE_FILTER_REBUILD_INTERVAL,
+    WRITE_BEHIND_ENABLED,
+    BATCH_GET_MAX_IDS,
+    REDIS_SCAN_COUNT,
+    DB_BOOTSTRAP,
+    POPULARITY_ENABLED,
+    PREWARM_TOP_N,
+    EXAMPLES_CACHE_CONTROL,
 )
 
 
@@ -29,86 +67,17 @@ if CORS_CONFIG:
 # Limit request size to 250000 bytes ~ 0.25 megabytes
 app.add_middleware(ContentSizeLimitMiddleware, max_content_size = 25_00_00)
 
-# Create database tables
-models.Base.metadata.create_all(bind = engine)
-
-
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-
-async def read_snippet(filepath: str) -> Union[None, str]:    
-    """Read in a Gleam code snippet from local file storage.
-
-    Args:
-        filepath (str): The filepath to a Gleam code snippet.
-
-    Returns:
-        Union[None, bool]: True if the Gleam code snippet was read in and cached
-            correctly. Otherwise None or False.
-    """
-    with open(filepath) as f:
-        name = None; uuid = None
-        print("Reading in snippet: ")
-        while True:
-            try:
-                line = next(f)
-                if len(line.split("//cname:")) == 2:
-                    name = line.split("//cname:")[-1].strip("'\n")
-                if len(line.split("//cuuid:")) == 2:
-                    uuid = line.split("//cuuid:")[-1].strip("'\n")
-                if name is not None and uuid is not None:
-                    code = str(f.read())
-                    # Cache the Gleam code snippet in Redis
-                    rc = await redis_cache.set(
-                        key = uuid,
-                        value = json.dumps(code),
-                        expire = REDIS_TTL,
-                    )
-                    if rc is None:
-                        logging.debug(
-                            f'REDIS: A Gleam code snippet could not be cached with identifier: {uuid}'
-                        )
-                    return code
-            except StopIteration:
-                break
-    return None
-
-
-async def check_snippets(key: str) -> Union[None, str]:
-    """Check local storage for a certain Gleam code snippet.
 
-    Args:
-        key (str): The identifier of a Gleam code snippet to be retrieved.
 
-    Returns:
-        Union[None, str]: A filepath if successful. Otherwise None.
-    """
-    gleam_files = [f for f in os.listdir(SNIPPET_DIR) if "gleam" in f.split(".")]
-    for gleam_file in gleam_files:
-        filepath = os.path.join(SNIPPET_DIR, gleam_file)
-        with open(filepath) as f:
-            name = None; uuid = None
-            while True:
-                try:
-                    line = next(f)
-                    if len(line.split("//cname:")) == 2:
-                        name = line.split("//cname:")[-1].strip("'\n")
-                        print("Name: ", name)
-                    if len(line.split("//cuuid:")) == 2:
-                        uuid = line.split("//cuuid:")[-1].strip("'\n")
-                        print("UUID: ", uuid)
-                    if name is not None and uuid is not None:
-                        if uuid == key:
-                            return filepath
-                except StopIteration:
-                    break
-    return None
+async def load_snippet_ids() -> List[str]:
+    """Load the identifiers of all stored Gleam code snippets."""
+    # From the primary, read replicas may lack the latest snippets
+    async with SessionLocal() as db:
+        return await crud.get_snippet_ids(db)
 
 
 @app.get('/version')
@@ -134,51 +103,209 @@ async def version_options() -> Response:
     
 @app.on_event('startup')
 async def starup_event() -> None:
+    global _startup_task
+    # Only for development, deployments run 'python manage.py migrate' (see DB_BOOTSTRAP)
+    if DB_BOOTSTRAP:
+        await bootstrap(engine)
+    # Index the bundled example snippets once, lookups never touch the filesystem
+    example_index.load()
+    if EXAMPLES_RELOAD:
+        example_index.watch(interval = EXAMPLES_RELOAD_INTERVAL)
+    # Everything that needs a network round trip happens in the background, such
+    # that a new replica serves its first request right away. Until Redis is
+    # connected, requests are served from the database
+    _startup_task = asyncio.ensure_future(deferred_startup())
+    read_replicas.start()
+    if EXISTENCE_FILTER_ENABLED:
+        snippet_filter.rebuild_periodically(
+            load = load_snippet_ids,
+            interval = EXISTENCE_FILTER_REBUILD_INTERVAL,
+        )
+
+
+# The background part of the startup (see deferred_startup)
+_startup_task = None
+
+
+async def deferred_startup() -> None:
     await redis_cache.init_cache()
+    if WRITE_BEHIND_ENABLED:
+        await write_behind.check_persistence()
+        # Pick up the snippets that were not persisted before a replica went down
+        await write_behind.recover()
+        write_behind.start()
+    if POPULARITY_ENABLED:
+        popularity.start()
+        await prewarm(PREWARM_TOP_N)
+    # Viewers of the examples see their output without a compile
+    await run_outputs.precompute_examples(example_index.examples)
+
+
+async def prewarm(n: int) -> None:
+    """Load the most popular Gleam code snippets into Redis and the in-process cache.
+
+    The bundled example snippets need no warming, they are indexed in memory.
+
+    Args:
+        n (int): The number of snippets to load.
+    """
+    # Identifiers recorded before the public identifiers were introduced are in the
+    # UUID form
+    scores = {
+        canonical_id(snippet_id): score for snippet_id, score in await popularity.top(n)
+        if example_index.get(snippet_id) is None and canonical_id(snippet_id) is not None
+    }
+    if not scores:
+        return
+    snippet_ids = list(scores)
+    # Snippets are cached either as their code or as their rendered body
+    values = await redis_cache.mget(
+        *snippet_ids, *[body_key(_) for _ in snippet_ids], encoding = None,
+    )
+    if values is None:
+        return
+    found = {}
+    rendered = set()
+    for snippet_id, code, body in zip(snippet_ids, values, values[len(snippet_ids):]):
+        if body is not None:
+            body_cache.set(snippet_id, decode_rendered(body))
+            rendered.add(snippet_id)
+        elif code is not None:
+            found[snippet_id] = json.loads(decode_cache_value(code))
+    uncached = [
+        snippet_id for snippet_id in snippet_ids
+        if snippet_id not in found and snippet_id not in rendered
+    ]
+    if uncached:
+        async with SessionLocal() as db:
+            db_snippets = await read_replicas.get_snippets(db, snippet_ids = uncached)
+        refill = []
+        for db_snippet in db_snippets:
+            code = db_snippet.get_code()
+            found[db_snippet.snippetID] = code
+            refill.append((
+                'setex',
+                db_snippet.snippetID,
+                popularity.ttl(scores[db_snippet.snippetID]),
+                encode_cache_value(json.dumps(code)),
+            ))
+        if refill:
+            await redis_cache.pipeline(*refill)
+    for snippet_id, code in found.items():
+        snippet_cache.set(snippet_id, code)
+    logging.debug(
+        f'Prewarmed {len(found) + rendered} popular snippets, {len(uncached)} from the database'
+    )
 
 
 @app.on_event('shutdown')
 async def shutdown_event() -> None:
-    redis_cache.close()
-    await redis_cache.wait_closed()
+    if _startup_task is not None:
+        _startup_task.cancel()
+    example_index.stop()
+    snippet_filter.stop()
+    if POPULARITY_ENABLED:
+        await popularity.stop()
+    await run_outputs.stop()
+    if WRITE_BEHIND_ENABLED:
+        await write_behind.stop()
+    await redis_cache.close()
+    await read_replicas.stop()
+    await engine.dispose()
 
 
 @app.post('/snippet')
 async def create_snippet(
-    snippet: schemas.BaseSnippet,
-    db: Session = Depends(get_db),
+    snippet: schemas.SharedSnippet,
+    db: AsyncSession = Depends(get_db),
     x_api_key: Optional[str] = Header(None),
     ) -> JSONResponse:
     """Create a Gleam code snippet and save it for long term storage.
 
+    The output of running the snippet is stored along with it. If the client does
+    not share it, it is computed in the background (see 'RunOutputs').
+
     Args:
-        snippet (schemas.BaseSnippet): A Gleam code snippet that is to be saved to the database.
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        snippet (schemas.SharedSnippet): A Gleam code snippet that is to be saved to
+            the database, and optionally its run output.
+        db (AsyncSession, optional): A database session. Defaults to Depends(get_db).
         x_api_key (Optional[str], optional): An API key provided by the frontend.
             Defaults to Header(None).
 
     Returns:
-        JSONResponse: The identifier of the saved code snippet.
+        JSONResponse: The identifier of the saved code snippet. If identical code was
+            shared before, the identifier of the existing snippet (status 200).
     """
     # Check if the given API is valid
     check_api_key(x_api_key, API_KEY)
-    db_snippet = crud.create_snippet(db = db, snippet = snippet)
-    logging.debug(
-        f'DB   : A Gleam code snippet was created with identifier: {db_snippet.snippetID}'
-    )
-    code = json.dumps(db_snippet.code)
-    # Cache the Gleam code snippet
-    rc = await redis_cache.set(
-        key = db_snippet.snippetID,
-        value = code,
+    code_hash = crud.content_hash(snippet.code)
+    # Identical code that was shared before resolves to the existing snippet. The
+    # mapping from content hash to identifier is cached such that the common case
+    # of re-sharing an example never reaches the database
+    snippet_id = await redis_cache.get(key = hash_key(code_hash))
+    if snippet_id is not None:
+        logging.debug(
+            f'REDIS: An identical Gleam code snippet exists with identifier: {snippet_id}'
+        )
+        rv = {'snippetID': canonical_id(snippet_id) or snippet_id}
+        return JSONResponse(rv, 200)
+    snippet_id, created = None, True
+    if WRITE_BEHIND_ENABLED:
+        # Hand out the identifier as soon as the snippet is durable in Redis, it is
+        # persisted to the database with the next batch
+        snippet_id = new_snippet_id()
+        if await write_behind.add(snippet_id, snippet.code, code_hash):
+            logging.debug(
+                f'REDIS: A Gleam code snippet was queued with identifier: {snippet_id}'
+            )
+        else:
+            snippet_id = None
+    if snippet_id is None:
+        snippet_id, created = await crud.create_snippet(
+            db = db, snippet = snippet, code_hash = code_hash,
+        )
+        logging.debug(
+            f'DB   : A Gleam code snippet was {"created" if created else "found"} with identifier: {snippet_id}'
+        )
+    await redis_cache.set(
+        key = hash_key(code_hash),
+        value = snippet_id,
         expire = REDIS_TTL,
     )
-    if rc is not None:
-        logging.debug(
-            f'REDIS: A Gleam code snippet was cached with identifier: {db_snippet.snippetID}'
+    # Cache the Gleam code of a new snippet. An existing one may be cached as its
+    # rendered body already, which holds the code as well
+    if created:
+        rc = await redis_cache.set(
+            key = snippet_id,
+            value = encode_cache_value(json.dumps(snippet.code)),
+            expire = REDIS_TTL,
+        )
+        if rc is not None:
+            logging.debug(
+                f'REDIS: A Gleam code snippet was cached with identifier: {snippet_id}'
+            )
+    snippet_cache.set(snippet_id, snippet.code)
+    snippet_filter.add(snippet_id)
+    if created:
+        # Read replicas may not have the snippet yet
+        read_replicas.record_write(snippet_id)
+        run_outputs.schedule(
+            snippet_id,
+            snippet.code,
+            run_output = snippet.run.json() if snippet.run is not None else None,
         )
-    rv = {'snippetID': db_snippet.snippetID}
-    return JSONResponse(rv, 201)
+    rv = {'snippetID': snippet_id}
+    return JSONResponse(rv, 201 if created else 200)
+
+
+def hash_key(code_hash: str) -> str:
+    # Redis key of the mapping from content hash to snippet identifier
+    return f'hash:{code_hash}'
+
+
+# Glob-style pattern of the Redis keys of cached snippets, i.e. their identifiers
+# (the keys of their rendered bodies are prefixed with BODY_PREFIX)
+SNIPPET_KEY_PATTERN = '[0-9A-Za-z]' * PUBLIC_ID_LENGTH
 
 
 @app.options('/snippet')
@@ -197,52 +324,576 @@ async def snippet_options() -> Response:
     )
 
 
+@app.get('/examples')
+async def get_examples(
+    x_api_key: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    ) -> Response:
+    """Retrieve all bundled example snippets at once.
+
+    The response body is built whenever the examples are indexed (at startup), so
+    neither Redis nor the database is consulted.
+
+    Args:
+        x_api_key (Optional[str], optional): An API key provided by the frontend.
+            Defaults to Header(None).
+        if_none_match (Optional[str], optional): Entity tags of the examples cached
+            by the client. Defaults to Header(None).
+        accept_encoding (Optional[str], optional): The content codings accepted by
+            the client. Defaults to Header(None).
+
+    Returns:
+        Response: The identifier, name and code of each example, or 304 Not
+            Modified if the client already has them.
+    """
+    check_api_key(x_api_key, API_KEY)
+    return rendered_response(
+        if_none_match, accept_encoding, example_index.bundle,
+        cache_control = EXAMPLES_CACHE_CONTROL,
+    )
+
+
 @app.get('/snippet/{snippet_id}')
 async def get_snippet(
     snippet_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     x_api_key: Optional[str] = Header(None),
-    ) -> JSONResponse:
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    ) -> Response:
     """Retrieve a Gleam code snippet given a certain identifier.
 
     Args:
         snippet_id (str): The identifier of the saved Gleam code snippet.
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        db (AsyncSession, optional): A database session. Defaults to Depends(get_db).
         x_api_key (Optional[str], optional): An API key provided by the frontend.
             Defaults to Header(None).
+        if_none_match (Optional[str], optional): Entity tags of the snippet cached
+            by the client. Defaults to Header(None).
+        accept_encoding (Optional[str], optional): The content codings accepted by
+            the client. Defaults to Header(None).
 
     Raises:
         HTTPException: If the requested Gleam code snippet was not found.
 
     Returns:
-        JSONResponse: The requested Gleam code snippet.
+        Response: The requested Gleam code snippet and its run output (if known), or
+            304 Not Modified if the client already has it.
     """
     # Check if the given API is valid
     check_api_key(x_api_key, API_KEY)
-    # Try to retrieve the Gleam code snippet from cache
-    code = await redis_cache.get(key = snippet_id)
-    if code is None:
-            # Try to retrieve the Gleam code snippet from the database
-            db_snippet = crud.get_snippet(db, snippet_id = snippet_id)
+    # The bundled example snippets are indexed in memory. They may change with a new
+    # release, so they are revalidated
+    example = example_index.get(snippet_id)
+    record_lookup('examples', example is not None)
+    if example is not None:
+        return _snippet_response(
+            if_none_match, snippet_id, example.code, run_outputs.example(example),
+            cache_control = EXAMPLES_CACHE_CONTROL,
+        )
+    # Snippets are looked up by their public identifier, old links carry the UUID
+    # form of it. Identifiers of neither form can not exist
+    snippet_id = canonical_id(snippet_id)
+    if snippet_id is None:
+        raise HTTPException(status_code = 404, detail = 'Snippet not found')
+    # Shared snippets never change, so the client's copy is up to date if it was
+    # issued for this identifier and the snippet is known to exist in process
+    # (entity tags can be made up). No cache or database has to be consulted. These
+    # reads do not count towards popularity, the filter has false positives
+    etag = matching_snippet_etag(if_none_match, snippet_id)
+    if etag is not None and (
+        snippet_filter.contains(snippet_id)
+        or body_cache.get(snippet_id) is not None
+        or snippet_cache.get(snippet_id) is not None
+        or write_behind.get(snippet_id) is not None
+    ):
+        return not_modified_response(etag)
+    # Try the in-process cache first: The final response body of the snippet is
+    # sent as is, otherwise it is rendered from the code
+    rendered = body_cache.get(snippet_id)
+    code = snippet_cache.get(snippet_id) if rendered is None else None
+    record_lookup('l1', rendered is not None or code is not None)
+    if rendered is not None:
+        popularity.record(snippet_id)
+        return rendered_response(if_none_match, accept_encoding, rendered)
+    if code is not None:
+        popularity.record(snippet_id)
+        return await _render_response(
+            if_none_match, accept_encoding, snippet_id, code, run_cache.get(snippet_id),
+        )
+    # Snippets that were not persisted yet by this replica
+    code = write_behind.get(snippet_id)
+    if code is not None:
+        popularity.record(snippet_id)
+        return _snippet_response(if_none_match, snippet_id, code, run_cache.get(snippet_id))
+    # Identifiers that were recently looked up in vain
+    missing = missing_cache.get(snippet_id)
+    record_lookup('negative', missing is not None)
+    if missing is not None:
+        raise HTTPException(status_code = 404, detail = 'Snippet not found')
+    # Try to retrieve the rendered response body or the Gleam code snippet (or a
+    # marker that it does not exist, or a snippet that was not persisted yet by
+    # another replica) and its run output from cache in a single round trip
+    values = await redis_cache.mget(
+        body_key(snippet_id),
+        snippet_id,
+        missing_key(snippet_id),
+        pending_key(snippet_id),
+        run_key(snippet_id),
+        encoding = None,
+    )
+    body, code, missing, pending, run = values if values is not None else (None,) * 5
+    refill = None
+    record_lookup('redis', body is not None or code is not None or pending is not None)
+    if body is not None:
+        logging.debug(
+            f'REDIS: A rendered Gleam code snippet was retrieved with identifier: {snippet_id}'
+        )
+        rendered = decode_rendered(body)
+        body_cache.set(snippet_id, rendered)
+        popularity.record(snippet_id)
+        return rendered_response(if_none_match, accept_encoding, rendered)
+    if run is not None:
+        run = decode_cache_value(run)
+    if code is None and pending is not None:
+        logging.debug(
+            f'REDIS: An unpersisted Gleam code snippet was retrieved with identifier: {snippet_id}'
+        )
+        code = json.loads(pending)['code']
+    elif code is None:
+            if missing is not None:
+                missing_cache.set(snippet_id, True)
+                raise HTTPException(status_code = 404, detail = 'Snippet not found')
+            # Skip the database for identifiers that have never been stored. Snippets
+            # created by other replicas since the filter was built are not rejected
+            # (see SnippetFilter). It is bypassed while Redis is unavailable, as it
+            # was before identifiers were time-ordered
+            might_exist = values is None or snippet_filter.might_exist(snippet_id)
+            if values is not None:
+                record_lookup('filter', might_exist)
+            if not might_exist:
+                await _mark_missing(snippet_id)
+                raise HTTPException(status_code = 404, detail = 'Snippet not found')
+            # Try to retrieve the Gleam code snippet from the database (a read replica,
+            # or the primary)
+            db_snippet = await read_replicas.get_snippet(db, snippet_id = snippet_id)
+            record_lookup('db', db_snippet is not None)
             logging.debug(
                 f'DB   : A Gleam code snippet was retrieved with identifier: {snippet_id}'
             )
             if db_snippet is None:
-                # As a last resort, try to retrieve the Gleam code snippet from local file storage
-                filepath = await check_snippets(key = snippet_id)
-                if filepath is not None:
-                    code = await read_snippet(filepath = filepath)
-                else:
-                    logging.debug(
-                        f'     : No Gleam code snippet could be found with identifier: {snippet_id}'
-                    )
-                    raise HTTPException(status_code = 404, detail = 'Snippet not found')
+                logging.debug(
+                    f'     : No Gleam code snippet could be found with identifier: {snippet_id}'
+                )
+                await _mark_missing(snippet_id)
+                raise HTTPException(status_code = 404, detail = 'Snippet not found')
             else:
-                code = db_snippet.code
+                code = db_snippet.get_code()
+                run = db_snippet.runOutput
+                # Cache the Gleam code snippet (and its run output) again
+                refill = [('setex', snippet_id, REDIS_TTL, encode_cache_value(json.dumps(code)))]
+                if run is not None:
+                    refill.append(('setex', run_key(snippet_id), REDIS_TTL, encode_cache_value(run)))
     else:
         logging.debug(
             f'REDIS: A Gleam code snippet was retrieved with identifier: {snippet_id}'
         )
-        code = json.loads(code)
-    rv = {'fileName': None, 'code': code}
-    return JSONResponse(rv, 200)
\ No newline at end of file
+        code = json.loads(decode_cache_value(code))
+    snippet_cache.set(snippet_id, code)
+    if run is not None:
+        run_cache.set(snippet_id, run)
+    popularity.record(snippet_id)
+    return await _render_response(
+        if_none_match, accept_encoding, snippet_id, code, run, refill = refill,
+    )
+
+
+def _is_final(run: Optional[str]) -> bool:
+    # Without a run output the response may still change, unless outputs are
+    # never computed
+    return run is not None or not run_outputs.enabled
+
+
+def _snippet_response(
+    if_none_match: Optional[str],
+    snippet_id: str,
+    code: str,
+    run: Optional[str],
+    cache_control: str = IMMUTABLE_CACHE_CONTROL,
+    ) -> Response:
+    return conditional_snippet_response(
+        if_none_match, snippet_id, code, cache_control, run = run, final = _is_final(run),
+    )
+
+
+async def _render_response(
+    if_none_match: Optional[str],
+    accept_encoding: Optional[str],
+    snippet_id: str,
+    code: str,
+    run: Optional[str],
+    refill: Optional[List[Tuple[Any, ...]]] = None,
+    ) -> Response:
+    """Respond with a snippet, and cache its rendered response body if it is final.
+
+    Args:
+        if_none_match (Optional[str]): Entity tags of the snippet cached by the client.
+        accept_encoding (Optional[str]): The content codings accepted by the client.
+        snippet_id (str): The identifier of the snippet.
+        code (str): The code of the snippet.
+        run (Optional[str]): The run output (JSON) of the snippet.
+        refill (Optional[List[Tuple[Any, ...]]], optional): Redis commands caching the
+            code and run output, only sent if the body is not cached in their place.
+            Defaults to None.
+
+    Returns:
+        Response: The response.
+    """
+    if not _is_final(run):
+        if refill:
+            await redis_cache.pipeline(*refill)
+        return _snippet_response(if_none_match, snippet_id, code, run)
+    rendered = render_snippet(snippet_id, code, run = run)
+    body_cache.set(snippet_id, rendered)
+    # The body holds the code and the run output, so it replaces their entries
+    # rather than being cached next to them
+    await redis_cache.pipeline(
+        ('setex', body_key(snippet_id), REDIS_TTL, encode_rendered(rendered)),
+        ('delete', snippet_id, run_key(snippet_id)),
+    )
+    return rendered_response(if_none_match, accept_encoding, rendered)
+
+
+async def _mark_missing(snippet_id: str) -> None:
+    """Remember for a short while that a Gleam code snippet does not exist.
+
+    Args:
+        snippet_id (str): The identifier that could not be found.
+    """
+    missing_cache.set(snippet_id, True)
+    await redis_cache.set(
+        key = missing_key(snippet_id),
+        value = '1',
+        expire = NEGATIVE_CACHE_TTL,
+    )
+
+
+@app.post('/snippets:batchGet')
+async def batch_get_snippets(
+    request: schemas.BatchGetSnippets,
+    db: AsyncSession = Depends(get_db),
+    x_api_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """Retrieve many Gleam code snippets at once.
+
+    Every cache tier is queried once for all identifiers: a single Redis MGET, and a
+    single database query for the identifiers that were not found in Redis.
+
+    Args:
+        request (schemas.BatchGetSnippets): The identifiers of the snippets.
+        db (AsyncSession, optional): A database session. Defaults to Depends(get_db).
+        x_api_key (Optional[str], optional): An API key provided by the frontend.
+            Defaults to Header(None).
+
+    Raises:
+        HTTPException: If more than BATCH_GET_MAX_IDS identifiers were requested.
+
+    Returns:
+        JSONResponse: The snippets that were found by identifier, and the
+            identifiers that were not.
+    """
+    # Check if the given API is valid
+    check_api_key(x_api_key, API_KEY)
+    # Remove duplicates but keep the order of the identifiers
+    snippet_ids = list(dict.fromkeys(request.ids))
+    if len(snippet_ids) > BATCH_GET_MAX_IDS:
+        raise HTTPException(
+            status_code = 400,
+            detail = f'At most {BATCH_GET_MAX_IDS} snippets can be retrieved at once',
+        )
+    # Snippets are looked up by their public identifier, old links carry the UUID
+    # form of it (the bundled examples keep theirs). Identifiers of neither form
+    # can not exist
+    lookup_ids = {
+        snippet_id: snippet_id if example_index.get(snippet_id) is not None
+        else canonical_id(snippet_id)
+        for snippet_id in snippet_ids
+    }
+    found = {}
+    missing = set()
+    unresolved = []
+    for snippet_id in dict.fromkeys(lookup_ids.values()):
+        if snippet_id is None:
+            continue
+        code = snippet_cache.get(snippet_id)
+        record_lookup('l1', code is not None)
+        if code is None:
+            example = example_index.get(snippet_id)
+            record_lookup('examples', example is not None)
+            code = example.code if example is not None else write_behind.get(snippet_id)
+        if code is not None:
+            found[snippet_id] = code
+            continue
+        is_missing = missing_cache.get(snippet_id)
+        record_lookup('negative', is_missing is not None)
+        if is_missing is not None:
+            missing.add(snippet_id)
+        else:
+            unresolved.append(snippet_id)
+    # Snippets (their code or rendered body), markers that they do not exist and
+    # unpersisted snippets of all remaining identifiers in a single round trip
+    values = None
+    if unresolved:
+        values = await redis_cache.mget(
+            *[
+                key for snippet_id in unresolved
+                for key in (
+                    snippet_id, body_key(snippet_id), missing_key(snippet_id),
+                    pending_key(snippet_id),
+                )
+            ],
+            encoding = None,
+        )
+    redis_available = values is not None
+    if values is None:
+        values = [None] * (4 * len(unresolved))
+    uncached = []
+    refill = []
+    for i, snippet_id in enumerate(unresolved):
+        code, body, is_missing, pending = values[4 * i:4 * i + 4]
+        record_lookup('redis', code is not None or body is not None or pending is not None)
+        if code is not None:
+            found[snippet_id] = json.loads(decode_cache_value(code))
+        elif body is not None:
+            rendered = decode_rendered(body)
+            body_cache.set(snippet_id, rendered)
+            found[snippet_id] = rendered_code(rendered)
+        elif pending is not None:
+            found[snippet_id] = json.loads(pending)['code']
+        elif is_missing is not None:
+            missing_cache.set(snippet_id, True)
+            missing.add(snippet_id)
+        else:
+            # The filter is only trusted if Redis was consulted (see get_snippet)
+            might_exist = not redis_available or snippet_filter.might_exist(snippet_id)
+            if redis_available:
+                record_lookup('filter', might_exist)
+            if might_exist:
+                uncached.append(snippet_id)
+            else:
+                missing.add(snippet_id)
+                missing_cache.set(snippet_id, True)
+                refill.append(('setex', missing_key(snippet_id), NEGATIVE_CACHE_TTL, '1'))
+    # Retrieve the remaining Gleam code snippets from the database in a single query
+    if uncached:
+        db_snippets = await read_replicas.get_snippets(db, snippet_ids = uncached)
+        logging.debug(
+            f'DB   : {len(db_snippets)} of {len(uncached)} Gleam code snippets were retrieved'
+        )
+        for db_snippet in db_snippets:
+            found[db_snippet.snippetID] = db_snippet.get_code()
+        for snippet_id in uncached:
+            record_lookup('db', snippet_id in found)
+            if snippet_id in found:
+                refill.append(
+                    ('setex', snippet_id, REDIS_TTL, encode_cache_value(json.dumps(found[snippet_id])))
+                )
+            else:
+                missing.add(snippet_id)
+                missing_cache.set(snippet_id, True)
+                refill.append(('setex', missing_key(snippet_id), NEGATIVE_CACHE_TTL, '1'))
+    # Refill Redis with everything that was not cached in one round trip
+    if refill:
+        await redis_cache.pipeline(*refill)
+    for snippet_id, code in found.items():
+        snippet_cache.set(snippet_id, code)
+        if example_index.get(snippet_id) is None:
+            popularity.record(snippet_id)
+    rv = {
+        'snippets': {
+            snippet_id: {'fileName': None, 'code': found[lookup_ids[snippet_id]]}
+            for snippet_id in snippet_ids if lookup_ids[snippet_id] in found
+        },
+        'missing': [
+            snippet_id for snippet_id in snippet_ids
+            if lookup_ids[snippet_id] is None or lookup_ids[snippet_id] in missing
+        ],
+    }
+    return JSONResponse(rv, 200)
+
+
+@app.get('/metrics')
+async def metrics() -> Response:
+    """Expose Prometheus metrics (e.g. lookups per cache tier).
+
+    Returns:
+        Response: The metrics in the Prometheus text format.
+    """
+    return Response(generate_latest(), 200, media_type = CONTENT_TYPE_LATEST)
+
+
+@app.get('/admin/cache')
+async def cache_stats(
+    x_admin_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """Report the hit ratio of each cache tier and the state of the in-process cache.
+
+    Args:
+        x_admin_key (Optional[str], optional): The admin key. Defaults to Header(None).
+
+    Returns:
+        JSONResponse: Hits, misses and hit ratios per tier.
+    """
+    check_admin_key(x_admin_key, ADMIN_KEY)
+    rv = {
+        'tiers': hit_ratios(),
+        'l1': {
+            'entries': len(snippet_cache),
+            'size': snippet_cache.size,
+            'max_size': snippet_cache.max_bytes,
+        },
+        'redis': {
+            'breaker': redis_cache.breaker.state,
+        },
+    }
+    return JSONResponse(rv, 200)
+
+
+@app.get('/admin/hot')
+async def hot_snippets(
+    limit: int = 50,
+    x_admin_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """List the most popular Gleam code snippets.
+
+    Args:
+        limit (int, optional): The number of snippets to list. Defaults to 50.
+        x_admin_key (Optional[str], optional): The admin key. Defaults to Header(None).
+
+    Returns:
+        JSONResponse: The estimated number of reads and the remaining Redis TTL (in
+            seconds, negative if not cached) of each snippet, most popular first.
+    """
+    check_admin_key(x_admin_key, ADMIN_KEY)
+    top = await popularity.top(max(min(limit, 1000), 1))
+    ttls = await cached_ttls([snippet_id for snippet_id, _ in top])
+    rv = {
+        'snippets': [
+            {
+                'snippetID': snippet_id,
+                'reads': score,
+                'hot': score >= popularity.hot_threshold,
+                'ttl': ttl,
+            }
+            for (snippet_id, score), ttl in zip(top, ttls)
+        ],
+    }
+    return JSONResponse(rv, 200)
+
+
+async def scan_snippets(cursor: int, count: int) -> Tuple[int, List[str]]:
+    # A page of the identifiers of snippets cached in Redis (as their code or their
+    # rendered body), see 'RedisCache.scan'. A SCAN pattern can not match both
+    # forms of keys, so they are told apart here
+    rv = await redis_cache.scan(cursor, count = max(min(count, 10000), 1))
+    if rv is None:
+        raise HTTPException(status_code = 503, detail = 'Redis is unavailable')
+    snippet_ids = []
+    for key in rv[1]:
+        snippet_id = key[len(BODY_PREFIX):] if key.startswith(BODY_PREFIX) else key
+        if fnmatch.fnmatchcase(snippet_id, SNIPPET_KEY_PATTERN):
+            snippet_ids.append(snippet_id)
+    return int(rv[0]), list(dict.fromkeys(snippet_ids))
+
+
+async def cached_ttls(snippet_ids: List[str]) -> List[Optional[int]]:
+    # The remaining Redis TTL of each snippet, cached as its code or its rendered
+    # body (negative if it is not cached, None if Redis is unavailable)
+    if not snippet_ids:
+        return []
+    rv = await redis_cache.pipeline(
+        *[('ttl', key) for snippet_id in snippet_ids for key in (snippet_id, body_key(snippet_id))]
+    )
+    if rv is None:
+        return [None] * len(snippet_ids)
+    return [max(rv[2 * i], rv[2 * i + 1]) for i in range(len(snippet_ids))]
+
+
+@app.get('/admin/snippets')
+async def cached_snippets(
+    cursor: int = 0,
+    count: int = REDIS_SCAN_COUNT,
+    x_admin_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """List the Gleam code snippets cached in Redis, a page at a time.
+
+    Args:
+        cursor (int, optional): The cursor of the page, as returned with the previous
+            one. Defaults to 0 (the first page).
+        count (int, optional): The number of Redis keys to look at. Defaults to
+            REDIS_SCAN_COUNT.
+        x_admin_key (Optional[str], optional): The admin key. Defaults to Header(None).
+
+    Returns:
+        JSONResponse: The cursor of the next page (0 after the last one) and the
+            remaining Redis TTL (in seconds) of each snippet of this page. Pages may
+            be empty before the last one.
+    """
+    check_admin_key(x_admin_key, ADMIN_KEY)
+    cursor, snippet_ids = await scan_snippets(cursor, count)
+    ttls = await cached_ttls(snippet_ids)
+    rv = {
+        'cursor': cursor,
+        'snippets': [
+            {'snippetID': snippet_id, 'ttl': ttl}
+            for snippet_id, ttl in zip(snippet_ids, ttls)
+        ],
+    }
+    return JSONResponse(rv, 200)
+
+
+@app.post('/admin/snippets:expire')
+async def expire_cached_snippets(
+    cursor: int = 0,
+    count: int = REDIS_SCAN_COUNT,
+    ttl: int = 0,
+    x_admin_key: Optional[str] = Header(None),
+    ) -> JSONResponse:
+    """Set the Redis TTL of the cached Gleam code snippets of a page.
+
+    Snippets stay in the database, and in the in-process caches of the replicas
+    until these expire. Call again with the returned cursor until it is 0 to
+    expire all cached snippets.
+
+    Args:
+        cursor (int, optional): The cursor of the page, as returned with the previous
+            one. Defaults to 0 (the first page).
+        count (int, optional): The number of Redis keys to look at. Defaults to
+            REDIS_SCAN_COUNT.
+        ttl (int, optional): The new TTL in seconds, 0 to remove the snippets from
+            Redis right away. Defaults to 0.
+        x_admin_key (Optional[str], optional): The admin key. Defaults to Header(None).
+
+    Returns:
+        JSONResponse: The cursor of the next page (0 after the last one) and the
+            number of snippets expired.
+    """
+    check_admin_key(x_admin_key, ADMIN_KEY)
+    if ttl < 0:
+        raise HTTPException(status_code = 400, detail = 'The TTL must not be negative')
+    cursor, snippet_ids = await scan_snippets(cursor, count)
+    # Along with the run outputs and rendered bodies of the snippets
+    keys = [
+        key for snippet_id in snippet_ids
+        for key in (snippet_id, run_key(snippet_id), body_key(snippet_id))
+    ]
+    rv = await redis_cache.pipeline(*[('expire', _, ttl) for _ in keys]) if keys else []
+    if rv is None:
+        raise HTTPException(status_code = 503, detail = 'Redis is unavailable')
+    # Snippets whose code or rendered body was cached
+    expired = sum(
+        1 for i in range(len(snippet_ids)) if int(rv[3 * i]) or int(rv[3 * i + 2])
+    )
+    logging.debug(f'REDIS: Set the TTL of {expired} cached snippets to {ttl}s')
+    return JSONResponse({'cursor': cursor, 'expired': expired}, 200)
@@ -0,0 +1,65 @@
+"""
+Python script for maintenance tasks of the share service that are run by hand.
+
+Examples:
+    python manage.py migrate
+    python manage.py compress --batch_size 500
+"""
+import argparse
+import asyncio
+import logging
+from database import SessionLocal, engine
+from migrations import bootstrap
+import crud
+
+
+def parse_commandline_args(args_list = None):
+    """ Setup, parse and validate given commandline arguments.
+    """
+    parser = argparse.ArgumentParser(description = "")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    subparsers.add_parser("migrate",
+        help = "Create the database tables or bring them up to date (run on deployment).",
+    )
+    compress_parser = subparsers.add_parser("compress",
+        help = "Compress the code of existing large snippets in the database.",
+    )
+    compress_parser.add_argument("-batch_size", "--batch_size",
+        required = False,
+        default = 500,
+        type = int,
+        help = "Specify the number of snippets to process per transaction.",
+    )
+    args = parser.parse_args(args_list)
+    return args
+
+
+async def migrate() -> None:
+    await bootstrap(engine)
+    logging.info('The database schema is up to date')
+    await engine.dispose()
+
+
+async def compress(batch_size: int) -> None:
+    after = None; batches = 0
+    while True:
+        async with SessionLocal() as db:
+            after = await crud.compress_snippets(db, batch_size = batch_size, after = after)
+        if after is None:
+            break
+        batches += 1
+        logging.info(f'Compressed batch {batches}, last identifier: {after}')
+    await engine.dispose()
+
+
+def main(args):
+    if args.command == "migrate":
+        asyncio.run(migrate())
+    elif args.command == "compress":
+        asyncio.run(compress(batch_size = args.batch_size))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    args = parse_commandline_args()
+    main(args = args)
@@ -0,0 +1,225 @@
+"""
+In-process store implementing the subset of the aioredis 1.3 client used by the
+share service. It takes the place of Redis for the embedded storage backend (and
+'REDIS_URL=memory://'), such that a single replica runs without a Redis server.
+
+Values are stored as bytes and decoded with the 'encoding' of a command (UTF-8 by
+default, like the Redis pool), expiry is checked lazily. The number of keys can be
+bounded, like Redis' 'volatile-ttl' policy the keys closest to expiring are evicted.
+"""
+import fnmatch
+import heapq
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+_NOTSET = object()
+
+
+def _to_bytes(value: Any) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+class MemoryStore:
+
+    def __init__(
+        self,
+        encoding: Optional[str] = "utf-8",
+        sweep_interval: int = 10000,
+        max_keys: Optional[int] = None,
+    ) -> None:
+        self.encoding = encoding
+        # Key -> (value, expiry as a timestamp or None)
+        self.data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        # Expired keys that are never read again are dropped every so many writes
+        self.sweep_interval = sweep_interval
+        self._writes = 0
+        # At most this many keys are kept (None for no limit), see '_evict'
+        self.max_keys = max_keys
+
+    def _sweep(self) -> None:
+        self._writes += 1
+        if self._writes >= self.sweep_interval:
+            self._writes = 0
+            self._drop_expired()
+        # Called before a write, which may add a key
+        if self.max_keys is not None and len(self.data) >= self.max_keys:
+            self._evict()
+
+    def _drop_expired(self) -> None:
+        now = time.time()
+        for key, (_, expires) in list(self.data.items()):
+            if expires is not None and expires <= now:
+                del self.data[key]
+
+    def _evict(self) -> None:
+        # Expired keys go first, then the ones closest to expiring until a tenth of
+        # the limit is free again, such that not every write evicts. Keys without
+        # an expiry are never evicted
+        self._drop_expired()
+        target = self.max_keys - self.max_keys // 10
+        excess = len(self.data) - target
+        if excess <= 0:
+            return
+        volatile = (
+            (expires, key) for key, (_, expires) in self.data.items() if expires is not None
+        )
+        for _, key in heapq.nsmallest(excess, volatile):
+            del self.data[key]
+
+    def _decode(self, value: Optional[bytes], encoding = _NOTSET) -> Any:
+        encoding = self.encoding if encoding is _NOTSET else encoding
+        if value is None or encoding is None:
+            return value
+        return value.decode(encoding)
+
+    def _get(self, key: str) -> Any:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def _container(self, key: str, factory):
+        value = self._get(key)
+        if value is None:
+            value = factory()
+            self.data[key] = (value, None)
+        return value
+
+    async def ping(self) -> bytes:
+        return b"PONG"
+
+    async def get(self, key: str, encoding = _NOTSET) -> Any:
+        return self._decode(self._get(key), encoding)
+
+    async def mget(self, key: str, *keys: str, encoding = _NOTSET) -> List[Any]:
+        return [self._decode(self._get(_), encoding) for _ in (key, *keys)]
+
+    async def set(self, key: str, value: Any, *, expire: int = 0) -> bool:
+        self._sweep()
+        self.data[key] = (_to_bytes(value), time.time() + expire if expire else None)
+        return True
+
+    async def setex(self, key: str, seconds: int, value: Any) -> bool:
+        return await self.set(key, value, expire = seconds)
+
+    async def delete(self, key: str, *keys: str) -> int:
+        return sum(self.data.pop(_, None) is not None for _ in (key, *keys))
+
+    async def expire(self, key: str, timeout: int) -> int:
+        value = self._get(key)
+        if value is None:
+            return 0
+        self.data[key] = (value, time.time() + timeout)
+        return 1
+
+    async def ttl(self, key: str) -> int:
+        if self._get(key) is None:
+            return -2
+        expires = self.data[key][1]
+        return -1 if expires is None else int(expires - time.time())
+
+    async def scan(
+        self,
+        cursor: int = 0,
+        match: Optional[str] = None,
+        count: Optional[int] = None,
+    ) -> Tuple[int, List[Any]]:
+        # The cursor is a position in the sorted keys. Expired keys are skipped but
+        # kept, such that expiring keys during a scan does not move later pages
+        keys = sorted(self.data)
+        stop = cursor + (count or 10)
+        now = time.time()
+        page = [
+            self._decode(_to_bytes(key)) for key in keys[cursor:stop]
+            if (match is None or fnmatch.fnmatchcase(key, match))
+            and (self.data[key][1] is None or self.data[key][1] > now)
+        ]
+        return (stop if stop < len(keys) else 0, page)
+
+    async def sadd(self, key: str, member: Any, *members: Any) -> int:
+        s = self._container(key, set)
+        added = {_to_bytes(_) for _ in (member, *members)} - s
+        s.update(added)
+        return len(added)
+
+    async def srem(self, key: str, member: Any, *members: Any) -> int:
+        s = self._container(key, set)
+        removed = {_to_bytes(_) for _ in (member, *members)} & s
+        s.difference_update(removed)
+        return len(removed)
+
+    async def smembers(self, key: str, *, encoding = _NOTSET) -> List[Any]:
+        return [self._decode(_, encoding) for _ in self._get(key) or set()]
+
+    async def zincrby(self, key: str, increment: float, member: Any) -> float:
+        z = self._container(key, dict)
+        member = _to_bytes(member)
+        z[member] = z.get(member, 0.0) + float(increment)
+        return z[member]
+
+    def _ranked(self, key: str, reverse: bool) -> List[Tuple[bytes, float]]:
+        z = self._get(key) or {}
+        return sorted(z.items(), key = lambda _: (_[1], _[0]), reverse = reverse)
+
+    @staticmethod
+    def _slice(items: List[Any], start: int, stop: int) -> List[Any]:
+        stop = len(items) + stop if stop < 0 else stop
+        return items[start:stop + 1]
+
+    async def zrevrange(
+        self,
+        key: str,
+        start: int,
+        stop: int,
+        withscores: bool = False,
+        encoding = _NOTSET,
+    ) -> List[Any]:
+        items = self._slice(self._ranked(key, reverse = True), start, stop)
+        if withscores:
+            return [(self._decode(m, encoding), s) for m, s in items]
+        return [self._decode(m, encoding) for m, _ in items]
+
+    async def zremrangebyrank(self, key: str, start: int, stop: int) -> int:
+        z = self._get(key) or {}
+        items = self._slice(self._ranked(key, reverse = False), start, stop)
+        for member, _ in items:
+            del z[member]
+        return len(items)
+
+    def pipeline(self) -> "_Pipeline":
+        return _Pipeline(self)
+
+    def multi_exec(self) -> "_Pipeline":
+        # Commands of the store never interleave, so a transaction is a pipeline
+        return _Pipeline(self)
+
+    def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class _Pipeline:
+
+    def __init__(self, redis: MemoryStore) -> None:
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    async def execute(self) -> List[Any]:
+        return [
+            await getattr(self.redis, name)(*args, **kwargs)
+            for name, args, kwargs in self.commands
+        ]
@@ -0,0 +1,88 @@
+from typing import Dict
+from prometheus_client import Counter, Gauge, Histogram
+
+
+# Lookups per cache/storage tier ('l1', 'examples', 'negative', 'redis', 'filter',
+# 'replica' and 'db'). For the existence filter a hit means the snippet might exist
+CACHE_LOOKUPS = Counter(
+    'gleam_playground_share_cache_lookups_total',
+    'Snippet lookups per tier and outcome.',
+    ['tier', 'result'],
+)
+
+# Latency of Redis commands, including the ones that timed out or failed
+REDIS_COMMAND_SECONDS = Histogram(
+    'gleam_playground_share_redis_command_seconds',
+    'Latency of Redis commands.',
+    ['command'],
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+REDIS_COMMAND_ERRORS = Counter(
+    'gleam_playground_share_redis_command_errors_total',
+    'Redis commands that timed out or failed.',
+    ['command'],
+)
+# Redis commands that were skipped since the circuit breaker was open
+REDIS_COMMANDS_SKIPPED = Counter(
+    'gleam_playground_share_redis_commands_skipped_total',
+    'Redis commands skipped by the circuit breaker.',
+    ['command'],
+)
+# 0 = closed, 1 = half-open, 2 = open
+BREAKER_STATE = Gauge(
+    'gleam_playground_share_breaker_state',
+    'State of the circuit breaker of a dependency.',
+    ['dependency'],
+)
+
+# Database connection pool
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'gleam_playground_share_db_pool_checkout_seconds',
+    'Time spent waiting for a database connection.',
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'gleam_playground_share_db_pool_checked_out',
+    'Database connections currently in use.',
+)
+DB_POOL_SATURATION = Gauge(
+    'gleam_playground_share_db_pool_saturation',
+    'Share of the maximum number of database connections in use.',
+)
+# Connections that were opened, closed or invalidated (e.g. by a failed pre-ping)
+DB_POOL_CONNECTIONS = Counter(
+    'gleam_playground_share_db_pool_connections_total',
+    'Database connection churn.',
+    ['event'],
+)
+
+# Read replicas: Seconds a replica is behind the primary (by replica number, the
+# order of DATABASE_REPLICA_URLS), -1 if it can not be reached
+DB_REPLICA_LAG_SECONDS = Gauge(
+    'gleam_playground_share_db_replica_lag_seconds',
+    'Replication lag of the read replicas.',
+    ['replica'],
+)
+
+# In-process copy of the counts above, used to report hit ratios directly
+_lookups: Dict[str, Dict[str, int]] = {}
+
+
+def record_lookup(tier: str, hit: bool) -> None:
+    result = 'hit' if hit else 'miss'
+    CACHE_LOOKUPS.labels(tier = tier, result = result).inc()
+    counts = _lookups.setdefault(tier, {'hit': 0, 'miss': 0})
+    counts[result] += 1
+
+
+def hit_ratios() -> Dict[str, Dict[str, float]]:
+    """Return the number of hits and misses and the hit ratio of each tier."""
+    ratios = {}
+    for tier, counts in _lookups.items():
+        total = counts['hit'] + counts['miss']
+        ratios[tier] = {
+            'hits': counts['hit'],
+            'misses': counts['miss'],
+            'ratio': counts['hit'] / total if total else 0.0,
+        }
+    return ratios
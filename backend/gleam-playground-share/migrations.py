@@ -0,0 +1,94 @@
+import logging
+from typing import Callable, List, Tuple
+from sqlalchemy import LargeBinary, String, inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+import models
+
+
+def _add_content_hash(connection: Connection) -> None:
+    connection.exec_driver_sql('ALTER TABLE snippet ADD COLUMN "contentHash" VARCHAR(64)')
+    # Existing rows keep a NULL hash (they may contain duplicates), NULLs never
+    # conflict with each other in a unique index
+    connection.exec_driver_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_snippet_contentHash" ON snippet ("contentHash")'
+    )
+
+
+def _add_code_blob(connection: Connection) -> None:
+    column_type = LargeBinary().compile(dialect = connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE snippet ADD COLUMN "codeBlob" {column_type}')
+
+
+def _add_run_output(connection: Connection) -> None:
+    connection.exec_driver_sql('ALTER TABLE snippet ADD COLUMN "runOutput" TEXT')
+
+
+def _compact_snippet_id(connection: Connection) -> None:
+    # Identifiers were stored as 36 character strings, they are stored in 16 bytes
+    # (see 'models.CompactUUID')
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(
+            'ALTER TABLE snippet ALTER COLUMN "snippetID" TYPE uuid USING "snippetID"::uuid'
+        )
+        return
+    # SQLite can not change the type of a column, the table is copied instead
+    table = models.Snippet.__table__
+    columns = [_.name for _ in table.columns]
+    connection.exec_driver_sql('ALTER TABLE snippet RENAME TO snippet_old')
+    table.create(connection)
+    rows = connection.exec_driver_sql(
+        'SELECT ' + ', '.join(f'"{_}"' for _ in columns) + ' FROM snippet_old'
+    )
+    while True:
+        batch = rows.fetchmany(1000)
+        if not batch:
+            break
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in batch])
+    connection.exec_driver_sql('DROP TABLE snippet_old')
+
+
+# Schema changes of the 'snippet' table that 'create_all' does not apply to tables
+# that already exist: (column, migration adding it)
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ('contentHash', _add_content_hash),
+    ('codeBlob', _add_code_blob),
+    ('runOutput', _add_run_output),
+]
+
+
+# Postgres advisory lock held while the schema is created or migrated
+BOOTSTRAP_LOCK_ID = 0x5eed5
+
+
+def migrate(connection: Connection) -> None:
+    """Bring an existing 'snippet' table up to date with the models.
+
+    Meant to be run through 'AsyncConnection.run_sync' after 'create_all'.
+
+    Args:
+        connection (Connection): A database connection inside a transaction.
+    """
+    columns = {_['name']: _ for _ in inspect(connection).get_columns('snippet')}
+    for column, migration in MIGRATIONS:
+        if column not in columns:
+            logging.debug(f'DB   : Migrating table snippet, adding column: {column}')
+            migration(connection)
+    if isinstance(columns['snippetID']['type'], String):
+        logging.debug('DB   : Migrating table snippet, compacting column: snippetID')
+        _compact_snippet_id(connection)
+
+
+async def bootstrap(engine: AsyncEngine) -> None:
+    """Create missing tables and bring existing ones up to date.
+
+    Args:
+        engine (AsyncEngine): The engine of the database.
+    """
+    async with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Replicas starting at the same time would otherwise apply the same
+            # migrations concurrently. The lock is released with the transaction
+            await conn.exec_driver_sql(f'SELECT pg_advisory_xact_lock({BOOTSTRAP_LOCK_ID})')
+        await conn.run_sync(models.Base.metadata.create_all)
+        await conn.run_sync(migrate)
@@ -1,7 +1,54 @@
-from sqlalchemy import Text, String, Column
+import uuid
+from sqlalchemy import Text, String, Column, LargeBinary
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import TypeDecorator
 from database import Base
+from compression import decode_column
+from ids import public_id, to_uuid
+
+
+class CompactUUID(TypeDecorator):
+    """A snippet identifier stored in 16 bytes instead of as a 36 character string.
+
+    Postgres has a native UUID type, other databases (SQLite) store the bytes as is.
+    Identifiers are bound in either form and loaded as public identifiers (see 'ids').
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.UUID(as_uuid = True))
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = to_uuid(value)
+        return value if dialect.name == 'postgresql' else value.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(bytes = bytes(value))
+        return public_id(value)
+
 
 class Snippet(Base):
     __tablename__ = "snippet"
+    # Small snippets are stored as text, large ones compressed in 'codeBlob'
     code = Column(Text)
-    snippetID = Column(String, primary_key = True)
+    codeBlob = Column(LargeBinary, nullable = True)
+    snippetID = Column(CompactUUID, primary_key = True)
+    # SHA-256 of the code, identical code is only ever stored once. Snippets shared
+    # before deduplication was introduced have no hash
+    contentHash = Column(String(64), unique = True, nullable = True)
+    # Output of running the snippet (JSON: toolchain version, events and formatted
+    # code), stored once it is known
+    runOutput = Column(Text, nullable = True)
+
+    def get_code(self) -> str:
+        return decode_column(self.code, self.codeBlob)
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import random
+from collections import Counter
+from typing import List, Tuple
+from database import RedisCache, redis_cache
+from httpcache import body_key
+from runoutput import run_key
+from settings import (
+    REDIS_TTL,
+    POPULARITY_ENABLED,
+    POPULARITY_SAMPLE_RATE,
+    POPULARITY_FLUSH_INTERVAL,
+    POPULARITY_HOT_THRESHOLD,
+    POPULARITY_MAX_TTL,
+    POPULARITY_MAX_TRACKED,
+)
+
+
+# Redis sorted set of snippet identifiers scored by their (estimated) number of reads
+POPULAR_KEY = 'snippets:popular'
+
+
+class PopularityTracker:
+    """Count snippet reads and keep popular snippets cached for longer.
+
+    Reads are sampled and counted in process, and added to a Redis sorted set shared
+    by all replicas in pipelined batches. After each batch the Redis TTL of the hot
+    snippets (at least 'hot_threshold' estimated reads) is extended in proportion to
+    their popularity.
+
+    Args:
+        redis_cache (RedisCache): The Redis cache holding the sorted set.
+        sample_rate (float): The fraction of reads that is counted.
+        flush_interval (float): Seconds between batches.
+        hot_threshold (float): Estimated reads from which a snippet is hot.
+        max_ttl (int): The maximum TTL (in seconds) of hot snippets.
+        max_tracked (int): The maximum number of snippets kept in the sorted set.
+        enabled (bool, optional): Whether reads are counted at all. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        redis_cache: RedisCache,
+        sample_rate: float,
+        flush_interval: float,
+        hot_threshold: float,
+        max_ttl: int,
+        max_tracked: int,
+        enabled: bool = True,
+    ) -> None:
+        self.redis_cache = redis_cache
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.hot_threshold = hot_threshold
+        self.max_ttl = max_ttl
+        self.max_tracked = max_tracked
+        self.enabled = enabled
+        self.counts: Counter = Counter()
+        self._task = None
+
+    def record(self, snippet_id: str) -> None:
+        # Without the periodic flush the counts would never be cleared
+        if not self.enabled:
+            return
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.counts[snippet_id] += 1
+
+    def ttl(self, score: float) -> int:
+        """The Redis TTL of a snippet given its estimated number of reads."""
+        if score < self.hot_threshold:
+            return REDIS_TTL
+        return int(min(REDIS_TTL * score / self.hot_threshold, self.max_ttl))
+
+    async def flush(self) -> None:
+        if not self.counts:
+            return
+        counts, self.counts = self.counts, Counter()
+        snippet_ids = list(counts)
+        # Every sampled read stands for 1 / sample_rate reads
+        scores = await self.redis_cache.pipeline(
+            *[
+                ('zincrby', POPULAR_KEY, counts[snippet_id] / self.sample_rate, snippet_id)
+                for snippet_id in snippet_ids
+            ],
+            # Forget all but the most popular snippets
+            ('zremrangebyrank', POPULAR_KEY, 0, -self.max_tracked - 1),
+        )
+        if scores is None:
+            return
+        # The run outputs and rendered bodies of snippets are cached as long as their code
+        expire = [
+            ('expire', key, self.ttl(float(score)))
+            for snippet_id, score in zip(snippet_ids, scores)
+            if float(score) >= self.hot_threshold
+            for key in (snippet_id, run_key(snippet_id), body_key(snippet_id))
+        ]
+        if expire:
+            await self.redis_cache.pipeline(*expire)
+        logging.debug(
+            f'REDIS: Counted reads of {len(snippet_ids)} snippets, {len(expire) // 3} of them are hot'
+        )
+
+    async def top(self, n: int) -> List[Tuple[str, float]]:
+        """Return the 'n' most popular snippet identifiers and their scores."""
+        rv = await self.redis_cache.zrevrange(POPULAR_KEY, 0, n - 1, withscores = True)
+        return [(snippet_id, float(score)) for snippet_id, score in rv or []]
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.debug(f'REDIS: Snippet reads could not be counted: {e}')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+popularity = PopularityTracker(
+    redis_cache = redis_cache,
+    sample_rate = POPULARITY_SAMPLE_RATE,
+    flush_interval = POPULARITY_FLUSH_INTERVAL,
+    hot_threshold = POPULARITY_HOT_THRESHOLD,
+    max_ttl = POPULARITY_MAX_TTL,
+    max_tracked = POPULARITY_MAX_TRACKED,
+    enabled = POPULARITY_ENABLED,
+)
@@ -0,0 +1,215 @@
+import asyncio
+import itertools
+import logging
+from typing import List, Optional
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from cache import LRUCache
+from metrics import DB_REPLICA_LAG_SECONDS, record_lookup
+from storage import storage_backend
+import crud, models
+from settings import (
+    DATABASE_REPLICA_URLS,
+    REPLICA_MAX_LAG,
+    REPLICA_CHECK_INTERVAL,
+    REPLICA_RECENT_TTL,
+    REPLICA_RECENT_MAX_ENTRIES,
+)
+
+
+# Seconds a Postgres standby is behind: 0 if it replayed everything it received
+# (or is no standby at all), otherwise the age of the last transaction it replayed
+LAG_QUERY = (
+    'SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+    'THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0)'
+)
+
+
+class ReadReplicas:
+    """Read replicas of the database that serve snippet lookups.
+
+    Lookups are spread over the replicas in turn, everything else (and lookups while
+    no replica is usable) uses the primary. A replica is skipped while it lags more
+    than 'max_lag' seconds or can not be reached, which is checked periodically.
+
+    Replication is asynchronous, so a snippet may not have reached a replica right
+    after it was created. Snippets created by this replica of the service are looked
+    up on the primary for 'recent_ttl' seconds, and snippets a replica does not
+    know are looked up on the primary again. Snippets created by other replicas of
+    the service are cached in Redis (or pending, with write-behind) meanwhile, so
+    their lookups rarely reach the database at all.
+
+    Args:
+        urls (List[str]): The addresses of the replicas, empty to read from the
+            primary only.
+        max_lag (float): Seconds a replica may be behind the primary.
+        check_interval (float): Seconds between checks of the lag.
+        recent_ttl (float): Seconds a created snippet is looked up on the primary.
+        recent_max_entries (int): The maximum number of such snippets.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        max_lag: float,
+        check_interval: float,
+        recent_ttl: float,
+        recent_max_entries: int,
+    ) -> None:
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.engines: List[AsyncEngine] = []
+        self.session_factories = []
+        for url in urls:
+            # Pools of the same size as the one of the primary (whose metrics they
+            # are not part of)
+            engine = create_async_engine(
+                url,
+                poolclass = AsyncAdaptedQueuePool,
+                **storage_backend.engine_options(url),
+            )
+            storage_backend.configure(engine)
+            self.engines.append(engine)
+            self.session_factories.append(sessionmaker(
+                autocommit = False,
+                autoflush = False,
+                expire_on_commit = False,
+                bind = engine,
+                class_ = AsyncSession,
+            ))
+        # Replicas are assumed usable until their lag has been checked
+        self.usable = [True] * len(self.engines)
+        self.recent = LRUCache(
+            max_bytes = recent_max_entries,
+            ttl = recent_ttl,
+            sizeof = lambda _: 1,
+        )
+        self._turn = itertools.count()
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def record_write(self, snippet_id: str) -> None:
+        # Look the snippet up on the primary until the replicas caught up
+        if self.enabled:
+            self.recent.set(snippet_id, True)
+
+    def _next_replica(self) -> Optional[int]:
+        # The number of the next usable replica, None if there is none
+        for _ in range(len(self.engines)):
+            i = next(self._turn) % len(self.engines)
+            if self.usable[i]:
+                return i
+        return None
+
+    async def _get_snippets(self, snippet_ids: List[str]) -> Optional[List[models.Snippet]]:
+        # Snippets found on a replica, None if no replica could be asked
+        i = self._next_replica()
+        if i is None:
+            return None
+        try:
+            async with self.session_factories[i]() as db:
+                return await crud.get_snippets(db, snippet_ids = snippet_ids)
+        except (asyncio.TimeoutError, SQLAlchemyError, OSError) as e:
+            # Skipped until the next check of its lag
+            logging.debug(f'DB   : Read replica {i} failed, reading from the primary: {e!r}')
+            self.usable[i] = False
+            return None
+
+    async def get_snippet(self, db: AsyncSession, snippet_id: str) -> Optional[models.Snippet]:
+        """Retrieve a Gleam code snippet from a replica, or from the primary.
+
+        Args:
+            db (AsyncSession): A session of the primary, only used if no replica
+                has the snippet.
+            snippet_id (str): The identifier of the snippet.
+
+        Returns:
+            Optional[models.Snippet]: The snippet. None if it does not exist.
+        """
+        if self.enabled and self.recent.get(snippet_id) is None:
+            db_snippets = await self._get_snippets([snippet_id])
+            if db_snippets is not None:
+                record_lookup('replica', bool(db_snippets))
+                if db_snippets:
+                    return db_snippets[0]
+        return await crud.get_snippet(db, snippet_id = snippet_id)
+
+    async def get_snippets(self, db: AsyncSession, snippet_ids: List[str]) -> List[models.Snippet]:
+        """Retrieve Gleam code snippets from a replica, and the rest from the primary.
+
+        Args:
+            db (AsyncSession): A session of the primary, only used for the snippets
+                no replica has.
+            snippet_ids (List[str]): The identifiers of the snippets.
+
+        Returns:
+            List[models.Snippet]: The snippets that exist.
+        """
+        found = []
+        replicated = [_ for _ in snippet_ids if self.recent.get(_) is None] if self.enabled else []
+        if replicated:
+            db_snippets = await self._get_snippets(replicated)
+            if db_snippets is not None:
+                found = db_snippets
+                known = {_.snippetID for _ in found}
+                for snippet_id in replicated:
+                    record_lookup('replica', snippet_id in known)
+                snippet_ids = [_ for _ in snippet_ids if _ not in known]
+        if snippet_ids:
+            found = found + await crud.get_snippets(db, snippet_ids = snippet_ids)
+        return found
+
+    async def check_lag(self) -> None:
+        """Measure the lag of each replica and skip the ones behind too far."""
+        for i, engine in enumerate(self.engines):
+            try:
+                async with engine.connect() as conn:
+                    if conn.dialect.name == 'postgresql':
+                        result = await asyncio.wait_for(
+                            conn.exec_driver_sql(LAG_QUERY), timeout = self.check_interval,
+                        )
+                        lag = float(result.scalar())
+                    else:
+                        lag = 0.0
+            except (asyncio.TimeoutError, SQLAlchemyError, OSError) as e:
+                logging.debug(f'DB   : Read replica {i} can not be reached: {e!r}')
+                DB_REPLICA_LAG_SECONDS.labels(replica = str(i)).set(-1)
+                self.usable[i] = False
+                continue
+            DB_REPLICA_LAG_SECONDS.labels(replica = str(i)).set(lag)
+            usable = lag <= self.max_lag
+            if usable != self.usable[i]:
+                logging.debug(
+                    f'DB   : Read replica {i} is {"used" if usable else "skipped"}, lag: {lag:.3f} s'
+                )
+            self.usable[i] = usable
+
+    async def _check_lag_periodically(self) -> None:
+        while True:
+            await self.check_lag()
+            await asyncio.sleep(self.check_interval)
+
+    def start(self) -> None:
+        if self.enabled:
+            self._task = asyncio.ensure_future(self._check_lag_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for engine in self.engines:
+            await engine.dispose()
+
+
+read_replicas = ReadReplicas(
+    urls = DATABASE_REPLICA_URLS,
+    max_lag = REPLICA_MAX_LAG,
+    check_interval = REPLICA_CHECK_INTERVAL,
+    recent_ttl = REPLICA_RECENT_TTL,
+    recent_max_entries = REPLICA_RECENT_MAX_ENTRIES,
+)
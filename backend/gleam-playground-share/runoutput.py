@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import urllib.request
+from typing import Any, Dict, Mapping, Optional, Set, Tuple
+from cache import run_cache
+from compression import encode_cache_value
+from database import RedisCache, SessionLocal, redis_cache
+from examples import Example
+import crud
+from settings import (
+    API_KEY,
+    REDIS_TTL,
+    RUN_SERVICE_URL,
+    RUN_SERVICE_TIMEOUT,
+    RUN_CONCURRENCY,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+)
+
+
+# Redis keys of the run outputs of snippets
+RUN_PREFIX = 'run:'
+
+
+def run_key(snippet_id: str) -> str:
+    return f'{RUN_PREFIX}{snippet_id}'
+
+
+class RunOutputs:
+    """Run outputs of snippets, such that viewers see them without a compile.
+
+    A run output is the JSON of the toolchain version, the events and the formatted
+    code returned by the run service. It is stored in the database next to the
+    snippet, and cached in Redis ('run:<id>') and in process next to its code.
+    Outputs are computed in the background by the run service, which is called
+    with blocking 'urllib' requests in the default executor (the share service has
+    no HTTP client dependency).
+
+    Args:
+        redis_cache (RedisCache): The Redis cache.
+        service_url (str): The address of the run service, empty if outputs are
+            never computed.
+        api_key (str): The API key of the run service.
+        timeout (float): Seconds to wait for the run service.
+        concurrency (int): The maximum number of snippets run at the same time.
+        persist_attempts (int, optional): How often storing an output is attempted
+            while its snippet is not persisted yet (write-behind). Defaults to 5.
+        persist_interval (float, optional): Seconds between these attempts.
+            Defaults to twice the write-behind flush interval.
+    """
+
+    def __init__(
+        self,
+        redis_cache: RedisCache,
+        service_url: str,
+        api_key: str,
+        timeout: float,
+        concurrency: int,
+        persist_attempts: int = 5,
+        persist_interval: float = 2 * WRITE_BEHIND_FLUSH_INTERVAL,
+    ) -> None:
+        self.redis_cache = redis_cache
+        self.service_url = service_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.persist_attempts = persist_attempts
+        self.persist_interval = persist_interval
+        # Example identifier -> (code, run output) of the bundled examples
+        self.examples: Dict[str, Tuple[str, str]] = {}
+        self._semaphore = None
+        self._tasks: Set[asyncio.Future] = set()
+
+    @property
+    def enabled(self) -> bool:
+        # Whether missing outputs are computed (and may thus still come)
+        return bool(self.service_url)
+
+    def example(self, example: Example) -> Optional[str]:
+        """The run output of a bundled example, if it was computed for its code."""
+        rv = self.examples.get(example.uuid)
+        if rv is None or rv[0] != example.code:
+            return None
+        return rv[1]
+
+    def _request(self, path: str, body: Any) -> Dict[str, Any]:
+        # Blocking, run in an executor
+        request = urllib.request.Request(
+            f'{self.service_url}{path}',
+            data = json.dumps(body).encode('utf-8'),
+            headers = {'Content-Type': 'application/json', 'X-Api-Key': self.api_key or ''},
+            method = 'POST',
+        )
+        with urllib.request.urlopen(request, timeout = self.timeout) as response:
+            return json.loads(response.read())
+
+    async def compute(self, code: str) -> Optional[str]:
+        """Run (and format) a Gleam code snippet with the run service.
+
+        Args:
+            code (str): The code of the snippet.
+
+        Returns:
+            Optional[str]: The run output. None if the run service failed.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            try:
+                rv = await asyncio.get_event_loop().run_in_executor(
+                    None, self._request, '/run?format=true', {'code': code},
+                )
+            except (OSError, ValueError) as e:
+                logging.debug(f'RUN  : A Gleam code snippet could not be run: {e}')
+                return None
+        return json.dumps({
+            'toolchain': rv.get('toolchain') or 'unknown',
+            'events': rv.get('events', []),
+            'formatted': rv.get('formatted'),
+        })
+
+    async def store(self, snippet_id: str, run_output: str) -> None:
+        """Store the run output of a snippet and cache it.
+
+        Args:
+            snippet_id (str): The identifier of the snippet.
+            run_output (str): The run output (JSON).
+        """
+        run_cache.set(snippet_id, run_output)
+        await self.redis_cache.set(
+            key = run_key(snippet_id),
+            value = encode_cache_value(run_output),
+            expire = REDIS_TTL,
+        )
+        for _ in range(self.persist_attempts):
+            async with SessionLocal() as db:
+                if await crud.set_run_output(db, snippet_id, run_output):
+                    logging.debug(f'DB   : A run output was stored with identifier: {snippet_id}')
+                    return
+            # Snippets queued by write-behind are persisted with the next batch
+            await asyncio.sleep(self.persist_interval)
+        logging.debug(f'DB   : The snippet of a run output was not found: {snippet_id}')
+
+    def schedule(
+        self,
+        snippet_id: str,
+        code: str,
+        run_output: Optional[str] = None,
+    ) -> None:
+        """Store the given run output of a new snippet, or compute it, in the background.
+
+        Args:
+            snippet_id (str): The identifier of the snippet.
+            code (str): The code of the snippet.
+            run_output (Optional[str], optional): The run output shared by the
+                client. Defaults to None.
+        """
+        if run_output is None and not self.enabled:
+            return
+        task = asyncio.ensure_future(self._store_or_compute(snippet_id, code, run_output))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _store_or_compute(
+        self,
+        snippet_id: str,
+        code: str,
+        run_output: Optional[str],
+    ) -> None:
+        try:
+            if run_output is None:
+                run_output = await self.compute(code)
+            if run_output is not None:
+                await self.store(snippet_id, run_output)
+        except Exception as e:
+            logging.debug(f'RUN  : The run output of {snippet_id} could not be stored: {e}')
+
+    async def precompute_examples(self, examples: Mapping[str, Example]) -> None:
+        """Compute the run outputs of the bundled examples (on startup).
+
+        Args:
+            examples (Mapping[str, Example]): The examples by identifier.
+        """
+        if not self.enabled:
+            return
+        examples = list(examples.values())
+        outputs = await asyncio.gather(*[self.compute(_.code) for _ in examples])
+        for example, run_output in zip(examples, outputs):
+            if run_output is not None:
+                self.examples[example.uuid] = (example.code, run_output)
+        logging.debug(f'RUN  : Precomputed the run outputs of {len(self.examples)} examples')
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        self._tasks.clear()
+
+
+run_outputs = RunOutputs(
+    redis_cache = redis_cache,
+    service_url = RUN_SERVICE_URL,
+    api_key = API_KEY,
+    timeout = RUN_SERVICE_TIMEOUT,
+    concurrency = RUN_CONCURRENCY,
+)
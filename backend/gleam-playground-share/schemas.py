@@ -1,10 +1,23 @@
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel
 
+class RunOutput(BaseModel):
+    toolchain: str
+    events: List[Dict[str, Any]]
+    formatted: Optional[str] = None
+
 class BaseSnippet(BaseModel):
     code: str
 
+class SharedSnippet(BaseSnippet):
+    # The output of running the code, if the client already has it
+    run: Optional[RunOutput] = None
+
 class Snippet(BaseSnippet):
     snippetID: str
 
     class Config:
         orm_mode = True
+
+class BatchGetSnippets(BaseModel):
+    ids: List[str]
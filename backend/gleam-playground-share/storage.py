@@ -0,0 +1,192 @@
+import logging
+import os
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Dict
+from asyncpg import Connection
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from settings import (
+    STORAGE_BACKEND,
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_DB,
+    POSTGRES_USER,
+    POSTGRES_PASSWORD,
+    POSTGRES_HOST,
+    POSTGRES_PORT,
+    POSTGRES_DB,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_CACHE_SIZE,
+    DB_UNIQUE_STATEMENT_NAMES,
+    EMBEDDED_DB_PATH,
+    EMBEDDED_BUSY_TIMEOUT,
+    EMBEDDED_MMAP_SIZE,
+)
+
+
+# Address of the in-process store that takes the place of Redis (see 'memorystore')
+MEMORY_URL = 'memory://'
+
+
+class StorageBackend(ABC):
+    """The deployment configuration of where snippets are stored and cached.
+
+    A backend only chooses the database and the (Redis) cache: their addresses, the
+    options of the database engine and the setup of its connections. It is no data
+    access layer. Queries ('crud') go through SQLAlchemy and cache commands through
+    'RedisCache' for every backend, which works because SQLAlchemy speaks to both
+    Postgres and SQLite and 'MemoryStore' implements the Redis commands in use.
+    """
+
+    name = ''
+
+    @abstractmethod
+    def database_url(self) -> str:
+        """The SQLAlchemy address of the database (unless DATABASE_URL is set)."""
+
+    @abstractmethod
+    def redis_url(self) -> str:
+        """The address of the cache (unless REDIS_URL is set)."""
+
+    def engine_options(self, database_url: str) -> Dict[str, Any]:
+        """Keyword arguments of 'create_async_engine' besides the pool class.
+
+        Args:
+            database_url (str): The database address, which may be overridden.
+
+        Returns:
+            Dict[str, Any]: The engine options.
+        """
+        return {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING,
+        }
+
+    def configure(self, engine: AsyncEngine) -> None:
+        """Prepare the backend for the created engine."""
+        pass
+
+
+class UniqueStatementNameConnection(Connection):
+    """An asyncpg connection that names its prepared statements randomly.
+
+    SQLAlchemy 1.4 prepares every statement under a name, even if none are cached,
+    and asyncpg numbers them per process. Behind pgbouncer in transaction pooling
+    mode a server connection is shared by the clients of all replicas, which would
+    reuse each other's names (SQLAlchemy 2.0 offers 'prepared_statement_name_func'
+    for this).
+    """
+
+    def _get_unique_id(self, prefix: str) -> str:
+        return f'__asyncpg_{prefix}_{uuid.uuid4().hex}__'
+
+
+class PostgresBackend(StorageBackend):
+    """Postgres (possibly behind pgbouncer) and Redis, shared by all replicas."""
+
+    name = 'postgres'
+
+    def database_url(self) -> str:
+        # PostgreSQL Kubernetes address is 'servicename.namespace.svc.cluster.local'
+        return f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}' + \
+            f'@{POSTGRES_HOST}.gleam-playground:{POSTGRES_PORT}/{POSTGRES_DB}' + \
+            f'?prepared_statement_cache_size={DB_STATEMENT_CACHE_SIZE}'
+
+    def redis_url(self) -> str:
+        # Redis kubernetes address is 'servicename.namespace.svc.cluster.local'
+        # TODO: Set address as environment variable such that it aligns with the kubernetes pod namespace
+        return f'redis://{REDIS_HOST}.gleam-playground:{REDIS_PORT}/{REDIS_DB}?encoding=utf-8'
+
+    def engine_options(self, database_url: str) -> Dict[str, Any]:
+        options = super().engine_options(database_url)
+        # asyncpg and SQLAlchemy each keep a cache of prepared statements per
+        # connection (SQLAlchemy's is set here too, DATABASE_URL may not set it)
+        if database_url.startswith('postgresql+asyncpg'):
+            options['connect_args'] = {
+                'statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+                'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+            }
+            if DB_UNIQUE_STATEMENT_NAMES:
+                options['connect_args']['connection_class'] = UniqueStatementNameConnection
+        return options
+
+
+class EmbeddedBackend(StorageBackend):
+    """A SQLite database file in WAL mode and an in-process store in place of Redis.
+
+    Meant for a single replica: Nothing is shared with other processes, in return
+    lookups neither cross the network nor need any external service. In WAL mode
+    reads run concurrently with a write, and hot pages are memory mapped.
+
+    Args:
+        path (str): The path of the database file.
+        busy_timeout (float): Seconds a write waits for the lock of another one.
+        mmap_size (int): Bytes of the database file that are memory mapped.
+    """
+
+    name = 'embedded'
+
+    def __init__(self, path: str, busy_timeout: float, mmap_size: int) -> None:
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+
+    def database_url(self) -> str:
+        return f'sqlite+aiosqlite:///{self.path}'
+
+    def redis_url(self) -> str:
+        return MEMORY_URL
+
+    def engine_options(self, database_url: str) -> Dict[str, Any]:
+        options = super().engine_options(database_url)
+        # Waiting for the lock is left to SQLite (the 'timeout' of 'sqlite3.connect')
+        options['connect_args'] = {'timeout': self.busy_timeout}
+        return options
+
+    def configure(self, engine: AsyncEngine) -> None:
+        if engine.dialect.name != 'sqlite':
+            return
+        # The database file may be given by DATABASE_URL as well
+        path = engine.url.database
+        if path and path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+
+        @event.listens_for(engine.sync_engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record) -> None:
+            cursor = dbapi_connection.cursor()
+            # The journal mode is stored in the database file, the rest per connection.
+            # With WAL, 'NORMAL' synchronisation is safe against corruption and only
+            # loses the latest commits on power loss
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute(f'PRAGMA mmap_size={self.mmap_size}')
+            cursor.close()
+        logging.debug(f'DB   : Embedded database at {path}')
+
+
+def get_backend(name: str) -> StorageBackend:
+    """Return the storage backend of the given name.
+
+    Raises:
+        ValueError: If there is no backend of that name.
+    """
+    if name == PostgresBackend.name:
+        return PostgresBackend()
+    if name == EmbeddedBackend.name:
+        return EmbeddedBackend(
+            path = EMBEDDED_DB_PATH,
+            busy_timeout = EMBEDDED_BUSY_TIMEOUT,
+            mmap_size = EMBEDDED_MMAP_SIZE,
+        )
+    raise ValueError(f'Unknown storage backend: {name}')
+
+
+storage_backend = get_backend(STORAGE_BACKEND)
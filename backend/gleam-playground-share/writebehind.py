@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import RedisCache, SessionLocal, redis_cache
+import crud
+from settings import (
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    WRITE_BEHIND_MAX_PENDING,
+    WRITE_BEHIND_REQUIRE_PERSISTENCE,
+)
+
+
+# Redis set of the identifiers of all snippets that have not been persisted yet, and
+# prefix of the Redis keys holding these snippets (without an expiry)
+PENDING_SET = 'pending'
+PENDING_PREFIX = 'pending:'
+
+
+# Prefix of the Redis keys of snippets that could not be persisted (without an
+# expiry), e.g. to be inspected and inserted by hand
+DEAD_LETTER_PREFIX = 'deadletter:'
+
+
+def pending_key(snippet_id: str) -> str:
+    return f'{PENDING_PREFIX}{snippet_id}'
+
+
+def dead_letter_key(snippet_id: str) -> str:
+    return f'{DEAD_LETTER_PREFIX}{snippet_id}'
+
+
+class WriteBehindBuffer:
+    """Make new snippets durable in Redis and persist them to the database in batches.
+
+    Snippets are only durable if Redis persists its data (append only file). If it
+    reports otherwise, no snippets are accepted unless 'require_persistence' is
+    off. If a batch fails, its snippets are inserted one by one. Snippets that still
+    fail while the database is reachable are moved to a dead letter key, such that
+    they do not hold up the snippets queued after them.
+
+    Args:
+        redis_cache (RedisCache): The Redis cache the snippets are made durable in.
+        session_factory (Callable[[], AsyncSession]): Creates database sessions.
+        batch_size (int): The maximum number of snippets per multi-row insert.
+        flush_interval (float): Seconds between flushes.
+        max_pending (int): The maximum number of snippets waiting to be persisted.
+        require_persistence (bool, optional): Only accept snippets if Redis
+            persists its data. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        redis_cache: RedisCache,
+        session_factory: Callable[[], AsyncSession],
+        batch_size: int,
+        flush_interval: float,
+        max_pending: int,
+        require_persistence: bool = True,
+    ) -> None:
+        self.redis_cache = redis_cache
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.require_persistence = require_persistence
+        # Whether snippets are accepted, see 'check_persistence'
+        self.accepting = True
+        # Snippet identifier -> (code, content hash), oldest first
+        self.pending: 'OrderedDict[str, Tuple[str, str]]' = OrderedDict()
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    async def add(self, snippet_id: str, code: str, code_hash: str) -> bool:
+        """Make a snippet durable in Redis and queue it to be persisted.
+
+        Args:
+            snippet_id (str): The identifier of the snippet.
+            code (str): The code of the snippet.
+            code_hash (str): The content hash of the code.
+
+        Returns:
+            bool: False if the snippet was not accepted (the backlog is full or Redis
+                is unavailable) and has to be written synchronously instead.
+        """
+        if not self.accepting:
+            return False
+        if len(self.pending) >= self.max_pending:
+            logging.debug('WRITE-BEHIND: The backlog is full')
+            return False
+        rv = await self.redis_cache.multi_exec(
+            ('set', pending_key(snippet_id), json.dumps({'code': code, 'hash': code_hash})),
+            ('sadd', PENDING_SET, snippet_id),
+        )
+        if rv is None:
+            return False
+        self.pending[snippet_id] = (code, code_hash)
+        return True
+
+    def get(self, snippet_id: str) -> Optional[str]:
+        entry = self.pending.get(snippet_id)
+        if entry is None:
+            return None
+        return entry[0]
+
+    async def check_persistence(self) -> None:
+        """Stop accepting snippets if Redis does not persist them (on startup)."""
+        persistent = await self.redis_cache.persistent()
+        if persistent is False and self.require_persistence:
+            logging.debug(
+                'WRITE-BEHIND: Redis does not persist its data (appendonly), '
+                'new snippets are written synchronously'
+            )
+            self.accepting = False
+
+    async def recover(self) -> None:
+        """Queue the snippets left unpersisted by this or any other replica."""
+        snippet_ids = await self.redis_cache.smembers(PENDING_SET)
+        for snippet_id in snippet_ids or []:
+            value = await self.redis_cache.get(pending_key(snippet_id))
+            if value is None:
+                # It was persisted by another replica in the meantime
+                continue
+            entry = json.loads(value)
+            self.pending.setdefault(snippet_id, (entry['code'], entry['hash']))
+        logging.debug(f'WRITE-BEHIND: Recovered {len(self.pending)} unpersisted snippets')
+
+    async def _insert(self, batch: List[Tuple[str, Tuple[str, str]]]) -> None:
+        async with self.session_factory() as db:
+            await crud.insert_snippets(
+                db, [(snippet_id, code, code_hash) for snippet_id, (code, code_hash) in batch],
+            )
+
+    async def _persisted(self, snippet_ids: List[str]) -> None:
+        await self.redis_cache.multi_exec(
+            ('delete', *[pending_key(_) for _ in snippet_ids]),
+            ('srem', PENDING_SET, *snippet_ids),
+        )
+        for snippet_id in snippet_ids:
+            del self.pending[snippet_id]
+        logging.debug(f'WRITE-BEHIND: Persisted {len(snippet_ids)} snippets')
+
+    async def _insert_one_by_one(self, batch: List[Tuple[str, Tuple[str, str]]]) -> None:
+        """Insert the snippets of a failed batch separately, set aside the ones that fail.
+
+        Raises:
+            Exception: If no snippet could be inserted and the database is not
+                reachable either, the batch is retried as a whole later.
+        """
+        failed = []
+        for snippet_id, entry in batch:
+            try:
+                await self._insert([(snippet_id, entry)])
+            except Exception as e:
+                failed.append((snippet_id, entry, e))
+            else:
+                await self._persisted([snippet_id])
+        if not failed:
+            return
+        if len(failed) == len(batch):
+            # Tell a failing database from snippets that can not be inserted
+            async with self.session_factory() as db:
+                await db.execute(text('SELECT 1'))
+        for snippet_id, (code, code_hash), e in failed:
+            logging.debug(f'WRITE-BEHIND: Snippet {snippet_id} can not be persisted: {e}')
+            rv = await self.redis_cache.multi_exec(
+                ('set', dead_letter_key(snippet_id), json.dumps(
+                    {'code': code, 'hash': code_hash, 'error': str(e)}
+                )),
+                ('delete', pending_key(snippet_id)),
+                ('srem', PENDING_SET, snippet_id),
+            )
+            if rv is None:
+                raise RuntimeError(f'Snippet {snippet_id} could not be set aside')
+            del self.pending[snippet_id]
+
+    async def flush(self) -> None:
+        """Persist all queued snippets, one multi-row insert per batch."""
+        while self.pending:
+            batch = list(self.pending.items())[:self.batch_size]
+            try:
+                await self._insert(batch)
+            except Exception as e:
+                logging.debug(f'WRITE-BEHIND: A batch failed, inserting one by one: {e}')
+                await self._insert_one_by_one(batch)
+                continue
+            await self._persisted([snippet_id for snippet_id, _ in batch])
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        delay = self.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except Exception as e:
+                # Retry with exponential backoff, the snippets stay durable in Redis
+                delay = min(2 * delay, 30.0)
+                logging.debug(f'WRITE-BEHIND: Flush failed, retrying in {delay}s: {e}')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.debug(f'WRITE-BEHIND: Final flush failed, snippets stay in Redis: {e}')
+
+
+write_behind = WriteBehindBuffer(
+    redis_cache = redis_cache,
+    session_factory = SessionLocal,
+    batch_size = WRITE_BEHIND_BATCH_SIZE,
+    flush_interval = WRITE_BEHIND_FLUSH_INTERVAL,
+    max_pending = WRITE_BEHIND_MAX_PENDING,
+    require_persistence = WRITE_BEHIND_REQUIRE_PERSISTENCE,
+)
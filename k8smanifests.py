@@ -239,6 +239,49 @@ def deployment_template(
     )
     return deployment
 
+def job_template(
+    job_name,
+    image_name,
+    image_version,
+    namespace,
+    container_command=None,
+    container_volume_mounts=None,
+    volumes=None,
+    backoff_limit=3,
+    ttl_seconds_after_finished=600,
+    ):
+    # Configure Pod template container
+    container = client.V1Container(
+        name=job_name,
+        image="{}:{}".format(image_name, image_version),
+        command=container_command,
+        volume_mounts=container_volume_mounts,
+    )
+    # Create and configurate a spec section
+    template = client.V1PodTemplateSpec(
+        metadata=client.V1ObjectMeta(
+            labels={"io.service": job_name},
+        ),
+        spec=client.V1PodSpec(
+            containers=[container],
+            volumes=volumes,
+            restart_policy="Never",
+        ),
+    )
+    # Jobs can not be changed once created, a finished one is deleted after a while
+    # such that the manifest can be applied again on the next deployment
+    job = client.V1Job(
+        api_version="batch/v1",
+        kind="Job",
+        metadata=client.V1ObjectMeta(name=job_name, namespace=namespace),
+        spec=client.V1JobSpec(
+            template=template,
+            backoff_limit=backoff_limit,
+            ttl_seconds_after_finished=ttl_seconds_after_finished,
+        ),
+    )
+    return job
+
 def service_template(service_name, service_type, service_ports, namespace):
     pvc = client.V1Service(
         api_version="v1",
@@ -454,6 +497,48 @@ def create_gleam_playground_pgbouncer_manifests(
     k8s_service_obj = k8s_service_obj.to_dict()
     to_yaml(k8s_service_obj, service_name + "-service.yaml", service_name)
 
+def create_gleam_playground_migrate_manifests(
+    config,
+    account_name,
+    service_name,
+    namespace,
+    parent_service_name=None,
+    secret_ref_name=None
+    ):
+    """Generate k8s manifests pertaining to the 'gleam-playground-migrate' job.
+
+    The job creates or migrates the database tables of the share function (which
+    does not do so on startup) and is applied before the functions are deployed.
+    """
+    ###
+    ### Job
+    ###
+    k8s_job_obj = job_template(
+        job_name=service_name,
+        image_name=os.path.join(account_name, parent_service_name),
+        namespace=namespace,
+        image_version="latest",
+        container_command=["python", "manage.py", "migrate"],
+        # The share function reads its secrets from files, as mounted by OpenFaaS
+        container_volume_mounts=[
+            client.V1VolumeMount(
+                mount_path="/var/openfaas/secrets",
+                name=secret_ref_name,
+                read_only=True,
+            ),
+        ],
+        volumes=[
+            client.V1Volume(
+                name=secret_ref_name,
+                secret=client.V1SecretVolumeSource(secret_name=secret_ref_name),
+            ),
+        ],
+    )
+    # Override the default to_dict method so we can update the k8s keys
+    k8s_job_obj.to_dict = MethodType(_camelized_to_dict, k8s_job_obj)
+    k8s_job_obj = k8s_job_obj.to_dict()
+    to_yaml(k8s_job_obj, service_name + "-job.yaml", service_name)
+
 def create_gleam_playground_frontend_manifests(
     config,
     account_name,
@@ -517,6 +602,22 @@ def create_redis_manifests(
     # another host name is set in the settings file.
     assert config._sections.get("redis").get("redis_host") == service_name
     port = int(config._sections.get("redis").get("redis_port"))
+    pvc_name = service_name + "-claim"
+
+    ###
+    ### PersistentVolumeClaim
+    ###
+    k8s_pvc_obj = persistent_volume_claim_template(
+        pvc_name=pvc_name,
+        pvc_resources=client.V1ResourceRequirements(
+            requests={"storage": "1Gi"},
+        ),
+        namespace=namespace,
+    )
+    # Override the default to_dict method so we can update the k8s keys
+    k8s_pvc_obj.to_dict = MethodType(_camelized_to_dict, k8s_pvc_obj)
+    k8s_pvc_obj = k8s_pvc_obj.to_dict()
+    to_yaml(k8s_pvc_obj, service_name + "-pvc.yaml", service_name)
 
     ###
     ### Deployment
@@ -529,10 +630,28 @@ def create_redis_manifests(
         container_ports=[
             client.V1ContainerPort(container_port=port)
         ],
-        container_args=["redis-server"],
+        # The share service's write-behind mode keeps snippets that are not yet
+        # in the database in Redis, so Redis persists every write to an append only
+        # file (synced to disk once per second) on a persistent volume
+        container_args=["redis-server", "--appendonly", "yes", "--appendfsync", "everysec"],
         container_resources=client.V1ResourceRequirements(
             requests={"cpu": "500m", "memory": "1000Mi"},
         ),
+        container_volume_mounts=[
+            client.V1VolumeMount(
+                mount_path="/data",
+                name=pvc_name,
+            ),
+        ],
+        volumes=[
+            client.V1Volume(
+                name=pvc_name,
+                persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                    claim_name=pvc_name,
+                    read_only=False,
+                ),
+            ),
+        ],
     )
     # Override the default to_dict method so we can update the k8s keys
     k8s_deployment_obj.to_dict = MethodType(_camelized_to_dict, k8s_deployment_obj)
@@ -714,6 +833,17 @@ def main(account_name, config, args):
             namespace=args.namespace,
         )
         ###
+        ### Create 'gleam-playground-migrate' manifests
+        ###
+        create_gleam_playground_migrate_manifests(
+            config=config,
+            account_name=account_name,
+            service_name=service_name + "-migrate",
+            parent_service_name=service_name + "-share",
+            secret_ref_name=secret_ref_name,
+            namespace=args.namespace,
+        )
+        ###
         ### Create 'gleam-playground-frontend' manifests
         ###
         create_gleam_playground_frontend_manifests(